@@ -0,0 +1,93 @@
+import asyncio
+import inspect
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
+
+from batch import render_job
+from pdf_template_manager import PdfTemplateManager, compile_formats
+
+
+# Size of the chunks written to an async writer
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+async def _write(writer, chunk: bytes) -> None:
+    result = writer.write(chunk)
+    if inspect.isawaitable(result):
+        await result
+    drain = getattr(writer, "drain", None)
+    if drain is not None:
+        await drain()
+
+
+class WriterFile:
+    """
+    Binary file object for the rendering thread, which passes the written data in chunks to an async writer
+    on the event loop. Each chunk is awaited before the rendering continues, so a slow writer slows down
+    the rendering instead of buffering the document.
+    """
+    def __init__(self, writer, loop: asyncio.AbstractEventLoop) -> None:
+        self.writer = writer
+        self.loop = loop
+        self.buffer = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        if len(self.buffer) >= WRITE_CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self) -> None:
+        if self.buffer:
+            chunk, self.buffer = bytes(self.buffer), bytearray()
+            asyncio.run_coroutine_threadsafe(_write(self.writer, chunk), self.loop).result()
+
+
+def stream_job(content: list, formats: dict|None, file: WriterFile) -> None:
+    """
+    Renders a document and streams its pages to the file as they are completed (see `PdfTemplateManager.stream_to`).
+    """
+    pdf = PdfTemplateManager(compiled_formats=compile_formats(formats))
+    pdf.stream_to(file)
+    pdf.render(content)
+    file.flush()
+
+
+async def render_async(
+        content: list,
+        formats: dict|None=None,
+        executor: Executor|None=None,
+        writer=None,
+        semaphore: asyncio.Semaphore|None=None,
+    ) -> bytes|None:
+    """
+    Renders a document without blocking the event loop and without writing it to disk.
+    The rendering runs in the given executor. Threads keep the event loop responsive, but share
+    the GIL, whereas a `ProcessPoolExecutor(initializer=batch.warm_up)` renders in parallel.
+    Returns the document as bytes or None, if the document is streamed to the writer.
+    With a writer, the pages are written as soon as they are completed, while the rest of the document
+    is still rendered. Streaming requires a thread executor (e.g. the default one), since the writer
+    belongs to the event loop.
+    Example:
+        limit = asyncio.Semaphore(4)
+        pdf = await render_async(content, semaphore=limit)
+    Args:
+        content (list): The content blocks of the document (see `PdfTemplateManager.render`).
+        formats (dict): Optional formats overriding the default formats.
+        executor (Executor): The executor running the rendering. Defaults to the executor of the event loop.
+        writer: Optional async writer such as an `asyncio.StreamWriter`. Its `write` may be a coroutine
+            and its `drain` is awaited after each chunk, if available.
+        semaphore (asyncio.Semaphore): Optional limit for the number of documents rendered at once.
+            Share the semaphore between all calls, which should be limited together.
+    """
+    if writer is not None and isinstance(executor, ProcessPoolExecutor):
+        raise TypeError("Documents are streamed to a writer from a thread, use a thread executor")
+    loop = asyncio.get_running_loop()
+    if writer is None:
+        job = partial(render_job, content, formats)
+    else:
+        job = partial(stream_job, content, formats, WriterFile(writer, loop))
+    if semaphore is not None:
+        async with semaphore:
+            return await loop.run_in_executor(executor, job)
+    return await loop.run_in_executor(executor, job)
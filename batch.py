@@ -0,0 +1,141 @@
+import multiprocessing
+import time
+from functools import partial
+from typing import Iterable, Iterator
+
+from pdf_template_manager import PdfTemplateManager, compile_formats
+
+
+def render_job(content: list, custom_formats: dict|None, destination=None, deterministic: bool=False) -> bytes|None:
+    """
+    Renders a single document with the given content and formats.
+    Returns the document as bytes, if no destination is given.
+    Args:
+        content (list): The content blocks of the document (see `PdfTemplateManager.render`).
+        custom_formats (dict): Optional formats overriding the default formats.
+        destination (str): The path or binary file object the document is written to.
+        deterministic (bool): Renders the same bytes for the same content and formats
+            (see `PdfTemplateManager`).
+    """
+    pdf = PdfTemplateManager(compiled_formats=compile_formats(custom_formats), deterministic=deterministic)
+    output = pdf.render(content, destination if destination is not None else "")
+    return bytes(output) if output is not None else None
+
+
+def run_job(job: tuple, deterministic: bool=False) -> dict:
+    """
+    Renders a job (content, formats, destination) and returns its result, containing the destination,
+    the status ("ok" or "error"), the error message, the duration in milliseconds and the document
+    as bytes, if the job has no destination.
+    """
+    start = time.perf_counter()
+    destination = pdf = None
+    try:
+        # Malformed jobs fail like any other job
+        content, custom_formats, destination = job
+        pdf = render_job(content, custom_formats, destination, deterministic)
+        status, error = "ok", None
+    except Exception as e:
+        status, error = "error", f"{type(e).__name__}: {e}"
+    return {
+        "destination": destination,
+        "status": status,
+        "error": error,
+        "duration_ms": (time.perf_counter() - start) * 1000,
+        "pdf": pdf,
+    }
+
+
+def render_many(jobs: Iterable, deterministic: bool=False) -> Iterator:
+    """
+    Renders many documents within the current process one after another.
+    All documents share the loaded fonts, the compiled formats, the font subsets and the
+    text measurements of the process, so only the first documents pay for warming them up.
+    A failing document does not abort the remaining ones.
+    Yields one result per job (see `run_job`) as soon as it is rendered, so the documents
+    returned as bytes are not kept in memory, unless the caller keeps them.
+    Args:
+        jobs (iterable): Tuples (content, formats, destination), where formats is optional
+            and overrides the default formats of the document. Without a destination,
+            the result contains the document as bytes.
+        deterministic (bool): Renders the same bytes for the same job (see `PdfTemplateManager`).
+    """
+    for job in jobs:
+        yield run_job(job, deterministic)
+
+
+def warm_up(custom_formats: list|None=None) -> None:
+    """
+    Loads all fonts and compiles the given formats, so the following documents
+    of the current process start with warm caches.
+    Args:
+        custom_formats (list): Formats, which are going to be used by the jobs.
+    """
+    PdfTemplateManager().load_fonts()
+    for formats in custom_formats or ():
+        compile_formats(formats)
+
+
+class PoolRenderer:
+    """
+    Renders documents in a pool of worker processes. Rendering is CPU bound, so the throughput
+    scales with the number of processes instead of threads. Each worker warms up its fonts and
+    formats once (see `warm_up`) and renders chunks of jobs to amortize the communication between
+    the processes. The pool is kept alive until it is closed, so several batches share the warm workers.
+    Example:
+        with PoolRenderer(processes=4) as renderer:
+            results = renderer.render(jobs)
+    """
+    def __init__(
+            self,
+            processes: int|None=None,
+            chunksize: int=8,
+            maxtasksperchild: int|None=None,
+            custom_formats: list|None=None,
+            deterministic: bool=False,
+        ) -> None:
+        """
+        Args:
+            processes (int): The number of worker processes. Defaults to the number of CPUs.
+            chunksize (int): The number of jobs sent to a worker at once.
+            maxtasksperchild (int): The number of chunks a worker renders, before it is replaced
+                by a new one. Defaults to keeping the workers for the lifetime of the pool.
+            custom_formats (list): Formats, which are compiled by each worker in advance.
+            deterministic (bool): Renders the same bytes for the same job in every worker
+                (see `PdfTemplateManager`).
+        """
+        self.chunksize = chunksize
+        self.deterministic = deterministic
+        self._pool = multiprocessing.Pool(
+            processes,
+            initializer=warm_up,
+            initargs=(custom_formats,),
+            maxtasksperchild=maxtasksperchild,
+        )
+
+    def __enter__(self) -> "PoolRenderer":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def imap(self, jobs: Iterable) -> Iterator:
+        """
+        Renders the jobs (see `render_many`) and yields their results in the order of the jobs,
+        as soon as they are available. The destinations have to be paths or None, since file objects
+        cannot be passed to other processes.
+        """
+        return self._pool.imap(partial(run_job, deterministic=self.deterministic), jobs, chunksize=self.chunksize)
+
+    def render(self, jobs: Iterable) -> list:
+        """
+        Renders the jobs (see `render_many`) and returns the list of results in the order of the jobs.
+        """
+        return list(self.imap(jobs))
+
+    def close(self) -> None:
+        """
+        Waits for the pending jobs and stops the workers.
+        """
+        self._pool.close()
+        self._pool.join()
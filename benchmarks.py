@@ -0,0 +1,321 @@
+import os
+import tempfile
+import time
+import tracemalloc
+
+from fpdf import FPDF
+from fpdf.output import OutputProducer
+from fpdf.table import Table
+
+from font_registry import font_registry
+from main import content
+from page_layers import PageLayer
+from pdf_template_manager import PdfTemplateManager
+from render_profiler import RenderProfiler
+from result_cache import ResultCache
+from subset_cache import subset_cache
+from text_metrics import wrap_cache
+
+
+def timed(func, repeat: int=1) -> float:
+    """
+    Runs the given function `repeat` times and returns the average wall time in milliseconds.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def bench_constructor(repeat: int=50) -> None:
+    """
+    Compares the latency of the constructor with a cold and a warm font cache.
+    """
+    font_registry.clear()
+    cold = timed(PdfTemplateManager)
+    warm = timed(PdfTemplateManager, repeat)
+    print(f"PdfTemplateManager() cold cache: {cold:8.2f} ms")
+    print(f"PdfTemplateManager() warm cache: {warm:8.2f} ms ({cold / warm:.1f}x faster)")
+    print(f"Font cache: {font_registry.stats()}")
+
+
+def layout(content: list) -> PdfTemplateManager:
+    """
+    Renders the content blocks without writing the document.
+    """
+    pdf = PdfTemplateManager()
+    for item in content:
+        getattr(pdf, f"render_{item['type']}")(**item["args"])
+    return pdf
+
+
+def bench_output(repeat: int=20) -> None:
+    """
+    Compares the latency of `output()` with and without the subset cache.
+    """
+    subset_cache.clear()
+    documents = [layout(content) for _ in range(repeat)]
+    uncached = timed(lambda: documents.pop().output(output_producer_class=OutputProducer), repeat)
+    documents = [layout(content) for _ in range(repeat)]
+    cached = timed(lambda: documents.pop().output(), repeat)
+    print(f"output() without subset cache: {uncached:8.2f} ms")
+    print(f"output() with subset cache:    {cached:8.2f} ms ({uncached / cached:.1f}x faster)")
+    print(f"Subset cache: {subset_cache.stats()}")
+
+
+def estimate_with_dry_run(pdf: PdfTemplateManager, items: list, col_widths: tuple) -> int:
+    """
+    The former estimation of the number of table rows, which renders every cell in a dry run.
+    """
+    tmp_x, tmp_y = pdf.get_x(), pdf.get_y()
+    max_y = tmp_y
+    num_of_rows = 0
+    with pdf.offset_rendering() as dummy:
+        for row in items:
+            for index, col in enumerate(row):
+                dummy.set_x(tmp_x)
+                dummy.set_y(tmp_y)
+                dummy.multi_cell(w=col_widths[index], text=col, h=pdf.line_height)
+                max_y = max(max_y, dummy.get_y())
+            num_of_rows += (max_y - tmp_y) / pdf.line_height
+            tmp_y = max_y
+    return int(round(num_of_rows))
+
+
+def bench_table_estimation(rows: int=10000) -> None:
+    """
+    Compares the estimation of the table height with dry runs of `multi_cell` and with `measure_text`.
+    """
+    table = content[7]["args"]
+    items = [table["table_items"][1 + index % (len(table["table_items"]) - 1)] for index in range(rows)]
+    pdf = PdfTemplateManager()
+    # The dry run does not accept page breaks, hence we start at the top of a huge page
+    pdf.add_page(format=(210, 20 * rows))
+    dry_run = timed(lambda: estimate_with_dry_run(pdf, items, table["col_widths"]))
+    metrics = timed(lambda: pdf.estimate_table_height(items, col_widths=table["col_widths"]))
+    print(f"Table height estimation ({rows} rows) with dry runs:    {dry_run:8.2f} ms")
+    print(f"Table height estimation ({rows} rows) with text metrics: {metrics:8.2f} ms ({dry_run / metrics:.1f}x faster)")
+
+
+def render_with_fpdf_table(pdf: PdfTemplateManager, items: list, **kwargs) -> None:
+    """
+    Renders a table with the table of fpdf, which measures every cell in a dry run before drawing it.
+    """
+    table = Table(pdf, line_height=pdf.line_height, **kwargs)
+    for item in items:
+        table.row(item)
+    table.render()
+
+
+def bench_table_rendering(rows: int=2000) -> None:
+    """
+    Compares rendering a large table with the table of fpdf and with the single layout pass of `render_table`.
+    """
+    table = dict(content[7]["args"])
+    table_items = table.pop("table_items")
+    items = [table_items[0]] + [table_items[1 + index % (len(table_items) - 1)] for index in range(rows)]
+    for key in ("pb", "line_color"):
+        table.pop(key)
+    def render(method: str) -> None:
+        pdf = PdfTemplateManager()
+        pdf.register_font(pdf.font_family, "B")
+        if method == "fpdf":
+            render_with_fpdf_table(pdf, items, **table)
+        else:
+            pdf.render_table(items, **table)
+    fpdf_table = timed(lambda: render("fpdf"))
+    layout_table = timed(lambda: render("layout"))
+    print(f"Table rendering ({rows} rows) with fpdf table:   {fpdf_table:8.2f} ms")
+    print(f"Table rendering ({rows} rows) with table layout: {layout_table:8.2f} ms ({fpdf_table / layout_table:.1f}x faster)")
+
+
+def bench_text_wrapping(blocks: int=2000) -> None:
+    """
+    Compares rendering recurring texts with `multi_cell` and with the wrap cache.
+    """
+    texts = [row[0] for row in content[7]["args"]["table_items"][1:]]
+    def render(method: str) -> None:
+        pdf = PdfTemplateManager()
+        for index in range(blocks):
+            if method == "multi_cell":
+                pdf.multi_cell(w=80, h=pdf.line_height, text=texts[index % len(texts)], new_x="LEFT", new_y="NEXT")
+            else:
+                pdf.wrapped_cell(w=80, text=texts[index % len(texts)])
+    wrap_cache.clear()
+    uncached = timed(lambda: render("multi_cell"))
+    cached = timed(lambda: render("wrapped_cell"))
+    print(f"Text wrapping ({blocks} blocks) with multi_cell: {uncached:8.2f} ms")
+    print(f"Text wrapping ({blocks} blocks) with wrap cache: {cached:8.2f} ms ({uncached / cached:.1f}x faster)")
+    print(f"Wrap cache: {wrap_cache.stats()}")
+
+
+def bench_page_layers(pages: int=500) -> None:
+    """
+    Compares drawing the letterhead lines and fold marks on every page with placing them as page layer.
+    The layer is small compared to the rest of each page, so the gain is moderate (1.2 to 1.7x, about 15% smaller).
+    """
+    letterhead = [item for item in content if item["type"] == "line"] + [
+        {"type": "text", "args": {"lines": ["DaumDigital • Olshausenstr. 11 • 24118 Kiel"], "x": 23, "y": 285, "size": 7}},
+        {"type": "line", "args": {"x1": 23, "x2": 187, "y1": 284}},
+    ]
+    sizes = {}
+    def render(method: str) -> None:
+        pdf = PdfTemplateManager()
+        if method == "layer":
+            pdf.add_page_layer(letterhead)
+        else:
+            def header() -> None:
+                # Same as the recording of a layer: no page breaks and the cursor is kept
+                x, y = pdf.get_x(), pdf.get_y()
+                pdf.set_auto_page_break(False)
+                PageLayer(letterhead).draw(pdf)
+                pdf.set_auto_page_break(True, pdf.marginY + pdf.paddingFooter)
+                pdf.set_xy(x, y)
+            pdf.header = header
+            pdf.header()
+        for _ in range(pages - 1):
+            pdf.add_page()
+        sizes[method] = len(pdf.output())
+    redrawn = timed(lambda: render("redraw"))
+    layer = timed(lambda: render("layer"))
+    print(f"Static content on {pages} pages redrawn:       {redrawn:8.2f} ms, {sizes['redraw']} bytes")
+    print(f"Static content on {pages} pages as page layer: {layer:8.2f} ms, {sizes['layer']} bytes ({redrawn / layer:.1f}x faster)")
+
+
+def bench_combined_documents(documents: int=200) -> None:
+    """
+    Compares rendering many documents separately with rendering them into a single file.
+    Combining mainly shrinks the output (about 5x smaller for 200 documents, as the fonts are embedded once).
+    The time is dominated by the layout of each document, so it is only about 1.1x faster.
+    """
+    sizes = {}
+    def separately() -> None:
+        sizes["separately"] = sum(len(PdfTemplateManager().render(content)) for _ in range(documents))
+    def combined() -> None:
+        sizes["combined"] = len(PdfTemplateManager().render_documents({"content": content} for _ in range(documents)))
+    separate = timed(separately)
+    single = timed(combined)
+    print(f"{documents} documents rendered separately: {separate:8.2f} ms, {sizes['separately']} bytes")
+    print(f"{documents} documents rendered combined:   {single:8.2f} ms, {sizes['combined']} bytes ({separate / single:.1f}x faster)")
+
+
+def bench_streaming_output(documents: int=100) -> None:
+    """
+    Compares the peak memory of writing a large file at once with streaming its pages.
+    """
+    def peak(stream: bool) -> tuple:
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, "streamed.pdf")
+            tracemalloc.start()
+            start = time.perf_counter()
+            pdf = PdfTemplateManager()
+            if stream:
+                pdf.stream_to(fname)
+            pdf.render_documents(({"content": content} for _ in range(documents)), fname)
+            elapsed = (time.perf_counter() - start) * 1000
+            memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return elapsed, memory, pdf.pages_count
+    buffered = peak(False)
+    streamed = peak(True)
+    print(f"{buffered[2]} pages written at once: {buffered[0]:8.2f} ms, peak {buffered[1] / 2**20:.1f} MiB")
+    print(f"{streamed[2]} pages streamed:        {streamed[0]:8.2f} ms, peak {streamed[1] / 2**20:.1f} MiB")
+
+
+def bench_result_cache(repeat: int=20) -> None:
+    """
+    Compares rendering the same document again with returning it from the result cache.
+    """
+    cache = ResultCache()
+    cache.render(content)
+    rendered = timed(lambda: PdfTemplateManager().render(content), repeat)
+    cached = timed(lambda: cache.render(content), repeat)
+    print(f"render():          {rendered:8.2f} ms")
+    print(f"ResultCache hit:   {cached:8.2f} ms ({rendered / cached:.0f}x faster)")
+
+
+def bench_fragment_cache(documents: int=200) -> None:
+    """
+    Compares laying out repeated blocks (legal notes and payment details) in every document
+    with replaying them from the fragment cache.
+    """
+    blocks = [
+        {"type": "text", "args": {"lines": ["Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor. " * 6] * 3}},
+        {"type": "table", "args": {"table_items": [["Bank", "IBAN"], ["Sparkasse", "DE00 1234 5678 9012 3456 78"]]}},
+    ]
+    cached = [dict(block, cache=True) for block in blocks]
+    def render(content: list) -> None:
+        for _ in range(documents):
+            PdfTemplateManager().render_content(content)
+    render(cached)
+    laid_out = timed(lambda: render(blocks))
+    replayed = timed(lambda: render(cached))
+    print(f"{documents} documents with laid out blocks: {laid_out:8.2f} ms")
+    print(f"{documents} documents with replayed blocks: {replayed:8.2f} ms ({laid_out / replayed:.1f}x faster)")
+
+
+def bench_state_tracking(rows: int=2000) -> None:
+    """
+    Compares the content streams of a large table with formatted cells with and without dropping
+    redundant color, line width and font operators.
+    """
+    class Untracked(PdfTemplateManager):
+        _out = FPDF._out
+    items = [[f"Pos {i}", "Artikel", f"{i},00 €"] for i in range(rows)]
+    cell_formats = {f"{row}.{column}": {"bg_color": (240, 240, 240), "style": "B"} for row in range(0, rows, 2) for column in range(3)}
+    def render(pdf_class: type) -> tuple:
+        pdf = pdf_class()
+        pdf.render_table(items, cell_formats=cell_formats)
+        return pdf, sum(len(page.contents) for page in pdf.pages.values())
+    untracked_time = timed(lambda: render(Untracked))
+    tracked_time = timed(lambda: render(PdfTemplateManager))
+    (_, untracked), (pdf, tracked) = render(Untracked), render(PdfTemplateManager)
+    stats = pdf.graphics_state.stats()
+    print(f"{rows} rows without tracking: {untracked / 1024:8.1f} KiB content, {untracked_time:8.2f} ms")
+    print(f"{rows} rows with tracking:    {tracked / 1024:8.1f} KiB content, {tracked_time:8.2f} ms ({1 - tracked / untracked:.0%} smaller)")
+    print(f"Suppressed operators: {stats}")
+
+
+def bench_layout(repeat: int=10) -> None:
+    """
+    Compares rendering a document with only laying it out to get its pages and block positions.
+    """
+    rows = [[f"Pos {i}", "Artikel " * (i % 5 + 1), f"{i},00 €"] for i in range(500)]
+    document = content + [{"type": "table", "args": {"table_items": rows}}]
+    rendered = timed(lambda: PdfTemplateManager().render(document), repeat)
+    laid_out = timed(lambda: PdfTemplateManager().layout(document), repeat)
+    print(f"render(): {rendered:8.2f} ms")
+    print(f"layout(): {laid_out:8.2f} ms ({rendered / laid_out:.1f}x faster)")
+
+
+def bench_profiling(repeat: int=20) -> None:
+    """
+    Measures the overhead of the render instrumentation and prints the hottest blocks of the example content.
+    """
+    PdfTemplateManager().render(content)
+    plain = timed(lambda: PdfTemplateManager().render(content), repeat)
+    profiled = timed(lambda: PdfTemplateManager(profiler=RenderProfiler()).render(content), repeat)
+    print(f"render():               {plain:8.2f} ms")
+    print(f"render() with profiler: {profiled:8.2f} ms ({profiled / plain - 1:+.1%})")
+    profiler = RenderProfiler()
+    PdfTemplateManager(profiler=profiler).render(content)
+    report = profiler.report()
+    for block in sorted(report["blocks"], key=lambda block: block["wall_ms"], reverse=True)[:3]:
+        print(f"{block['type']} #{block['index']}: {block['wall_ms']:8.2f} ms, {block['multi_cell_calls']} multi_cell calls")
+    print(f"Output: {report['output']}")
+
+
+if __name__ == "__main__":
+    bench_constructor()
+    bench_output()
+    bench_table_estimation()
+    bench_table_rendering()
+    bench_text_wrapping()
+    bench_page_layers()
+    bench_combined_documents()
+    bench_streaming_output()
+    bench_result_cache()
+    bench_fragment_cache()
+    bench_state_tracking()
+    bench_layout()
+    bench_profiling()
@@ -0,0 +1,63 @@
+from fpdf import FPDF
+
+
+class LayoutRecorder:
+    """
+    Collects the bounding boxes of the content blocks, while `PdfTemplateManager.layout` lays out
+    the content without drawing it. Every block gets one box per page it covers.
+    The boxes are given in the unit of the document, measured from the top left corner of the page.
+    """
+    def __init__(self) -> None:
+        self.blocks = []
+
+    def start(self, item: dict) -> None:
+        """
+        Starts the next content block. All boxes added afterwards belong to it.
+        """
+        self.blocks.append({"type": item["type"], "boxes": {}})
+
+    def add(self, pdf: FPDF, x: float, y: float, w: float, h: float, page: int|None=None) -> None:
+        """
+        Extends the box of the current block on the given or current page by the given rectangle.
+        The footer of the pages is not part of any block.
+        """
+        if not self.blocks or pdf.in_footer:
+            return
+        x0, x1 = min(x, x + w), max(x, x + w)
+        y0, y1 = min(y, y + h), max(y, y + h)
+        page = pdf.page if page is None else page
+        boxes = self.blocks[-1]["boxes"]
+        box = boxes.get(page)
+        if box is None:
+            boxes[page] = [x0, y0, x1, y1]
+        else:
+            boxes[page] = [min(box[0], x0), min(box[1], y0), max(box[2], x1), max(box[3], y1)]
+
+    def add_span(self, pdf: FPDF, page: int, x: float, y: float, w: float) -> None:
+        """
+        Extends the boxes of the current block by the area between the given position and the cursor,
+        e.g. after a text laid out by `multi_cell`. Pages in between are covered up to their page break trigger.
+        """
+        while page < pdf.page:
+            self.add(pdf, x, y, w, pdf.page_break_trigger - y, page)
+            page, y = page + 1, pdf.t_margin
+        self.add(pdf, x, y, w, pdf.y - y)
+
+    def result(self, pdf: FPDF) -> dict:
+        """
+        Returns the size of every page as (w, h) and the boxes of every block as (page, x, y, w, h).
+        """
+        return {
+            "pages": [
+                # The dimensions are stored in points, rounded to two decimals
+                tuple(round(dimension / pdf.k, 2) for dimension in page.dimensions())
+                for _, page in sorted(pdf.pages.items())
+            ],
+            "blocks": [
+                {
+                    "type": block["type"],
+                    "boxes": [(page, x0, y0, x1 - x0, y1 - y0) for page, (x0, y0, x1, y1) in sorted(block["boxes"].items())],
+                }
+                for block in self.blocks
+            ],
+        }
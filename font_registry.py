@@ -0,0 +1,329 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import weakref
+from collections import defaultdict
+from copy import copy
+from pathlib import Path
+
+from fontTools import ttLib
+from fpdf import FPDF
+from fpdf.enums import TextEmphasis
+from fpdf.fonts import SubsetMap, TTFFont
+
+
+# The directory containing all fonts we ship with
+FONTS_DIR = Path(__file__).resolve().parent / "fonts"
+
+FONT_EXTENSIONS = (".ttf", ".otf")
+
+
+def cache_dir() -> Path:
+    """
+    Returns the directory for files cached across processes such as the font index.
+    It is given by the environment variable PYOFFICE_CACHE_DIR and defaults to `pyoffice`
+    within the user's cache directory ($XDG_CACHE_HOME or ~/.cache).
+    """
+    directory = os.environ.get("PYOFFICE_CACHE_DIR")
+    if directory:
+        return Path(directory)
+    return Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "pyoffice"
+
+
+class FontIndex:
+    """
+    Index of all font files within the fonts directory (including `static/` and variable fonts).
+    Family, weight and style are read from the name and OS/2 tables of each font once and
+    stored in a compact index file, so later processes can resolve a font without opening
+    every font file. The index file is kept in the cache directory (see `cache_dir`) by default,
+    so the fonts directory of the package is never written to.
+    """
+    def __init__(self, directory: str|Path=FONTS_DIR, index_file: str|Path|None=None) -> None:
+        self.directory = Path(directory).resolve()
+        if index_file is None:
+            # One index per fonts directory
+            name = hashlib.sha1(str(self.directory).encode()).hexdigest()[:16]
+            index_file = cache_dir() / f"font-index-{name}.json"
+        self.index_file = Path(index_file)
+        self._fonts = None
+        self._signature = None
+        self._lock = threading.Lock()
+
+    def _scan(self) -> list:
+        """
+        Returns the relative paths, sizes and modification times of all font files.
+        """
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.lower().endswith(FONT_EXTENSIONS):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    files.append((os.path.relpath(path, self.directory), stat.st_size, stat.st_mtime_ns))
+        return sorted(files)
+
+    @staticmethod
+    def _read_font(path: str) -> tuple:
+        """
+        Reads the family, weight and style of a font from its tables.
+        Returns a tuple (family, weight, italic, min weight, max weight), where the
+        weight range is only wider than a single value for variable fonts.
+        """
+        ttfont = ttLib.TTFont(path, lazy=True)
+        names = ttfont["name"]
+        # Prefer the typographic family (ID 16) over the legacy family name (ID 1)
+        family = names.getDebugName(16) or names.getDebugName(1)
+        weight = ttfont["OS/2"].usWeightClass
+        italic = bool(ttfont["OS/2"].fsSelection & 1)
+        min_weight = max_weight = weight
+        if "fvar" in ttfont:
+            for axis in ttfont["fvar"].axes:
+                if axis.axisTag == "wght":
+                    min_weight, max_weight = int(axis.minValue), int(axis.maxValue)
+        ttfont.close()
+        return family, weight, italic, min_weight, max_weight
+
+    def _build(self, files: list) -> list:
+        fonts = []
+        for relpath, _, _ in files:
+            fonts.append([relpath, *self._read_font(str(self.directory / relpath))])
+        return fonts
+
+    def load(self) -> list:
+        """
+        Loads the index from the index file. If the index file is missing or outdated,
+        the fonts directory is indexed again and the index file is updated.
+        Each entry is a list [path, family, weight, italic, min weight, max weight].
+        """
+        with self._lock:
+            if self._fonts is not None:
+                return self._fonts
+
+            files = self._scan()
+            signature = hashlib.sha1(json.dumps(files).encode()).hexdigest()
+            try:
+                with open(self.index_file) as f:
+                    index = json.load(f)
+                if index["signature"] != signature:
+                    index = None
+            except (OSError, ValueError, KeyError):
+                index = None
+
+            if index is None:
+                index = {"signature": signature, "fonts": self._build(files)}
+                try:
+                    self.index_file.parent.mkdir(parents=True, exist_ok=True)
+                    tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+                    with open(tmp_file, "w") as f:
+                        json.dump(index, f, separators=(",", ":"))
+                    os.replace(tmp_file, self.index_file)
+                except OSError:
+                    # Without a writable cache directory, the fonts are simply indexed in every process
+                    pass
+
+            self._fonts = index["fonts"]
+            self._signature = signature
+            return self._fonts
+
+    def signature(self) -> str:
+        """
+        Returns the hash of the paths, sizes and modification times of all font files
+        at the time the index was loaded. It changes whenever a font is added, removed or replaced.
+        """
+        self.load()
+        return self._signature
+
+    def families(self) -> list:
+        """
+        Returns the lowercase names of all indexed font families.
+        Families with optical sizes (e.g. "Inter 18pt") are also available by their base name.
+        """
+        families = set()
+        for _, family, *_ in self.load():
+            families.add(family.lower())
+            families.add(re.sub(r" \d+pt$", "", family.lower()))
+        return sorted(families)
+
+    def resolve(self, family: str, style: str="", weight: int|None=None) -> tuple|None:
+        """
+        Resolves the font file for the given family, style and weight.
+        Static fonts with the closest weight are preferred over variable fonts.
+        Returns a tuple (path, variations), where variations is only given for variable fonts,
+        or None if no font matches.
+        Args:
+            family (str): The name of the font family (case insensitive).
+            style (str): The style of the font. Contains "B" for bold and "I" for italic.
+            weight (int): Optional weight of the font, which overrides the bold flag of the style.
+        """
+        family, style = family.lower(), style.upper()
+        if weight is None:
+            weight = 700 if "B" in style else 400
+        italic = "I" in style
+
+        candidates = [font for font in self.load() if font[1].lower() == family and font[3] == italic]
+        statics = [font for font in candidates if font[4] == font[5]]
+        if not statics:
+            # Fall back to the smallest optical size, e.g. "Inter 18pt" for "Inter"
+            sized = [
+                font for font in self.load()
+                if re.fullmatch(re.escape(family) + r" (\d+)pt", font[1].lower()) and font[3] == italic
+            ]
+            sized.sort(key=lambda font: int(font[1].rsplit(" ", 1)[1][:-2]))
+            statics = [font for font in sized if font[1] == sized[0][1]] if sized else []
+
+        if statics:
+            font = min(statics, key=lambda font: (abs(font[2] - weight), -font[2]))
+            return str(self.directory / font[0]), None
+        for font in candidates:
+            if font[4] <= weight <= font[5]:
+                return str(self.directory / font[0]), {"wght": weight}
+        return None
+
+
+class FontRegistry:
+    """
+    Process-wide registry of parsed fonts.
+    Parsing a font file (cmap, glyph widths, font descriptor) is the most expensive part
+    of `FPDF.add_font`. The registry parses each file only once per process and attaches
+    lightweight copies to every new document, which share the parsed metrics and font tables.
+    Only the older versions of modified files are dropped from the registry.
+    """
+    def __init__(self) -> None:
+        self._fonts = {}
+        self._parsing = {}
+        # Font tables shared by the documents, which are only read while laying out texts
+        self._shared = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._fonts)
+
+    def parse(self, pdf: FPDF, fname: str) -> TTFFont:
+        """
+        Returns the parsed font for the given file. The font is only parsed, if the file
+        is not yet part of the registry or if it has been modified since.
+        Args:
+            pdf (FPDF): The document requesting the font.
+            fname (str): The path to the font file.
+        """
+        path = os.path.abspath(fname)
+        key = (path, os.stat(path).st_mtime_ns)
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is not None:
+                self.hits += 1
+                return font
+            # Each file is parsed by one thread, while other files are parsed concurrently
+            parsing = self._parsing.setdefault(key, threading.Lock())
+
+        with parsing:
+            try:
+                with self._lock:
+                    font = self._fonts.get(key)
+                    if font is not None:
+                        self.hits += 1
+                        return font
+                    self.misses += 1
+                font = TTFFont(pdf, Path(path), path, "")
+                with self._lock:
+                    # Older versions of a modified file are not used by new documents anymore
+                    for other in [other for other in self._fonts if other[0] == path]:
+                        del self._fonts[other]
+                    self._fonts[key] = font
+                    self._shared.add(font.ttfont)
+                return font
+            finally:
+                # Also if the file cannot be parsed, so the next attempt gets a new lock
+                with self._lock:
+                    self._parsing.pop(key, None)
+
+    def attach(self, pdf: FPDF, family: str, fname: str, style: str="", variations: dict|None=None) -> None:
+        """
+        Makes the font available for the given document. Works like `FPDF.add_font`,
+        but reuses the already parsed font whenever possible.
+        Args:
+            pdf (FPDF): The document we want to add the font to.
+            family (str): The name of the font family.
+            fname (str): The path to the font file.
+            style (str): The style of the font. Choose between "", "B", "I" or "BI".
+            variations (dict): Optional axes of a variable font, e.g. {"wght": 700}.
+        """
+        style = "".join(sorted(style.upper()))
+        fontkey = f"{family.lower()}{style}"
+        if fontkey in pdf.fonts:
+            return
+
+        if variations is not None:
+            # Variable fonts are instantiated within their tables, so we do not share them
+            pdf.add_font(family, style=style, fname=fname, variations=variations)
+            return
+
+        parsed = self.parse(pdf, fname)
+        if parsed.color_font is not None:
+            # Color fonts keep per document state in their glyphs, so we do not share them
+            pdf.add_font(family, style=style, fname=fname)
+            return
+
+        font = TTFFont.__new__(TTFFont)
+        for attr in TTFFont.__slots__:
+            if hasattr(parsed, attr):
+                setattr(font, attr, getattr(parsed, attr))
+        font.i = len(pdf.fonts) + 1
+        font.fontkey = fontkey
+        font.emphasis = TextEmphasis.coerce(style)
+        # The tables are only read while laying out texts, their parsed parts are shared. Only fpdf's own
+        # font embedding subsets them in place, so the document gets its own tables then (see `own_tables`).
+        font.ttfont = parsed.ttfont
+        # `output()` assigns object ids to the descriptor
+        font.desc = copy(parsed.desc)
+        font.cw = defaultdict(parsed.cw.default_factory, parsed.cw)
+        font.missing_glyphs = []
+        font.biggest_size_pt = 0
+        font.subset = SubsetMap(font)
+        pdf.fonts[fontkey] = font
+        if font.is_cff and font.is_cid_keyed:
+            pdf._set_min_pdf_version("1.6")
+
+    def is_shared(self, font) -> bool:
+        """
+        Returns True, if the font tables of a document's font are shared with other documents.
+        """
+        with self._lock:
+            return isinstance(font, TTFFont) and font.ttfont in self._shared
+
+    def own_tables(self, font) -> None:
+        """
+        Gives the font of a document its own (lazily loaded) font tables, if they are shared
+        with other documents. Required before the tables are modified, e.g. subset by `FPDF.output`.
+        """
+        if self.is_shared(font):
+            font.ttfont = ttLib.TTFont(
+                font.ttffile,
+                recalcTimestamp=False,
+                fontNumber=font.collection_font_number,
+                lazy=True,
+            )
+
+    def stats(self) -> dict:
+        """
+        Returns the number of cache hits and misses as well as the number of parsed fonts.
+        """
+        return {"hits": self.hits, "misses": self.misses, "fonts": len(self)}
+
+    def clear(self) -> None:
+        """
+        Removes all parsed fonts and resets the counters.
+        """
+        with self._lock:
+            self._fonts.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# Shared by all instances of the template manager within the current process
+font_index = FontIndex()
+font_registry = FontRegistry()
@@ -0,0 +1,245 @@
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+
+from fpdf import FPDF, FPDF_VERSION
+from fpdf.enums import PDFResourceType
+from fpdf.fonts import TTFFont
+
+from font_registry import font_index
+from state_tracker import reset_graphics_state
+
+
+# Font selections and string literals within the operators of a fragment
+TEXT_TOKEN = re.compile(rb"/F(\d+) ([\d.]+ Tf)|\(((?:\\.|[^\\()])*)\)", re.S)
+ESCAPED = re.compile(rb"\\(.)", re.S)
+UNESCAPED = {b"r": b"\r"}
+
+
+class Fragment:
+    """
+    Operators of a content block, which are replayed instead of laying out the block again.
+    The fonts are referenced by their keys and the characters by their glyphs, so a fragment
+    can be replayed in other documents, whose font ids and subsets differ.
+    """
+    def __init__(self, stream: bytes, y: float, end_x: float, end_y: float, fonts: dict) -> None:
+        """
+        Args:
+            stream (bytes): The operators of the block.
+            y (float): The vertical position the block was recorded at.
+            end_x (float): The horizontal position of the cursor after the block.
+            end_y (float): The vertical position of the cursor after the block.
+            fonts (dict): The fonts of the block by their id, as tuples (family, style, glyphs per character id).
+                The glyphs are None for core fonts.
+        """
+        self.stream = stream
+        self.y = y
+        self.end_x = end_x
+        self.end_y = end_y
+        self.fonts = fonts
+
+    @property
+    def height(self) -> float:
+        return self.end_y - self.y
+
+    def encode(self, pdf: FPDF) -> tuple:
+        """
+        Returns the operators with the font ids and character ids of the given document
+        and the ids of the used fonts.
+        """
+        fonts = {}
+        for i, (family, style, glyphs) in self.fonts.items():
+            font = pdf.fonts.get(f"{family}{style}")
+            if font is None:
+                # Registers the font without changing the current font of the document
+                pdf._push_local_stack()
+                try:
+                    pdf.set_font(family, style)
+                finally:
+                    pdf._pop_local_stack()
+                font = pdf.fonts[f"{family}{style}"]
+            codes = None
+            if glyphs is not None:
+                codes = {code: font.subset.pick_glyph(glyph) for code, glyph in glyphs.items()}
+            fonts[i] = (font, codes)
+
+        current = None
+        def replace(match: re.Match) -> bytes:
+            nonlocal current
+            if match.group(1) is not None:
+                current = fonts[int(match.group(1))]
+                return b"/F%d %s" % (current[0].i, match.group(2))
+            if current is None or current[1] is None:
+                return match.group(0)
+            font, codes = current
+            data = ESCAPED.sub(lambda m: UNESCAPED.get(m.group(1), m.group(1)), match.group(3))
+            text = "".join(chr(codes[int.from_bytes(data[i:i + 2], "big")]) for i in range(0, len(data), 2))
+            return f"({font.escape_text(text)})".encode("latin-1")
+        return TEXT_TOKEN.sub(replace, self.stream), [font.i for font, _ in fonts.values()]
+
+    def replay(self, pdf: FPDF, dy: float) -> None:
+        """
+        Draws the fragment on the current page of the document, moved vertically by the given offset,
+        and moves the cursor below it.
+        """
+        stream, font_ids = self.encode(pdf)
+        pdf._out(f"q 1 0 0 1 0 {-dy * pdf.k:.2f} cm" if dy else "q")
+        pdf._out(stream)
+        pdf._out("Q")
+        for i in font_ids:
+            pdf._resource_catalog.add(PDFResourceType.FONT, i, pdf.page)
+        pdf.set_xy(self.end_x, self.end_y + dy)
+
+
+def record_fragment(pdf: FPDF, draw) -> Fragment|None:
+    """
+    Draws a block on the current page and records its operators as fragment.
+    The block is drawn from an explicitly set graphics state and wrapped into `q`/`Q`. The recorded
+    operators are then replaced by the replayed fragment, so the content stream is the same byte for byte,
+    no matter whether the fragment is recorded or replayed (i.e. whether the cache is cold or warm).
+    Returns None, if the block cannot be replayed, e.g. because it breaks the page, contains links,
+    images or the total number of pages.
+    Args:
+        pdf (FPDF): The document to draw the block into.
+        draw (callable): Draws the block into the document.
+    """
+    if pdf.dry_run:
+        # Nothing is written during dry runs (see `PdfTemplateManager._disable_writing`)
+        draw()
+        return None
+    page, y = pdf.page, pdf.y
+    page_obj = pdf.pages[page]
+    substitutions, annotations = len(page_obj.get_text_substitutions()), len(page_obj.annots)
+    reset_graphics_state(pdf)
+    recording_start = len(page_obj.contents)
+    # Like `FPDF.local_context`, so page breaks within the block keep the stream balanced
+    pdf._out("q")
+    reset_graphics_state(pdf)
+    start = len(page_obj.contents)
+    state = pdf._push_local_stack()
+    state.current_font_is_set_on_page = False
+    pdf._out(state.draw_color.serialize().upper())
+    pdf._out(state.fill_color.serialize().lower())
+    pdf._out(f"{state.line_width * pdf.k:.2f} w")
+    try:
+        draw()
+    finally:
+        end = len(pdf.pages[pdf.page].contents)
+        pdf._out("Q")
+        pdf._pop_local_stack()
+    if (
+        pdf.page != page
+        or len(page_obj.get_text_substitutions()) != substitutions
+        or len(page_obj.annots) != annotations
+    ):
+        return None
+    # `_out` appends the line break, when the fragment is replayed
+    stream = bytes(page_obj.contents[start:end]).removesuffix(b"\n")
+
+    fonts_per_id = {font.i: font for font in pdf.fonts.values()}
+    fonts = {}
+    for resource_type, name in pdf._resource_catalog.scan_stream(stream.decode("latin-1")):
+        if resource_type != PDFResourceType.FONT:
+            return None
+        font = fonts_per_id[int(name)]
+        style = font.emphasis.style if font.emphasis is not None else ""
+        family = font.fontkey[:len(font.fontkey) - len(style)]
+        glyphs = None
+        if isinstance(font, TTFFont):
+            if font.color_font is not None:
+                return None
+            glyphs = {code: glyph for glyph, code in font.subset.items() if glyph is not None}
+        fonts[int(name)] = (family, style, glyphs)
+    fragment = Fragment(stream, y, pdf.x, pdf.y, fonts)
+    del page_obj.contents[recording_start:]
+    fragment.replay(pdf, 0)
+    return fragment
+
+
+class FragmentCache:
+    """
+    Bounded LRU cache of fragments (see `Fragment`), shared by the documents of the current process.
+    Repeated blocks such as the sender address, payment instructions or legal footnotes are laid out
+    once and replayed by later documents without wrapping their texts again.
+    The fragments are keyed by the block (or its explicit cache key), the formats, the page size,
+    the installed fonts and the version of fpdf, so they are invalidated when one of them changes.
+    """
+    def __init__(self, maxsize: int=256) -> None:
+        self.maxsize = maxsize
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._fragments)
+
+    def __deepcopy__(self, memo: dict) -> "FragmentCache":
+        # The cache is shared between documents, hence copies of a document share it as well
+        return self
+
+    def key(self, pdf: FPDF, item: dict) -> str|None:
+        """
+        Returns the key of a content block for the given document or None, if the block cannot be
+        cached (e.g. tables with rows from a generator).
+        Args:
+            pdf (FPDF): The document the block is rendered into.
+            item (dict): The content block. Its "cache" value is either True or an explicit key.
+        """
+        block = item["cache"] if isinstance(item["cache"], str) else {"type": item["type"], "args": item["args"]}
+        try:
+            data = json.dumps(
+                [block, pdf.formats.key, [pdf.w, pdf.h], font_index.signature(), FPDF_VERSION],
+                sort_keys=True,
+                separators=(",", ":"),
+                default=str,
+            )
+        except (TypeError, ValueError):
+            return None
+        if "<generator object" in data:
+            return None
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def get(self, key: str) -> Fragment|None:
+        """
+        Returns the cached fragment for the given key or None.
+        """
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._fragments.move_to_end(key)
+            return fragment
+
+    def put(self, key: str, fragment: Fragment) -> None:
+        """
+        Stores the fragment for the given key and evicts the least recently used fragments.
+        """
+        with self._lock:
+            self._fragments[key] = fragment
+            self._fragments.move_to_end(key)
+            while len(self._fragments) > self.maxsize:
+                self._fragments.popitem(last=False)
+
+    def stats(self) -> dict:
+        """
+        Returns the number of hits and misses and the number of cached fragments.
+        """
+        return {"hits": self.hits, "misses": self.misses, "fragments": len(self)}
+
+    def clear(self) -> None:
+        """
+        Removes all fragments and resets the counters.
+        """
+        with self._lock:
+            self._fragments.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# Shared by all instances of the template manager within the current process
+fragment_cache = FragmentCache()
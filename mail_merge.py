@@ -0,0 +1,146 @@
+import csv
+import io
+import json
+import os
+import time
+from collections import ChainMap
+from typing import Callable, Iterable, Iterator
+
+from pdf_template_manager import PdfTemplateManager
+from template_plan import TemplatePlan, compile_value
+
+
+# File extensions of the supported record files
+RECORD_FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+
+
+def read_records(source, format: str|None=None) -> Iterator:
+    """
+    Reads records incrementally from a CSV or JSONL file, so only one record is kept in memory at once.
+    Any other iterable of dicts is passed through as it is.
+    Args:
+        source: A path to a CSV or JSONL file, an opened text file or an iterable of dicts.
+        format (str): Either "csv" or "jsonl". Defaults to the extension of the path.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        if format is None:
+            format = RECORD_FORMATS.get(os.path.splitext(source)[1].lower())
+        if format is None:
+            raise ValueError(f"Unknown format of the records in '{source}', choose between 'csv' and 'jsonl'")
+        with open(source, newline="", encoding="utf-8") as f:
+            yield from read_records(f, format)
+        return
+
+    if format == "csv":
+        yield from csv.DictReader(source)
+    elif format == "jsonl":
+        for line in source:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        yield from source
+
+
+class MailMerge:
+    """
+    Renders one content template with field references (see `TemplatePlan`) for a stream of records.
+    Records are rendered as they are read, either into one document per record or into one
+    combined document. Both return a report including the throughput in documents per second.
+    Example:
+        merge = MailMerge(content)
+        report = merge.render_each(read_records("invoices.csv"), "invoices/{{number}}.pdf")
+    """
+    def __init__(self, content: list, formats: dict|None=None) -> None:
+        """
+        Args:
+            content (list): The content blocks with placeholders such as {{customer.name}}.
+            formats (dict): Optional formats overriding the default formats.
+        """
+        self.plan = TemplatePlan(content, formats)
+
+    @staticmethod
+    def _report(documents: int, errors: list, start: float) -> dict:
+        seconds = time.perf_counter() - start
+        return {
+            "documents": documents,
+            "errors": errors,
+            "seconds": seconds,
+            "documents_per_second": documents / seconds if seconds > 0 else 0,
+        }
+
+    @staticmethod
+    def _pattern(pattern: str|Callable) -> Callable:
+        """
+        Compiles a pattern with placeholders for the fields of a record and {{index}} into a function
+        of the record and its index.
+        """
+        if callable(pattern):
+            return pattern
+        binder = compile_value(pattern, set())
+        if binder is None:
+            return lambda *_: pattern
+        return lambda record, index: binder(ChainMap(record, {"index": index}))
+
+    def render_each(self, records: Iterable, destination: str|Callable) -> dict:
+        """
+        Renders one document per record. A failing record does not abort the remaining ones.
+        Returns a report with the number of documents, the errors as (index, message) tuples,
+        the duration in seconds and the documents per second.
+        Args:
+            records (iterable): The records, e.g. from `read_records`.
+            destination (str): The path of each document with placeholders for the fields of the record
+                and {{index}} for the number of the record, or a function returning the path for a
+                record and its index.
+        """
+        path = self._pattern(destination)
+        start = time.perf_counter()
+        documents, errors = 0, []
+        for index, record in enumerate(records):
+            try:
+                self.plan.render(record, path(record, index))
+                documents += 1
+            except Exception as e:
+                errors.append((index, f"{type(e).__name__}: {e}"))
+        return self._report(documents, errors, start)
+
+    def render_combined(self, records: Iterable, destination="", title: str|Callable|None=None) -> tuple:
+        """
+        Renders all records into one file, each record as a logical document starting on a new page
+        with its own page numbering (see `PdfTemplateManager.start_document`). The pages are streamed
+        to the destination as they are completed (see `PdfTemplateManager.stream_to`), so the memory
+        does not grow with the number of records. A failing record does not abort the remaining ones:
+        records missing a field are skipped before anything is drawn (see `TemplatePlan.bind`).
+        Each record is laid out only once, so records failing while they are laid out (e.g. because of
+        an invalid table) remain incomplete in the file. Both are reported as errors.
+        Returns a tuple (file, report), where file is None, if a destination is given.
+        The report contains the number of documents, the errors as (index, message) tuples,
+        the duration in seconds and the documents per second.
+        Args:
+            records (iterable): The records, e.g. from `read_records`.
+            destination (str): The path or binary file object the file is written to.
+            title (str): Optional title of the bookmark of each record with placeholders for the fields
+                of the record and {{index}}, or a function returning the title for a record and its index.
+        """
+        name = self._pattern(title) if title is not None else (lambda *_: None)
+        start = time.perf_counter()
+        # Without any records, the file consists of an empty page
+        pdf = PdfTemplateManager(compiled_formats=self.plan.formats)
+        file = io.BytesIO() if destination == "" else destination
+        pdf.stream_to(file)
+        documents, errors = 0, []
+        for index, record in enumerate(records):
+            try:
+                document_title = name(record, index)
+                bound = self.plan.bind(record)
+            except Exception as e:
+                errors.append((index, f"{type(e).__name__}: {e}"))
+                continue
+            pdf.start_document(document_title)
+            try:
+                self.plan.draw(pdf, bound)
+            except Exception as e:
+                errors.append((index, f"{type(e).__name__}: {e}"))
+                continue
+            documents += 1
+        pdf.output()
+        return (file.getvalue() if destination == "" else None), self._report(documents, errors, start)
@@ -0,0 +1,159 @@
+from fpdf import FPDF
+from fpdf.enums import PDFResourceType
+from fpdf.syntax import Name, PDFArray, PDFContentStream
+
+from state_tracker import reset_graphics_state
+from subset_cache import SubsetCachingOutputProducer
+
+
+# Form XObjects are placed by the same names (/I<index>) as the images, whose indices count up from 1.
+# The indices of the Form XObjects start far above, so they never collide with those of the images.
+FIRST_FORM_XOBJECT_INDEX = 100000
+
+
+class PageLayer:
+    """
+    Static content, which is identical on every page, e.g. fold marks, letterhead lines or footer chrome.
+    The content is recorded once per document and page size as a Form XObject and placed on every page
+    with a single `Do` operator, instead of drawing its operators again for every page.
+    The gain is bounded by the size of the layer, since the rest of each page (e.g. the footer) is still
+    laid out per page: for a letterhead line and fold marks on 500 pages (see `benchmarks.bench_page_layers`)
+    rendering is 1.2 to 1.7x faster and the file about 15% smaller. A layer of a single line hardly gains
+    anything, but still costs an extra object in the file.
+    Dynamic content such as the page number must not be part of a layer.
+    """
+    def __init__(self, content: list) -> None:
+        """
+        Args:
+            content (list): The content blocks of type "text" or "line" (see `PdfTemplateManager.render`).
+        """
+        self.content = content
+
+    def draw(self, pdf: FPDF) -> None:
+        """
+        Draws the content blocks of the layer at their absolute positions.
+        """
+        for item in self.content:
+            getattr(pdf, f"render_{item['type']}")(**item["args"])
+
+    def place(self, pdf: FPDF) -> None:
+        """
+        Places the layer on the current page of the document. The layer is recorded on its first use.
+        """
+        if pdf.dry_run:
+            # Nothing is written during dry runs (see `PdfTemplateManager._disable_writing`)
+            return
+        key = (id(self), pdf.w_pt, pdf.h_pt)
+        index = pdf.form_xobjects.get(key)
+        if index is None:
+            index = pdf.form_xobjects[key] = self.record(pdf)
+        pdf._out(f"q /I{index} Do Q")
+        pdf._resource_catalog.add(PDFResourceType.X_OBJECT, index, pdf.page)
+
+    def record(self, pdf: FPDF) -> int:
+        """
+        Records the layer as Form XObject of the document and returns its index.
+        """
+        return record_form_xobject(pdf, self.draw)
+
+
+def record_form_xobject(pdf: FPDF, draw) -> int:
+    """
+    Records the operators drawn by the given function on the current page as a Form XObject
+    and removes them from the page again. Returns the index of the XObject, which is placed
+    with the operator `/I<index> Do`.
+    The drawing starts from an explicitly set graphics state, so the XObject looks the same
+    no matter what the graphics state of the page is when it is placed. The state of the document
+    (cursor, colors, font, ...) is not changed by the recording.
+    Args:
+        pdf (FPDF): The document to record the XObject for.
+        draw (callable): Draws the content of the XObject, takes the document as argument.
+    """
+    reset_graphics_state(pdf)
+    contents = pdf.pages[pdf.page].contents
+    start = len(contents)
+    x, y = pdf.x, pdf.y
+    auto_page_break, b_margin = pdf.auto_page_break, pdf.b_margin
+    state = pdf._push_local_stack()
+    # The font is selected again, the colors and the line width are set explicitly
+    state.current_font_is_set_on_page = False
+    pdf._out(state.draw_color.serialize().upper())
+    pdf._out(state.fill_color.serialize().lower())
+    pdf._out(f"{state.line_width * pdf.k:.2f} w")
+    # The static content never triggers a page break
+    pdf.set_auto_page_break(False)
+    try:
+        draw(pdf)
+    finally:
+        stream = bytes(contents[start:])
+        del contents[start:]
+        pdf._pop_local_stack()
+        pdf.set_auto_page_break(auto_page_break, b_margin)
+        pdf.set_xy(x, y)
+
+    index, xobject = add_form_xobject(pdf, stream, (0, 0, round(pdf.w_pt, 2), round(pdf.h_pt, 2)))
+    xobject._page_layer_resources = pdf._resource_catalog.scan_stream(stream.decode("latin-1"))
+    return index
+
+
+def add_form_xobject(pdf: FPDF, stream: bytes, b_box: tuple) -> tuple:
+    """
+    Adds a Form XObject with the given content stream to the document.
+    Returns a tuple (index, xobject). The resources of the XObject are added by the output producer.
+    Args:
+        pdf (FPDF): The document to add the XObject to.
+        stream (bytes): The uncompressed content stream.
+        b_box (tuple): The bounding box of the XObject in points.
+    """
+    catalog = pdf._resource_catalog
+    # Other Form XObjects of fpdf (e.g. blend groups) get the indices after it as well
+    index = max(FIRST_FORM_XOBJECT_INDEX, catalog.next_xobject_index)
+    catalog.next_xobject_index = index + 1
+    xobject = PDFContentStream(contents=stream, compress=pdf.compress)
+    xobject.type = Name("XObject")
+    xobject.subtype = Name("Form")
+    xobject.b_box = PDFArray(b_box)
+    catalog.form_xobjects.append((index, xobject))
+    return index, xobject
+
+
+class PageLayerOutputProducer(SubsetCachingOutputProducer):
+    """
+    Output producer, which adds the resources (fonts, images and graphics states) used by
+    the page layers to their Form XObjects.
+    """
+    def _finalize_form_xobjects(
+        self,
+        img_objs_per_index,
+        gfxstate_objs_per_name,
+        pattern_objs_per_name,
+        shading_objs_per_name,
+        font_objs_per_index,
+    ):
+        super()._finalize_form_xobjects(
+            img_objs_per_index,
+            gfxstate_objs_per_name,
+            pattern_objs_per_name,
+            shading_objs_per_name,
+            font_objs_per_index,
+        )
+        for _, xobject in self.fpdf._resource_catalog.form_xobjects:
+            add_resources = getattr(xobject, "_add_resources", None)
+            if add_resources is not None:
+                # E.g. imported pages, which bring their own resources (see `PdfBackground`)
+                xobject.resources = add_resources(self)
+                continue
+            resources = getattr(xobject, "_page_layer_resources", None)
+            if resources is None:
+                continue
+            used = {resource_type: set() for resource_type in PDFResourceType}
+            for resource_type, resource in resources:
+                used[resource_type].add(resource)
+            # Sorted, so the resources do not depend on the iteration order of the sets
+            xobject.resources = self._add_resources_dict(
+                {int(i): font_objs_per_index[int(i)] for i in sorted(used[PDFResourceType.FONT], key=int)},
+                {int(i): img_objs_per_index[int(i)] for i in sorted(used[PDFResourceType.X_OBJECT], key=int)},
+                {name: gfxstate_objs_per_name[name] for name in sorted(used[PDFResourceType.EXT_G_STATE])},
+                {},
+                {name: pattern_objs_per_name[name] for name in sorted(used[PDFResourceType.PATTERN])},
+            )
@@ -0,0 +1,329 @@
+import os
+import re
+import threading
+import zlib
+
+from fpdf import FPDF
+from fpdf.syntax import PDFObject
+
+from page_layers import PageLayer, add_form_xobject
+
+
+OBJECT_HEADER = re.compile(rb"(\d+)\s+(\d+)\s+obj\b")
+REFERENCE = re.compile(rb"(\d+)\s+(\d+)\s+R\b")
+WHITESPACE = b" \t\r\n\f\0"
+DELIMITERS = b"()<>[]{}/%"
+
+
+def skip_whitespace(data: bytes, pos: int) -> int:
+    """
+    Returns the position of the next token, skipping whitespace and comments.
+    """
+    while pos < len(data):
+        if data[pos] in WHITESPACE:
+            pos += 1
+        elif data[pos:pos + 1] == b"%":
+            while pos < len(data) and data[pos] not in b"\r\n":
+                pos += 1
+        else:
+            break
+    return pos
+
+
+def read_value(data: bytes, pos: int) -> int:
+    """
+    Reads the PDF value (dictionary, array, string, name, number, reference, ...) starting
+    at the given position and returns the position after its end.
+    """
+    pos = skip_whitespace(data, pos)
+    if data.startswith(b"<<", pos):
+        pos += 2
+        while True:
+            pos = skip_whitespace(data, pos)
+            if data.startswith(b">>", pos):
+                return pos + 2
+            pos = read_value(data, pos)
+    if data.startswith(b"[", pos):
+        pos += 1
+        while True:
+            pos = skip_whitespace(data, pos)
+            if data.startswith(b"]", pos):
+                return pos + 1
+            pos = read_value(data, pos)
+    if data.startswith(b"(", pos):
+        depth = 0
+        while True:
+            char = data[pos:pos + 1]
+            if char == b"\\":
+                pos += 2
+                continue
+            if char == b"(":
+                depth += 1
+            elif char == b")":
+                depth -= 1
+                if depth == 0:
+                    return pos + 1
+            pos += 1
+    if data.startswith(b"<", pos):
+        return data.index(b">", pos) + 1
+    reference = REFERENCE.match(data, pos)
+    if reference is not None:
+        return reference.end()
+    end = pos + 1
+    while end < len(data) and data[end] not in WHITESPACE and data[end] not in DELIMITERS:
+        end += 1
+    return end
+
+
+def dict_get(dictionary: bytes, key: bytes) -> bytes|None:
+    """
+    Returns the raw value of a key of a PDF dictionary or None, if the key does not exist.
+    """
+    pos = skip_whitespace(dictionary, 0) + 2
+    while True:
+        pos = skip_whitespace(dictionary, pos)
+        if pos >= len(dictionary) or dictionary.startswith(b">>", pos):
+            return None
+        end = read_value(dictionary, pos)
+        name = dictionary[pos:end]
+        start = skip_whitespace(dictionary, end)
+        pos = read_value(dictionary, start)
+        if name == key:
+            return dictionary[start:pos]
+
+
+def array_items(array: bytes) -> list:
+    """
+    Returns the raw values of a PDF array.
+    """
+    items = []
+    pos = skip_whitespace(array, 0) + 1
+    while True:
+        pos = skip_whitespace(array, pos)
+        if pos >= len(array) or array.startswith(b"]", pos):
+            return items
+        end = read_value(array, pos)
+        items.append(array[pos:end])
+        pos = end
+
+
+class PdfFile:
+    """
+    Minimal reader of PDF files with classic cross-reference tables, such as the files written by fpdf.
+    Cross-reference streams, object streams and encrypted files are not supported.
+    """
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.offsets = {}
+        self.trailer = None
+        startxref = re.search(rb"startxref\s+(\d+)", data[-1024:])
+        if startxref is None:
+            raise ValueError("The file is not a PDF file")
+        self._read_xref(int(startxref.group(1)))
+        if dict_get(self.trailer, b"/Encrypt") is not None:
+            raise ValueError("Encrypted PDF files are not supported")
+
+    def _read_xref(self, pos: int) -> None:
+        while pos is not None:
+            if not self.data.startswith(b"xref", pos):
+                raise ValueError("PDF files with cross-reference streams are not supported")
+            pos = skip_whitespace(self.data, pos + 4)
+            while not self.data.startswith(b"trailer", pos):
+                first, count = self.data[pos:].split(maxsplit=2)[:2]
+                pos = self.data.index(b"\n", pos) + 1
+                for number in range(int(first), int(first) + int(count)):
+                    offset, _, kind = self.data[pos:pos + 20].split()
+                    # Entries of older sections of incrementally updated files do not override newer ones
+                    if kind == b"n":
+                        self.offsets.setdefault(number, int(offset))
+                    pos += 20
+                pos = skip_whitespace(self.data, pos)
+            start = skip_whitespace(self.data, pos + 7)
+            trailer = self.data[start:read_value(self.data, start)]
+            self.trailer = self.trailer or trailer
+            prev = dict_get(trailer, b"/Prev")
+            pos = int(prev) if prev is not None else None
+
+    def object(self, number: int) -> tuple:
+        """
+        Returns the object with the given number as tuple (value, stream), where stream is the raw
+        (still encoded) data of a stream object and None otherwise.
+        """
+        header = OBJECT_HEADER.match(self.data, skip_whitespace(self.data, self.offsets[number]))
+        if header is None or int(header.group(1)) != number:
+            raise ValueError(f"Invalid offset of object {number}")
+        start = skip_whitespace(self.data, header.end())
+        end = read_value(self.data, start)
+        value = self.data[start:end]
+        pos = skip_whitespace(self.data, end)
+        if not self.data.startswith(b"stream", pos):
+            return value, None
+        pos += 6
+        pos += 2 if self.data.startswith(b"\r\n", pos) else 1
+        length = int(self.resolve(dict_get(value, b"/Length")))
+        return value, self.data[pos:pos + length]
+
+    def resolve(self, value: bytes|None) -> bytes|None:
+        """
+        Returns the value of the referenced object, if the value is a reference.
+        """
+        if value is None:
+            return None
+        reference = REFERENCE.fullmatch(value.strip())
+        if reference is None:
+            return value
+        return self.object(int(reference.group(1)))[0]
+
+    def pages(self) -> list:
+        """
+        Returns the object numbers of all pages in their order.
+        """
+        root = self.resolve(dict_get(self.trailer, b"/Root"))
+        pages = []
+        nodes = [dict_get(root, b"/Pages")]
+        while nodes:
+            reference = nodes.pop(0)
+            node = self.resolve(reference)
+            kids = dict_get(node, b"/Kids")
+            if kids is None:
+                pages.append(int(REFERENCE.fullmatch(reference.strip()).group(1)))
+            else:
+                nodes = array_items(self.resolve(kids)) + nodes
+        return pages
+
+    def page_attribute(self, page: bytes, key: bytes) -> bytes|None:
+        """
+        Returns an attribute of a page, which may be inherited from its parents.
+        """
+        while page is not None:
+            value = dict_get(page, key)
+            if value is not None:
+                return self.resolve(value)
+            page = self.resolve(dict_get(page, b"/Parent"))
+        return None
+
+    def decode_stream(self, value: bytes, stream: bytes) -> bytes:
+        """
+        Returns the decoded data of a stream. Only the FlateDecode filter is supported.
+        """
+        filters = self.resolve(dict_get(value, b"/Filter"))
+        if filters is None:
+            return stream
+        names = array_items(filters) if filters.startswith(b"[") else [filters]
+        for name in names:
+            if name != b"/FlateDecode":
+                raise ValueError(f"The stream filter {name.decode()} is not supported")
+            stream = zlib.decompress(stream)
+        return stream
+
+    def import_page(self, index: int=0) -> "ImportedPage":
+        """
+        Imports the page with the given index (starting at 0).
+        """
+        page = self.object(self.pages()[index])[0]
+        # The contents are either a single stream or an array of streams
+        contents = dict_get(page, b"/Contents") or b"[]"
+        if not contents.startswith(b"[") and self.resolve(contents).startswith(b"["):
+            contents = self.resolve(contents)
+        references = array_items(contents) if contents.startswith(b"[") else [contents]
+        streams = []
+        for reference in references:
+            streams.append(self.decode_stream(*self.object(int(REFERENCE.fullmatch(reference.strip()).group(1)))))
+        resources = self.page_attribute(page, b"/Resources") or b"<<>>"
+        media_box = [float(item) for item in array_items(self.page_attribute(page, b"/MediaBox"))]
+        # All objects referenced by the resources (fonts, images, ...) are copied
+        objects = {}
+        pending = [resources]
+        while pending:
+            for reference in REFERENCE.finditer(pending.pop()):
+                number = int(reference.group(1))
+                if number not in objects:
+                    objects[number] = self.object(number)
+                    pending.append(objects[number][0])
+        return ImportedPage(b"\n".join(streams), resources, tuple(media_box), objects)
+
+
+class RawPdfObject(PDFObject):
+    """
+    Object copied from another PDF file, whose references have already been renumbered.
+    """
+    def __init__(self, value: bytes, stream: bytes|None) -> None:
+        super().__init__()
+        self.value = value
+        self.stream = stream
+
+    def serialize(self, obj_dict=None, _security_handler=None) -> str:
+        if self.stream is None:
+            return f"{self.id} 0 obj\n{self.value.decode('latin-1')}\nendobj"
+        return f"{self.id} 0 obj\n{self.value.decode('latin-1')}\nstream\n{self.stream.decode('latin-1')}\nendstream\nendobj"
+
+
+class ImportedPage:
+    """
+    Page of an existing PDF file: its decoded content stream, its resources and all objects
+    referenced by the resources.
+    """
+    def __init__(self, contents: bytes, resources: bytes, media_box: tuple, objects: dict) -> None:
+        self.contents = contents
+        self.resources = resources
+        self.media_box = media_box
+        self.objects = objects
+
+    def add_objects(self, producer) -> str:
+        """
+        Adds the referenced objects to the output of the producer and returns the resources
+        with the renumbered references. The objects are only added once per output document,
+        no matter how often the page is placed.
+        """
+        added = producer.__dict__.setdefault("_imported_pages", {})
+        if id(self) not in added:
+            numbers = {}
+            copies = []
+            for number, (value, stream) in sorted(self.objects.items()):
+                copies.append(RawPdfObject(value, stream))
+                numbers[number] = producer._add_pdf_obj(copies[-1], "images")
+            renumber = lambda value: REFERENCE.sub(lambda m: b"%d 0 R" % numbers[int(m.group(1))], value)
+            for copy in copies:
+                copy.value = renumber(copy.value)
+            added[id(self)] = renumber(self.resources).decode("latin-1")
+        return added[id(self)]
+
+
+# Imported pages shared by all instances of the template manager within the current process
+_imported_pages = {}
+_imported_pages_lock = threading.Lock()
+
+
+def import_page(fname: str, index: int=0) -> ImportedPage:
+    """
+    Imports a page of a PDF file. Each page is only read once per process and file modification time.
+    Args:
+        fname (str): The path to the PDF file.
+        index (int): The index of the page, starting at 0.
+    """
+    key = (os.path.realpath(fname), os.stat(fname).st_mtime_ns, index)
+    with _imported_pages_lock:
+        if key not in _imported_pages:
+            with open(fname, "rb") as f:
+                _imported_pages[key] = PdfFile(f.read()).import_page(index)
+        return _imported_pages[key]
+
+
+class PdfBackground(PageLayer):
+    """
+    Page of an existing PDF file (e.g. the corporate stationery), which is placed under every page.
+    The page is read once per process and added once per output document as Form XObject.
+    """
+    def __init__(self, fname: str, index: int=0) -> None:
+        """
+        Args:
+            fname (str): The path to the PDF file.
+            index (int): The index of the page, starting at 0.
+        """
+        super().__init__([])
+        self.page = import_page(fname, index)
+
+    def record(self, pdf: FPDF) -> int:
+        index, xobject = add_form_xobject(pdf, self.page.contents, self.page.media_box)
+        xobject._add_resources = self.page.add_objects
+        return index
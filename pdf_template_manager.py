@@ -1,11 +1,29 @@
+import json
 import os
-from datetime import datetime
-from typing import List
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from typing import Iterable
 
 from fpdf import FPDF, XPos, YPos
-from fpdf.enums import VAlign
+from fpdf.enums import Align, TextEmphasis, VAlign
+from fpdf.line_break import FORM_FEED
+from fpdf.table import DEFAULT_HEADINGS_STYLE
 
 from colors import TailwindColors
+from document_layout import LayoutRecorder
+from font_registry import font_index, font_registry
+from fragment_cache import Fragment, fragment_cache, record_fragment
+from page_layers import PageLayer, PageLayerOutputProducer
+from pdf_import import PdfBackground
+from render_profiler import RenderProfiler, profiling_producer
+from state_tracker import GraphicsStateTracker
+from streaming_output import PageStreamWriter, StreamingOutputProducer
+from subset_cache import SubsetCachingOutputProducer, subset_cache
+from table_layout import LayoutTable, StreamingTable
+from template_formats import CompiledFormats, merge
+from text_metrics import is_measurable, measure_text
 
 
 # Providing the default formats for our template manager
@@ -32,6 +50,10 @@ formats = {
             "style": "B"
         }
     },
+    "background": {
+        "file": None,   # path to a PDF file, e.g. our stationery "template.pdf"
+        "page": 0
+    },
     "fold_marks": [
         {
             "y": 99,
@@ -42,6 +64,20 @@ formats = {
     ]
 }
 
+# Creation date of deterministic documents, unless the environment pins another one (see `deterministic_date`)
+DETERMINISTIC_DATE = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+
+def deterministic_date() -> datetime:
+    """
+    Returns the creation date of deterministic documents. Like reproducible builds, the date
+    can be pinned by the environment variable SOURCE_DATE_EPOCH (seconds since 1970-01-01 UTC).
+    """
+    epoch = os.environ.get("SOURCE_DATE_EPOCH")
+    if epoch:
+        return datetime.fromtimestamp(int(epoch), timezone.utc)
+    return DETERMINISTIC_DATE
+
 
 class PdfTemplateManager(FPDF):
     """
@@ -49,12 +85,50 @@ class PdfTemplateManager(FPDF):
     Takes as input a template consisting of several basic building blocks and 
     outputs the corresponding pdf file.
     """
-    def __init__(self, orientation = "portrait", format = "A4"):
+    def __init__(
+            self,
+            orientation = "portrait",
+            format = "A4",
+            compiled_formats: dict|None=None,
+            deterministic: bool=False,
+            profiler: RenderProfiler|None=None,
+        ):
         super().__init__(orientation=orientation, format=format)
-        self.formats = formats
+        # Records the rendering of every block and the output (see `RenderProfiler`)
+        self.profiler = profiler
+        # Deterministic documents consist of the same bytes for the same content and formats,
+        # no matter when and where they are rendered. Their creation date is pinned and their
+        # identifier is the hash of their content (see `FPDF._default_file_id`).
+        self.deterministic = deterministic
+        if deterministic:
+            self.set_creation_date(deterministic_date())
+        # Already merged formats (see `compile_formats`) are used as they are
+        if compiled_formats is None:
+            compiled_formats = compile_formats()
+        elif not isinstance(compiled_formats, CompiledFormats):
+            compiled_formats = CompiledFormats(compiled_formats)
+        self.formats = compiled_formats
+        self.subset_cache = subset_cache
+        self.fragment_cache = fragment_cache
+        # Drops redundant color, line width and font operators (see `GraphicsStateTracker`)
+        self.graphics_state = GraphicsStateTracker()
+        self.page_layers = []
+        # Form XObjects of the page layers by their key and page size (see `PageLayer.place`)
+        self.form_xobjects = {}
+        # True while the content is laid out without being written (see `_disable_writing`)
+        self.dry_run = False
+        # First pages and titles of the logical documents (see `start_document`)
+        self.documents = []
+        self.document_start = 1
+        # Writes completed pages to the destination (see `stream_to`)
+        self.page_writer = None
+        self._footer_offset = None
+        # Collects the bounding boxes of the blocks instead of drawing them (see `layout`)
+        self.layout_recorder = None
         self.apply_formats()
-        self.load_fonts()
         self.set_typography()
+        if self.formats.background["file"] is not None:
+            self.set_background(self.formats.background["file"], self.formats.background["page"])
         self.add_page()
     
     @property
@@ -67,59 +141,133 @@ class PdfTemplateManager(FPDF):
     
     @property
     def marginX(self) -> int:
-        return self.formats["mx"]
+        return self.formats.mx
     
     @property
     def marginY(self) -> int:
-        return self.formats["my"]
+        return self.formats.my
     
     @property
     def paddingHeader(self) -> float:
-        return self.formats["ph"]
+        return self.formats.ph
     
     @property
     def paddingFooter(self) -> float:
-        return self.formats["pf"]
+        return self.formats.pf
     
     @property
     def line_height(self) -> float:
-        return self.font_size * self.formats["line_height"]
+        return self.font_size * self.formats.line_height
     
     @property
     def primary_main_color(self) -> tuple:
-        return self.formats["primary_color"]
+        return self.formats.primary_color
     
     @property
     def primary_contrast_text(self) -> tuple:
-        return self.formats["primary_contrast_color"]
+        return self.formats.primary_contrast_color
     
     @property
     def secondary_color(self) -> tuple:
-        return self.formats["secondary_color"]
+        return self.formats.secondary_color
     
     # ==== Overriding the built-in functions ====
     def header(self) -> None:
-        pass
+        for layer in self.page_layers:
+            layer.place(self)
 
     def footer(self) -> None:
-        if not self.formats["footer"]["show_page_number"]:
+        if self.dry_run:
+            # Page breaks of dry runs do not complete the current page, its footer is rendered later on
+            return
+        # The footer contains the total number of pages, so it is kept when the page is streamed
+        self.graphics_state.reset()
+        self._footer_offset = (self.page, len(self.pages[self.page].contents))
+        if not self.formats.footer["show_page_number"]:
             return
         
         y = self.HEIGHT - self.marginY
         self.set_y(y)
         self.render_text(
-            [f"Seite {self.page_no()} von {{nb}}"], 
+            [f"Seite {self.page_no() - self.document_start + 1} von {{nb}}"], 
             size=8, 
-            style=self.formats["footer"]["typography"]["style"], 
-            align=self.formats["footer"]["align"]
+            style=self.formats.footer["typography"]["style"], 
+            align=self.formats.footer["align"]
         )
         self.set_typography()
 
+    def _out(self, s: str|bytes) -> None:
+        self.graphics_state.out(self, s, super()._out)
+
+    def _beginpage(self, *args, **kwargs) -> None:
+        if self.profiler is not None and self.page > 0:
+            self.profiler.count("page_breaks")
+        if self.page_writer is not None and self.page > 0 and not self.dry_run:
+            self._write_page()
+        super()._beginpage(*args, **kwargs)
+
+    @contextmanager
+    def _disable_writing(self):
+        # Flags the dry run, so page layers, fragments and streamed pages are not written either
+        if self.dry_run:
+            yield
+            return
+        with super()._disable_writing():
+            self.dry_run = True
+            try:
+                yield
+            finally:
+                self.dry_run = False
+
+    def output(self, name: str="", **kwargs):
+        """
+        Outputs the document like `FPDF.output`, but embeds the font subsets from the `subset_cache`.
+        Streamed documents (see `stream_to`) are completed in their destination and the name is ignored.
+        """
+        kwargs.setdefault(
+            "output_producer_class",
+            PageLayerOutputProducer if self.page_writer is None else StreamingOutputProducer,
+        )
+        if not issubclass(kwargs["output_producer_class"], SubsetCachingOutputProducer):
+            # Other producers subset the font tables shared with other documents in place
+            for font in self.fonts.values():
+                font_registry.own_tables(font)
+        if self.profiler is None or self.buffer:
+            return self._output(name, **kwargs)
+        kwargs["output_producer_class"] = profiling_producer(kwargs["output_producer_class"])
+        with self.profiler.phase("output"):
+            return self._output(name, **kwargs)
+
+    def _output(self, name: str, **kwargs):
+        """
+        Completes the logical documents and the streamed pages and outputs the document (see `output`).
+        """
+        if self.buffer or (not self.documents and self.page_writer is None):
+            return super().output(name, **kwargs)
+
+        # The last footer is rendered here, so the total of the last document can be substituted
+        # and the last page can be streamed as well
+        self._render_footer()
+        if self.documents:
+            self._substitute_page_totals(self.page)
+        if self.page_writer is not None:
+            self._write_page()
+        self.footer = lambda: None
+        try:
+            output = super().output(name if self.page_writer is None else "", **kwargs)
+        finally:
+            del self.footer
+        if self.page_writer is None:
+            return output
+        self.page_writer.write(bytes(output))
+        self.page_writer.close()
+        return None
+
     # ==== Utility functions ==== #
     def set_meta_data(self, title: str="", author: str="", subject: str="", creator: str="") -> None:
         """
         Takes as argument the meta data of the document and sets them.
-        Sets automatically the current date as date for the document.
+        Sets automatically the current date as date for the document, unless the document is deterministic.
         Args:
             title (str): The title of the document.
             author (str): The name of the author.
@@ -131,62 +279,72 @@ class PdfTemplateManager(FPDF):
         self.set_author(author)
         self.set_subject(subject)
         self.set_creator(creator)
-        self.set_creation_date(datetime.now())
+        self.set_creation_date(deterministic_date() if self.deterministic else datetime.now())
 
-    def merge(self, source, destination):
+    @staticmethod
+    def merge(source, destination):
         """
         Merges two dictionaries with each other.
         Found here: https://stackoverflow.com/a/20666342/22250877
         """
-        for key, value in source.items():
-            if isinstance(value, dict):
-                # get node or create one
-                node = destination.setdefault(key, {})
-                self.merge(value, node)
-            else:
-                destination[key] = value
-        return destination
+        return merge(source, destination)
 
     def load_fonts(self) -> None:
         """
-        Simply loads all existing fonts we have installed.
-        For better performance, we simply have them hardcoded.
-        """
-        # Roboto
-        self.add_font("Roboto", fname=f"{os.getcwd()}/fonts/Roboto/Roboto-Regular.ttf")
-        self.add_font("Roboto", style="B", fname=f"{os.getcwd()}/fonts/Roboto/Roboto-Bold.ttf")
-        self.add_font("Roboto", style="I", fname=f"{os.getcwd()}/fonts/Roboto/Roboto-Italic.ttf")
-        # Poppins
-        self.add_font("Poppins", fname=f"{os.getcwd()}/fonts/Poppins/Poppins-Regular.ttf")
-        self.add_font("Poppins", style="B", fname=f"{os.getcwd()}/fonts/Poppins/Poppins-Bold.ttf")
-        self.add_font("Poppins", style="I", fname=f"{os.getcwd()}/fonts/Poppins/Poppins-Italic.ttf")
-        # # Inter
-        # self.add_font("Inter", fname=f"{os.getcwd()}/fonts/Roboto/Roboto-Regular.ttf")
-        # self.add_font("Inter", style="B", fname=f"{os.getcwd()}/fonts/Roboto/Roboto-Bold.ttf")
-        # self.add_font("Inter", style="I", fname=f"{os.getcwd()}/fonts/Roboto/Roboto-Italic.ttf")
-        # Montserrat
-        self.add_font("Montserrat", fname=f"{os.getcwd()}/fonts/Montserrat/static/Montserrat-Regular.ttf")
-        self.add_font("Montserrat", style="B", fname=f"{os.getcwd()}/fonts/Montserrat/static/Montserrat-Bold.ttf")
-        self.add_font("Montserrat", style="I", fname=f"{os.getcwd()}/fonts/Montserrat/static/Montserrat-Italic.ttf")
+        Loads all existing fonts we have installed at once.
+        Usually not required, since fonts are registered lazily on their first use (see `register_font`).
+        """
+        for family in font_index.families():
+            for style in ("", "B", "I", "BI"):
+                self.register_font(family, style)
+
+    def register_font(self, family: str, style: str="") -> None:
+        """
+        Registers the font for the given family and style, if it is one of our installed fonts
+        and it is not yet registered. The font file is looked up in the index of the `fonts` directory
+        (see `font_index`) and parsed only once per process (see `font_registry`).
+        Args:
+            family (str): The name of the font family.
+            style (str): The style of the font, e.g. "", "B", "I" or "BIU".
+        """
+        family = family.lower()
+        style = "".join(sorted(style.upper().replace("U", "").replace("S", "")))
+        if family + style in self.fonts:
+            return
+
+        font = font_index.resolve(family, style)
+        if font is None:
+            return
+        fname, variations = font
+        font_registry.attach(self, family, fname, style=style, variations=variations)
 
     def apply_formats(self, formats: dict|None=None) -> None:
         """
         This function applies the formats of the template. Either use the built-in formats or 
         take an optional argument for new formats and apply them.
         If the new `formats` does not contain all values, simply merge them with the existing
-        formats.
+        formats. The formats are compiled into new immutable formats (see `CompiledFormats`), so
+        neither the default formats nor the formats of other documents are changed.
         Args:
             formats (dict): A dictionary containing customized values for the formats.
-        
-        TODO: Testing this function!!!
         """
         if formats is not None:
-            self.formats = self.merge(dict(self.formats), formats)
+            self.formats = self.formats.merge(formats)
 
-        self.set_top_margin(self.marginY + self.paddingHeader)
+        self.set_top_margin(self.formats.top_margin)
         self.set_left_margin(self.marginX)
         self.set_right_margin(self.marginX)
-        self.set_auto_page_break(True, self.marginY + self.paddingFooter)
+        self.set_auto_page_break(True, self.formats.bottom_margin)
+
+    def set_font(self, family: str|None=None, style: str|TextEmphasis="", size: float=0) -> None:
+        """
+        Registers the font on its first use and selects it afterwards.
+        For more information checkout the documentation of `FPDF.set_font`.
+        """
+        if isinstance(style, TextEmphasis):
+            style = style.style
+        self.register_font(family or self.font_family, style)
+        super().set_font(family=family, style=style, size=size)
 
     def set_typography(self, family: str|None=None, style: str="", size: int|None=None, color: tuple|None=None) -> None:
         """
@@ -201,13 +359,13 @@ class PdfTemplateManager(FPDF):
             color (tuple): Color of the text.
         """
         if family is None:
-            family = self.formats["typography"]["family"]
+            family = self.formats.typography["family"]
 
         if size is None:
-            size = self.formats["typography"]["size"]
+            size = self.formats.typography["size"]
 
         if color is None:
-            color = self.formats["typography"]["color"]
+            color = self.formats.typography["color"]
         
         self.set_text_color(*color)
         self.set_font(family=family, style=style, size=size)
@@ -225,7 +383,111 @@ class PdfTemplateManager(FPDF):
             self.set_xy(self.l_margin, new_y)
         else:
             self.set_xy(self.l_margin, self.get_y() + self.line_height)
-    
+
+    def add_page_layer(self, content: list) -> PageLayer:
+        """
+        Adds static content, which is drawn on the current and every following page, such as
+        letterhead lines or footer chrome. The content is recorded once per document and
+        placed with a single operator per page (see `PageLayer`).
+        Args:
+            content (list): The content blocks of type "text" or "line" with absolute positions.
+        """
+        layer = PageLayer(content)
+        self.page_layers.append(layer)
+        if self.page > 0:
+            layer.place(self)
+        return layer
+
+    def stream_to(self, destination) -> PageStreamWriter:
+        """
+        Streams the document to the destination: each page is written as soon as it is completed
+        and `output` only writes the remaining objects (fonts, images, page tree, ...).
+        So the memory does not grow with the number of pages, which makes it possible to render
+        very large documents. The footers are kept until `output`, since they contain the total
+        number of pages. Encryption, signatures and tables of contents are not supported.
+        Args:
+            destination: The path or binary file object the document is written to.
+        """
+        self.page_writer = PageStreamWriter(destination, self.pdf_version)
+        return self.page_writer
+
+    def _write_page(self) -> None:
+        """
+        Writes the completed current page to the destination of the streamed document, except for its footer.
+        """
+        page, offset = self._footer_offset or (None, None)
+        self.page_writer.write_page(self, self.page, offset if page == self.page else None)
+
+    def start_document(self, title: str|None=None) -> None:
+        """
+        Starts a new logical document on a new page, e.g. the next invoice of a combined print file.
+        Each document restarts its page numbering, so the footer shows "Seite x von y" per document.
+        Fonts and images are shared by all documents and embedded only once.
+        The first document starts on the current page.
+        Args:
+            title (str): Optional title of the bookmark pointing to the first page of the document.
+        """
+        if self.documents:
+            self.add_page(label_style="D", label_start=1)
+            self._substitute_page_totals(self.page - 1)
+        else:
+            self.set_page_label(label_style="D", label_start=1)
+        self.document_start = self.page
+        self.documents.append((self.page, title))
+        if title is not None:
+            self.start_section(title)
+
+    def _substitute_page_totals(self, last: int) -> None:
+        """
+        Substitutes the total number of pages of the current document, which ends at the given page.
+        """
+        total = str(last - self.document_start + 1)
+        for page in range(self.document_start, last + 1):
+            substitutions = self.pages[page].get_text_substitutions()
+            for substitution in substitutions:
+                self.pages[page].contents = self.pages[page].contents.replace(
+                    substitution.get_placeholder_string().encode("latin-1"),
+                    substitution.render_text_substitution(total).encode("latin-1"),
+                )
+            # Otherwise fpdf substitutes the total of the entire file
+            substitutions.clear()
+
+    def set_background(self, fname: str, page: int=0) -> PdfBackground:
+        """
+        Places a page of an existing PDF file (e.g. our stationery) under the current and every following page.
+        The file is read once per process and its page is added once per document (see `PdfBackground`).
+        Args:
+            fname (str): The path to the PDF file.
+            page (int): The index of the page to import, starting at 0.
+        """
+        background = PdfBackground(fname, page)
+        # The background is placed before all other layers, so it is drawn beneath them
+        self.page_layers.insert(0, background)
+        if self.page > 0:
+            contents = self.pages[self.page].contents
+            end = len(contents)
+            background.place(self)
+            # The content already drawn on the current page is moved on top of the background
+            contents[:] = contents[end:] + contents[:end]
+        return background
+
+    def add_fold_marks(self) -> PageLayer:
+        """
+        Adds the fold marks of the `formats` as page layer, so they are drawn on every page.
+        """
+        return self.add_page_layer([
+            {
+                "type": "line",
+                "args": {
+                    "x1": mark["pl"],
+                    "x2": mark["pl"] + mark["length"],
+                    "y1": mark["y"],
+                    "color": mark["color"],
+                },
+            }
+            for mark in self.formats.fold_marks
+        ])
+
     # ==== Functions to render content blocks in the document ==== #
     def render_line(
             self, 
@@ -255,6 +517,10 @@ class PdfTemplateManager(FPDF):
         if color is None:
             color = TailwindColors.SLATE_900.value
 
+        if self.layout_recorder is not None:
+            self.layout_recorder.add(self, x1, y1, x2 - x1, y2 - y1)
+            return
+
         p_c, p_w = self.draw_color, self.line_width
         self.set_draw_color(color)
         self.set_line_width(line_width)
@@ -299,14 +565,55 @@ class PdfTemplateManager(FPDF):
         self.next_line(self.get_y() + pt)
         if one_line:
             ln = f" {separator} ".join(lines)
-            self.multi_cell(w=w, h=self.line_height, text=ln, new_x=XPos.LEFT, new_y=YPos.NEXT, align=align)
+            self.wrapped_cell(w=w, text=ln, align=align)
         else:
             for ln in lines:
-                self.multi_cell(w=w, h=self.line_height, text=ln, new_x=XPos.LEFT, new_y=YPos.NEXT, align=align)
+                self.wrapped_cell(w=w, text=ln, align=align)
         # self.render_next_line()
         self.next_line(self.get_y() + pb)
         self.set_typography()
     
+    def wrapped_cell(self, w: float, text: str, align: str="L") -> None:
+        """
+        Renders a text like `multi_cell` with the current line height and moves below it.
+        The line splits are taken from the wrap cache and each line is rendered as a single cell,
+        which results in the same output. Justified texts and texts with a trailing line break,
+        form feeds or features unknown to the text metrics still use `multi_cell`.
+        Args:
+            w (float): The width of the cell. If 0, the width extends to the right margin.
+            text (str): The text to render.
+            align (str): The alignment of the text.
+        """
+        if (
+            Align.coerce(align) == Align.J
+            or not self.is_ttf_font
+            or text.endswith("\n")
+            or FORM_FEED in text
+            or not is_measurable(self, text)
+        ):
+            page, x, y = self.page, self.x, self.y
+            self.multi_cell(w=w, h=self.line_height, text=text, new_x=XPos.LEFT, new_y=YPos.NEXT, align=align)
+            if self.layout_recorder is not None:
+                self.layout_recorder.add_span(self, page, x, y, w or self.w - self.r_margin - x)
+            return
+        if w == 0:
+            w = self.w - self.r_margin - self.x
+        lines, _ = measure_text(self, text, w, self.line_height)
+        if self.layout_recorder is not None:
+            # Moves like the cells below, without drawing them
+            for _ in lines:
+                self._perform_page_break_if_need_be(self.line_height)
+                self.layout_recorder.add(self, self.x, self.y, w, self.line_height)
+                self.y += self.line_height
+            return
+        for line in lines:
+            self.cell(w=w, h=self.line_height, text=line, new_x=XPos.LEFT, new_y=YPos.NEXT, align=align)
+
+    def multi_cell(self, *args, **kwargs):
+        if self.profiler is not None:
+            self.profiler.count("multi_cell_calls")
+        return super().multi_cell(*args, **kwargs)
+
     def render_cell(self, bg_color: tuple=(255,255,255), **kwargs: dict) -> None:
         """
         If given, applies customized settings for each cell such as typography, bg color or something else.
@@ -317,64 +624,56 @@ class PdfTemplateManager(FPDF):
         self.set_fill_color(bg_color)
         self.set_typography(**kwargs)
 
-    def __estimate_number_of_table_rows(self, items: List[tuple], col_widths: tuple=None) -> int:
+    def __create_table(self, table_class: type=LayoutTable, v_align=VAlign.T, **kwargs) -> LayoutTable:
+        if "line_height" not in kwargs:
+            kwargs["line_height"] = self.line_height
+        # The table checks the font of the headings before selecting it,
+        # so we have to register it beforehand
+        headings_style = kwargs.get("headings_style", DEFAULT_HEADINGS_STYLE)
+        if headings_style is not None and headings_style.emphasis is not None:
+            self.register_font(headings_style.family or self.font_family, headings_style.emphasis.style)
+        return table_class(self, v_align=v_align, **kwargs)
+
+    def __add_table_row(self, table: LayoutTable, row_index: int, data_row: tuple, cell_formats: dict) -> None:
+        row = table.row()
+        for cell_index, datum in enumerate(data_row):
+            key = f"{row_index}.{cell_index}"
+            if key in cell_formats:
+                args = cell_formats[key]
+                self.render_cell(**args)
+            row.cell(datum)
+            if key in cell_formats:
+                self.render_cell()
+
+    def build_table(self, table_items: list, v_align=VAlign.T, cell_formats: dict={}, **kwargs) -> LayoutTable:
         """
-        Based on given parameters, this function estimates the number of rows of our table.
-        The number of rows is the number, which is actually printed on the pdf document.
+        Creates a table with all items, without rendering it. The layout of the table is computed
+        once by `LayoutTable.layout` and shared by the page breaks and the drawing of the table.
         Args:
-            items (list): A nested list of table items, where the entire list represents all rows
+            table_items (list): A nested list of table items, where the entire list represents all rows
                 and each item inside the nested lists represents a single cell of the table.
-            col_widths (tuple): Optional tuple containing the splitting for each column of the table.
-        """
-        num_of_items = len(items)
-        if col_widths is None:
-            col_widths = (self.WIDTH - self.l_margin - self.r_margin) / num_of_items
-        # Using temporary values for the x and y to compute the actual number of lines later on
-        tmp_x, tmp_y = self.get_x(), self.get_y()
-        # Also holding a maximum y value
-        max_y = tmp_y
-        num_of_rows = 0
-        with self.offset_rendering() as dummy:
-            for row in items:
-                for index, col in enumerate(row):
-                    # Here, we iterate over each cell of the table and use the dummy to render them all
-                    # at the very beginning of the current line.
-                    # When some cell extends the current maximum (has more than one line), it updates the 
-                    # maximum. Otherwise, it does not.
-                    dummy.set_x(tmp_x)
-                    dummy.set_y(tmp_y)
-                    dummy.multi_cell(w=col_widths[index], text=col, h=self.line_height)
-
-                    if max_y < dummy.get_y():
-                        max_y = dummy.get_y()
-                # Add the estimated number of rows to the total number
-                num_of_rows += (max_y - tmp_y) / self.line_height
-                tmp_y = max_y
-        return int(round(num_of_rows))
-
-    def estimate_table_height(
-            self, 
-            table_items: list,
-            padding: tuple=(0,0,0,0), 
-            gutter_height: float=0, 
-            col_widths: tuple|None=None,
-            **kwargs: dict
-        ) -> float:
+            v_align (VAlign): The vertical alignment of the cells.
+            cell_formats (dict): Custom formats of single cells, keyed by "row.column".
+            kwargs (dict): Further arguments of the fpdf table.
+        """
+        table = self.__create_table(LayoutTable, v_align=v_align, **kwargs)
+        for row_index, data_row in enumerate(table_items):
+            self.__add_table_row(table, row_index, data_row, cell_formats)
+        return table
+
+    def estimate_table_height(self, table_items: list, **kwargs: dict) -> float:
         """
         This function calculates the height of a table.
         This function can be used to make sure, that some tables are renderd on the same page.
+        Returns the y value below the table, if it was rendered at the current position without page breaks.
         Args:
-            num_of_items (int): The number of table items.
-            padding (tuple): Optional value for padding of each cell. (Top, right, bottom, left).
-            gutter_height (float): Optional vertical space between rows.
-        """
-        num_of_lines = self.__estimate_number_of_table_rows(table_items, col_widths)
-        # Use the current y value as starting point and add the top and bottom padding
-        height = self.get_y()
-        height += num_of_lines * (self.line_height)
-        height += len(table_items) * (padding[0] + padding[2])
-        height += num_of_lines * gutter_height
-        return height
+            table_items (list): A nested list of table items (see `render_table`).
+            kwargs (dict): The same arguments as for `render_table` such as the padding,
+                the gutter height or the column widths.
+        """
+        for key in ("pt", "pb", "unbreakable", "line_color", "line_width"):
+            kwargs.pop(key, None)
+        return self.get_y() + self.build_table(table_items, **kwargs).layout().height
 
     def render_table(
             self, 
@@ -392,58 +691,182 @@ class PdfTemplateManager(FPDF):
         Leverages the built-in table function to create a customized table.
         For more information about the table in fpdf2, checkout the following documentation:
             https://py-pdf.github.io/fpdf2/Tables.html
+        The table items are either a list of rows or any other iterable of rows such as a generator.
+        Rows of other iterables are rendered as they arrive, keeping only one page of rows in memory.
         """
         self.next_line(self.get_y() + pt)
-        if "line_height" not in kwargs:
-            kwargs["line_height"] = self.line_height
-        kwargs["v_align"] = v_align
         prev_line_color, prev_line_width = self.draw_color, self.line_width
         self.set_draw_color(line_color)
         self.set_line_width(line_width)
-
-        # If the estimated table height extends the threshold for the printable area,
-        # we force here a new page
-        table_height = self.estimate_table_height(table_items, pt=pt, pb=pb, **kwargs)
-        if unbreakable and table_height >= self.HEIGHT - self.marginY - self.paddingFooter:
-            self.add_page()
-        
-        # Make the entire table unbreakable
-        with self.table(**kwargs) as table:
-            for row_index, data_row in enumerate(table_items):
-                row = table.row()
-                for cell_index, datum in enumerate(data_row):
-                    key = f"{row_index}.{cell_index}"
-                    if key in cell_formats:
-                        args = cell_formats[key]
-                        self.render_cell(**args)
-                    row.cell(datum)
-                    if key in cell_formats:
-                        self.render_cell()
+        if isinstance(table_items, (list, tuple)) or unbreakable:
+            table = self.build_table(table_items, v_align=v_align, cell_formats=cell_formats, **kwargs)
+            # If the table does not fit into the printable area of the current page,
+            # we force here a new page to keep the entire table on one page
+            if unbreakable and table.layout().page_breaks(self.get_y(), self.t_margin, self.page_break_trigger):
+                self.add_page()
+            table.render()
+        else:
+            # Rows from iterators (e.g. generators or database cursors) are rendered page by page
+            table = self.__create_table(StreamingTable, v_align=v_align, **kwargs)
+            table.render_rows(
+                table_items,
+                lambda row_index, data_row: self.__add_table_row(table, row_index, data_row, cell_formats),
+            )
 
         self.set_draw_color(prev_line_color)
         self.set_line_width(prev_line_width)
         self.next_line(self.get_y() + pb)
 
-    def render(self, content: dict, filename: str) -> None:
+    def render_block(self, item: dict) -> None:
+        """
+        Renders a single content block such as a text, a line or a table.
+        Args:
+            item (dict): The content block with its type ("type") and the arguments of its render function ("args").
+        """
+        type, args = item["type"], item["args"]
+        if type == "text":
+            self.render_text(**args)
+        elif type == "line":
+            self.render_line(**args)
+        elif type == "table":
+            self.render_table(**args)
+
+    def render_cached_block(self, item: dict) -> None:
+        """
+        Renders a content block, which is byte-identical across many documents (e.g. the sender address),
+        from the `fragment_cache`. The block is laid out once and later documents replay its operators
+        at the current position without wrapping its texts again (see `Fragment`).
+        Blocks, which do not fit on the current page anymore, are rendered as usual.
+        Args:
+            item (dict): The content block with the flag "cache" set to True or an explicit cache key.
+        """
+        # The layout records the boxes of the blocks, which replayed fragments do not know about
+        key = self.fragment_cache.key(self, item) if self.layout_recorder is None else None
+        if key is None:
+            self.render_block(item)
+            return
+        fragment = self.fragment_cache.get(key)
+        if fragment is None:
+            fragment = record_fragment(self, lambda: self.render_block(item))
+            if fragment is not None:
+                self.fragment_cache.put(key, fragment)
+            return
+        self.render_fragment(item, fragment)
+
+    def render_fragment(self, item: dict, fragment: Fragment) -> None:
+        """
+        Replays the recorded operators of a content block (see `record_fragment`) at the current position.
+        Blocks, which do not fit on the current page anymore, are rendered as usual.
+        Args:
+            item (dict): The content block.
+            fragment (Fragment): The fragment recorded for the block.
+        """
+        # Lines and texts with an absolute vertical position do not depend on the cursor
+        dy = 0 if item["type"] == "line" or item["args"].get("y") is not None else self.y - fragment.y
+        # Blocks may end below the trigger (e.g. the bottom border of a table), which was fine, where they were recorded
+        if dy > 0 and fragment.end_y + dy > self.page_break_trigger:
+            self.render_block(item)
+            return
+        fragment.replay(self, dy)
+
+    def render_content(self, content: list) -> None:
+        """
+        Lays out the content blocks such as texts, lines or tables without writing the document.
+        Blocks with the flag "cache" are replayed from the `fragment_cache` (see `render_cached_block`).
+        Args:
+            content (list): The content blocks to render into the document.
+        """
+        for index, item in enumerate(content):
+            if self.layout_recorder is not None:
+                self.layout_recorder.start(item)
+            with self.profiler.block(index, item) if self.profiler is not None else nullcontext():
+                if item.get("cache"):
+                    self.render_cached_block(item)
+                else:
+                    self.render_block(item)
+
+    def render(self, content: dict, filename: str="") -> bytearray|None:
         """
         Takes a content dictionary as input and applies on them the primitive building blocks
         such as texts, lines, images, boxes or tables.
+        Returns the document as bytes, if no filename is given.
         Args:
             content (dict): A dictionary containing the entire data to render into the document.
+            filename (str): The path or binary file object the document is written to.
         """
-        for item in content:
-            type, args = item["type"], item["args"]
-            if type == "text":
-                self.render_text(**args)
-                continue
-            elif type == "line":
-                self.render_line(**args)
-                continue
-            elif type == "table":
-                self.render_table(**args)
-                continue
-        
-        self.output(filename)
+        self.render_content(content)
+        return self.output(filename)
+
+    def layout(self, content: list) -> dict:
+        """
+        Lays out the content blocks like `render`, including page breaks, unbreakable tables and
+        blocks with absolute positions, but neither draws nor outputs the document, i.e. there is no
+        serialization, compression or font embedding. Used to find out the number of pages
+        (e.g. for the postage) and where each block lands before rendering the document.
+        The content is laid out in a dry run (see `_disable_writing`), which restores the pages and the position
+        afterwards, so the document can still be rendered. Blocks are laid out through `render_content`,
+        hence they are recorded by the profiler, if any.
+        Returns the size of every page and the bounding boxes of every block, one per page it covers,
+        in the unit of the document from the top left corner of the page:
+            {"pages": [(w, h), ...], "blocks": [{"type": "text", "boxes": [(page, x, y, w, h), ...]}, ...]}
+        Args:
+            content (list): The content blocks (see `render`).
+        """
+        self.layout_recorder = LayoutRecorder()
+        try:
+            with self._disable_writing():
+                self.render_content(content)
+                return self.layout_recorder.result(self)
+        finally:
+            self.layout_recorder = None
+
+    def render_documents(self, documents: Iterable, filename: str="") -> bytearray|None:
+        """
+        Renders many logical documents (e.g. the invoices of a print file) into a single file.
+        Each document starts on a new page with its own page numbering and a bookmark, while
+        fonts and images are embedded only once for all documents. This mostly reduces the size of the file,
+        the time is dominated by the layout of each document (see `benchmarks.bench_combined_documents`).
+        Returns the file as bytes, if no filename is given.
+        Args:
+            documents (iterable): The documents as dictionaries with the content blocks ("content")
+                and an optional title of the bookmark ("title").
+            filename (str): The path or binary file object the file is written to.
+        """
+        for document in documents:
+            self.start_document(document.get("title"))
+            self.render_content(document["content"])
+        return self.output(filename)
+
+
+# Compiled formats per distinct custom formats, shared by all documents within the current process.
+# The least recently used formats are evicted, so per-customer formats do not grow the cache without limit.
+COMPILED_FORMATS_MAXSIZE = 256
+_compiled_formats = OrderedDict()
+_compiled_formats_lock = threading.Lock()
+_default_formats = CompiledFormats(formats)
+
+
+def compile_formats(custom_formats: dict|None=None) -> CompiledFormats:
+    """
+    Merges custom formats into the default formats and compiles them (see `CompiledFormats`),
+    without modifying the defaults. Each distinct set of custom formats is only compiled once
+    per process, so the result is shared by all documents using the same formats.
+    Args:
+        custom_formats (dict): Formats overriding the default formats. If None, the defaults are returned.
+    """
+    if not custom_formats:
+        return _default_formats
+    key = json.dumps(custom_formats, sort_keys=True, default=str)
+    with _compiled_formats_lock:
+        compiled = _compiled_formats.get(key)
+        if compiled is None:
+            compiled = _default_formats.merge(custom_formats)
+            _compiled_formats[key] = compiled
+            while len(_compiled_formats) > COMPILED_FORMATS_MAXSIZE:
+                _compiled_formats.popitem(last=False)
+        else:
+            _compiled_formats.move_to_end(key)
+        return compiled
 
 if __name__ == "__main__":
     pdf = PdfTemplateManager()
@@ -0,0 +1,204 @@
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+# Values of the recorded blocks, which are only used for the trace events
+INTERNAL_KEYS = ("start", "thread")
+
+
+class RenderProfiler:
+    """
+    Optional instrumentation of a document (see `PdfTemplateManager`). Records for every content block
+    its type, wall time, CPU time of the rendering thread, the number of `multi_cell` calls and page breaks
+    and, if enabled, the allocated bytes measured by tracemalloc. The time of `output()` is broken down
+    into the phases of the output producer: the pages (page dictionaries, annotations and the compression
+    of their content streams), the fonts (subsetting, compression and descriptors) and the remaining objects
+    and file structure.
+    The results are available as report (see `report`) and as Chrome trace events (see `chrome_trace`),
+    which are opened in chrome://tracing or Perfetto.
+    tracemalloc is process-wide, hence the allocations of concurrently rendered documents are mixed up.
+    Example:
+        with RenderProfiler(trace_memory=True) as profiler:
+            PdfTemplateManager(profiler=profiler).render(content, "invoice.pdf")
+        profiler.write_chrome_trace("invoice.trace.json")
+    """
+    def __init__(self, trace_memory: bool=False) -> None:
+        """
+        Args:
+            trace_memory (bool): Measures the allocated bytes per block with tracemalloc.
+                Tracing is started, if it is not running yet, and stopped again by `close`.
+        """
+        self.trace_memory = trace_memory
+        self.started_tracing = trace_memory and not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        self.start = time.perf_counter_ns()
+        self.blocks = []
+        # Phases of the output as tuples (name, start, duration, thread), times in nanoseconds
+        self.phases = []
+        self._counters = None
+
+    def __enter__(self) -> "RenderProfiler":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __deepcopy__(self, memo: dict) -> None:
+        # Copies of a document (e.g. by `FPDF.offset_rendering`) must not record into the report
+        return None
+
+    def close(self) -> None:
+        """
+        Stops tracemalloc, if it was started by the profiler.
+        """
+        if self.started_tracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.started_tracing = False
+
+    def count(self, name: str) -> None:
+        """
+        Counts an event (e.g. "multi_cell_calls" or "page_breaks") for the current block, if any.
+        """
+        if self._counters is not None:
+            self._counters[name] += 1
+
+    @contextmanager
+    def block(self, index: int, item: dict):
+        """
+        Records the rendering of a content block.
+        Args:
+            index (int): The index of the block within the content.
+            item (dict): The content block.
+        """
+        counters = self._counters = {"multi_cell_calls": 0, "page_breaks": 0}
+        memory = self.trace_memory and tracemalloc.is_tracing()
+        if memory:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start, cpu_start = time.perf_counter_ns(), time.thread_time_ns()
+        try:
+            yield
+        finally:
+            end, cpu_end = time.perf_counter_ns(), time.thread_time_ns()
+            allocated = peak = None
+            if memory:
+                current, peak = tracemalloc.get_traced_memory()
+                allocated, peak = current - before, peak - before
+            self._counters = None
+            self.blocks.append({
+                "index": index,
+                "type": item["type"],
+                "cached": bool(item.get("cache")),
+                "start": start,
+                "thread": threading.get_ident(),
+                "wall_ms": (end - start) / 1e6,
+                "cpu_ms": (cpu_end - cpu_start) / 1e6,
+                **counters,
+                "allocated_bytes": allocated,
+                "peak_bytes": peak,
+            })
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Records a phase of the output, i.e. "output" as a whole, "pages" or "fonts" (see `ProfilingOutputProducer`).
+        """
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.phases.append((name, start, time.perf_counter_ns() - start, threading.get_ident()))
+
+    def report(self) -> dict:
+        """
+        Returns the recorded blocks in their order, the totals of all blocks and the breakdown of the output
+        in milliseconds. The other objects are the time of the output, which is neither spent on
+        the pages nor on the fonts.
+        """
+        blocks = [{key: value for key, value in block.items() if key not in INTERNAL_KEYS} for block in self.blocks]
+        phases = {"output": 0, "pages": 0, "fonts": 0}
+        for name, _, duration, _ in self.phases:
+            phases[name] += duration / 1e6
+        return {
+            "blocks": blocks,
+            "totals": {
+                "blocks": len(blocks),
+                **{
+                    key: sum(block[key] for block in blocks)
+                    for key in ("wall_ms", "cpu_ms", "multi_cell_calls", "page_breaks")
+                },
+            },
+            "output": {
+                "total_ms": phases["output"],
+                "pages_ms": phases["pages"],
+                "fonts_ms": phases["fonts"],
+                "other_ms": phases["output"] - phases["pages"] - phases["fonts"],
+            },
+        }
+
+    def chrome_trace(self) -> dict:
+        """
+        Returns the blocks and phases of the output as complete events of the Chrome trace-event format.
+        """
+        pid = os.getpid()
+        events = []
+        for block in self.blocks:
+            events.append({
+                "name": f"{block['type']} #{block['index']}",
+                "cat": "block",
+                "ph": "X",
+                "ts": (block["start"] - self.start) / 1e3,
+                "dur": block["wall_ms"] * 1e3,
+                "pid": pid,
+                "tid": block["thread"],
+                "args": {key: value for key, value in block.items() if key not in INTERNAL_KEYS},
+            })
+        for name, start, duration, thread in self.phases:
+            events.append({
+                "name": name,
+                "cat": "output",
+                "ph": "X",
+                "ts": (start - self.start) / 1e3,
+                "dur": duration / 1e3,
+                "pid": pid,
+                "tid": thread,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path: str) -> None:
+        """
+        Writes the Chrome trace events (see `chrome_trace`) as JSON file.
+        """
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+class ProfilingOutputProducer:
+    """
+    Mixin of the output producers, which records the phases of the output in the profiler of the document:
+    - "pages": `_add_pages`, i.e. the page dictionaries, their annotations and their content streams,
+      which are compressed, when they are created,
+    - "fonts": `_add_fonts`, i.e. the font subsets (from the `subset_cache` or subset by fpdf),
+      the compression of the font streams, the widths, ToUnicode maps and font descriptors.
+    """
+    def _add_fonts(self, *args, **kwargs):
+        with self.fpdf.profiler.phase("fonts"):
+            return super()._add_fonts(*args, **kwargs)
+
+    def _add_pages(self, *args, **kwargs):
+        with self.fpdf.profiler.phase("pages"):
+            return super()._add_pages(*args, **kwargs)
+
+
+@functools.cache
+def profiling_producer(producer_class: type) -> type:
+    """
+    Returns the output producer class extended by the `ProfilingOutputProducer`.
+    """
+    return type(f"Profiling{producer_class.__name__}", (ProfilingOutputProducer, producer_class), {})
@@ -0,0 +1,226 @@
+import dataclasses
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from enum import Enum
+
+from fpdf import FPDF_VERSION
+
+from batch import render_job
+from font_registry import font_index
+from pdf_template_manager import compile_formats
+
+
+# Changes of the rendering, which are not covered by the inputs of the key, require a new revision
+CACHE_REVISION = 1
+
+
+def canonical(value):
+    """
+    Converts values, which are not supported by JSON, into a canonical form for the cache key.
+    Raises TypeError for values without a canonical form, such as generators of table rows.
+    """
+    if isinstance(value, Enum):
+        return f"{type(value).__name__}.{value.name}"
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return {"__type__": type(value).__name__, **dataclasses.asdict(value)}
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f"{type(value).__name__} cannot be part of a cache key")
+
+
+class ResultCache:
+    """
+    Cache of rendered documents, which returns identical documents (reprints, previews followed
+    by sending, retries, ...) without rendering them again.
+    Documents are keyed by the hash of their content, the merged formats, the installed fonts
+    and the versions of fpdf and the cache. They are kept in an in-memory LRU limited by the
+    size of the documents and optionally in a directory on disk, which is limited by size as well
+    and shared between processes. The oldest documents are evicted first.
+    The stored documents are returned as they are, including their creation date.
+    Example:
+        cache = ResultCache(max_bytes=64 * 2**20, directory="cache/documents")
+        pdf = cache.render(content)
+    """
+    def __init__(self, max_bytes: int=64 * 2**20, directory: str|None=None, max_disk_bytes: int=1024 * 2**20) -> None:
+        """
+        Args:
+            max_bytes (int): The maximum total size of the documents kept in memory.
+            directory (str): Optional directory of the disk tier.
+            max_disk_bytes (int): The maximum total size of the documents kept in the directory.
+        """
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._documents = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def key(self, content: list, custom_formats: dict|None=None) -> str|None:
+        """
+        Returns the cache key of a document or None, if the content cannot be cached
+        (e.g. tables with rows from a generator).
+        Args:
+            content (list): The content blocks of the document (see `PdfTemplateManager.render`).
+            custom_formats (dict): Optional formats overriding the default formats.
+        """
+        formats = compile_formats(custom_formats)
+        background = formats["background"]["file"]
+        try:
+            data = json.dumps(
+                {
+                    "content": content,
+                    "formats": formats.key,
+                    # The background is imported from a file, which may be replaced
+                    "background": os.stat(background).st_mtime_ns if background is not None else None,
+                    "fonts": font_index.signature(),
+                    "version": [FPDF_VERSION, CACHE_REVISION],
+                },
+                sort_keys=True,
+                separators=(",", ":"),
+                default=canonical,
+            )
+        except (TypeError, ValueError):
+            return None
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.pdf")
+
+    def get(self, key: str) -> bytes|None:
+        """
+        Returns the document with the given key from memory or disk, or None if it is not cached.
+        """
+        with self._lock:
+            if key in self._documents:
+                self.hits += 1
+                self._documents.move_to_end(key)
+                return self._documents[key]
+
+        pdf = None
+        if self.directory is not None:
+            try:
+                with open(self._path(key), "rb") as f:
+                    pdf = f.read()
+                # The modification time is the last use of the document for the eviction
+                os.utime(self._path(key))
+            except OSError:
+                pdf = None
+
+        with self._lock:
+            if pdf is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._put_memory(key, pdf)
+        return pdf
+
+    def put(self, key: str, pdf: bytes) -> None:
+        """
+        Stores a document in memory and on disk.
+        """
+        self._put_memory(key, pdf)
+        if self.directory is not None:
+            tmp_file = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_file, "wb") as f:
+                f.write(pdf)
+            os.replace(tmp_file, self._path(key))
+            self._evict_disk()
+
+    def _put_memory(self, key: str, pdf: bytes) -> None:
+        # Documents exceeding the budget on their own are only stored on disk
+        if len(pdf) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._documents:
+                self._bytes -= len(self._documents[key])
+            self._documents[key] = pdf
+            self._documents.move_to_end(key)
+            self._bytes += len(pdf)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._documents.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def _evict_disk(self) -> None:
+        """
+        Removes the least recently used documents from the directory, until it fits into its size limit.
+        """
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pdf"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # Removed by another process in the meantime
+                    continue
+                files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, path in sorted(files):
+            if size <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= file_size
+            with self._lock:
+                self.disk_evictions += 1
+
+    def render(self, content: list, custom_formats: dict|None=None) -> bytes:
+        """
+        Returns the document for the given content and formats as bytes. Cached documents are
+        returned without creating a `PdfTemplateManager`, others are rendered and cached.
+        Args:
+            content (list): The content blocks of the document (see `PdfTemplateManager.render`).
+            custom_formats (dict): Optional formats overriding the default formats.
+        """
+        key = self.key(content, custom_formats)
+        if key is not None:
+            pdf = self.get(key)
+            if pdf is not None:
+                return pdf
+        pdf = render_job(content, custom_formats)
+        if key is not None:
+            self.put(key, pdf)
+        return pdf
+
+    def stats(self) -> dict:
+        """
+        Returns the number of hits (in memory and on disk), misses, evictions (from memory and disk),
+        cached documents and their size in memory.
+        """
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "disk_evictions": self.disk_evictions,
+            "documents": len(self),
+            "bytes": self._bytes,
+        }
+
+    def clear(self) -> None:
+        """
+        Removes all documents from memory and resets the counters. The disk tier is kept.
+        """
+        with self._lock:
+            self._documents.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.disk_evictions = 0
@@ -0,0 +1,163 @@
+import re
+from collections import Counter
+
+from fpdf import FPDF
+
+
+# Operators setting a single parameter of the graphics state, as written by fpdf
+STATE_OPERATORS = {
+    "RG": re.compile(r"[\d.]+ (?:[\d.]+ [\d.]+ RG|G|[\d.]+ [\d.]+ [\d.]+ K)"),
+    "rg": re.compile(r"[\d.]+ (?:[\d.]+ [\d.]+ rg|g|[\d.]+ [\d.]+ [\d.]+ k)"),
+    "w": re.compile(r"[\d.]+ w"),
+    "Tf": re.compile(r"BT /F\d+ [\d.]+ Tf ET"),
+}
+# The state operator by the last character of its output, so at most one pattern is matched per output
+# and most other operators (e.g. paths or texts) are skipped without matching any pattern
+STATE_SUFFIXES = {"G": "RG", "K": "RG", "g": "rg", "k": "rg", "w": "w", "T": "Tf"}
+
+# Operators within other output, which change a parameter of the graphics state as well
+CHANGING_OPERATORS = {
+    "RG": (" RG", " G", " K", " CS", " SC"),
+    "rg": (" rg", " g", " k", " cs", " sc"),
+    "w": (" w",),
+    "Tf": (" Tf",),
+}
+SAVE_RESTORE = re.compile(r"(?:^|\s)[qQ](?:\s|$)")
+
+
+class GraphicsStateTracker:
+    """
+    Tracks the effective graphics state of the current page, as written into its content stream,
+    and drops operators setting the stroke color (`RG`), the fill color (`rg`), the line width (`w`)
+    or the font (`Tf`), which do not change anything:
+    - operators setting the value, which is already in effect,
+    - operators overwritten by the next operator of the same kind, before anything is drawn.
+    Output, which is not understood, makes the affected values unknown, so nothing is dropped wrongly.
+    Code reading offsets within the content stream has to call `reset` beforehand (see `reset_graphics_state`).
+    """
+    def __init__(self) -> None:
+        self.suppressed = Counter()
+        self.page = None
+        self.contents = None
+        self.length = 0
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Forgets the graphics state, so the next operators are written in any case.
+        """
+        self.state = {}
+        self.stack = []
+        self.commit()
+
+    def commit(self) -> None:
+        """
+        Keeps the operators written so far, so they are not dropped by later operators anymore.
+        """
+        self.tail = []
+        self.tail_start = None
+
+    def out(self, pdf: FPDF, s: str|bytes, write) -> None:
+        """
+        Writes the output to the current page of the document, unless it is a redundant state operator.
+        Args:
+            pdf (FPDF): The document.
+            s (str): The output, i.e. one or more operators.
+            write (callable): Writes the output to the document (`FPDF._out`).
+        """
+        if not pdf.page:
+            write(s)
+            return
+        contents = pdf.pages[pdf.page].contents
+        if pdf.page != self.page or contents is not self.contents or len(contents) != self.length:
+            # Another page or the content stream has been changed without writing to it
+            self.page, self.contents = pdf.page, contents
+            self.reset()
+
+        kind = STATE_SUFFIXES.get(s[-1:]) if isinstance(s, str) else None
+        if kind is None or not STATE_OPERATORS[kind].fullmatch(s):
+            self._track(s)
+            write(s)
+            self.length = len(contents)
+            return
+
+        rewrite = False
+        for index, (name, _, previous) in enumerate(self.tail):
+            if name == kind:
+                # Overwritten before anything has been drawn with it
+                del self.tail[index]
+                self.state[kind] = previous
+                self.suppressed[kind] += 1
+                rewrite = True
+                break
+        if self.state.get(kind) == s:
+            self.suppressed[kind] += 1
+        else:
+            if self.tail_start is None:
+                self.tail_start = len(contents)
+            self.tail.append((kind, s, self.state.get(kind)))
+            self.state[kind] = s
+            if not rewrite:
+                write(s)
+        if rewrite:
+            contents[self.tail_start:] = b"".join(f"{line}\n".encode("latin-1") for _, line, _ in self.tail)
+        self.length = len(contents)
+        if not self.tail:
+            self.commit()
+
+    def _track(self, s: str|bytes) -> None:
+        """
+        Updates the graphics state for any other output.
+        """
+        self.commit()
+        if not isinstance(s, str):
+            self.reset()
+        elif s == "q":
+            self.stack.append(dict(self.state))
+        elif s == "Q":
+            self.state = self.stack.pop() if self.stack else {}
+        elif " gs" in s or SAVE_RESTORE.search(s):
+            if not self._is_enclosed(s):
+                self.reset()
+        else:
+            for kind, operators in CHANGING_OPERATORS.items():
+                if kind in self.state and any(operator in s for operator in operators):
+                    del self.state[kind]
+
+    @staticmethod
+    def _is_enclosed(s: str) -> bool:
+        """
+        Returns True, if the output is enclosed by a single pair of `q`/`Q` operators,
+        hence does not change the graphics state after it.
+        """
+        if not s.startswith("q ") or not s.endswith(" Q"):
+            return False
+        tokens = s.split()
+        if tokens.count("q") == 1 and tokens.count("Q") == 1:
+            # The common case, e.g. a single text line
+            return True
+        depth = 0
+        for index, token in enumerate(tokens):
+            if token == "q":
+                depth += 1
+            elif token == "Q":
+                depth -= 1
+                if depth == 0 and index < len(tokens) - 1:
+                    return False
+        return depth == 0
+
+    def stats(self) -> dict:
+        """
+        Returns the number of dropped operators in total and per operator.
+        """
+        return {"suppressed": sum(self.suppressed.values()), **{kind: self.suppressed[kind] for kind in STATE_OPERATORS}}
+
+
+def reset_graphics_state(pdf: FPDF) -> None:
+    """
+    Forgets the graphics state tracked for the document, if any. Required before reading offsets
+    within the content stream of the current page or recording self-contained operators.
+    """
+    tracker = getattr(pdf, "graphics_state", None)
+    if tracker is not None:
+        tracker.reset()
@@ -0,0 +1,175 @@
+import os
+
+from fpdf import FPDF
+from fpdf.errors import FPDFException
+from fpdf.output import PDFHeader, _dimensions_to_mediabox, pdf_dict
+from fpdf.syntax import Name, PDFArray, PDFContentStream, PDFObject
+
+from page_layers import PageLayerOutputProducer
+
+
+class StreamedObject(PDFObject):
+    """
+    Object, which has already been written to the destination. Only used to reference it.
+    """
+    def __init__(self, id: int) -> None:
+        super().__init__()
+        self.id = id
+
+
+class PageStreamWriter:
+    """
+    Writes the content streams of completed pages to the destination as soon as a page is closed,
+    so the memory does not grow with the number of pages. Only the offsets of the written objects
+    and the pages' remainders containing the total number of pages (see `write_page`) are kept
+    until the document is completed by the `StreamingOutputProducer`.
+    """
+    def __init__(self, destination, pdf_version: str="1.3") -> None:
+        """
+        Args:
+            destination: The path or binary file object the document is written to.
+                File objects do not need to be seekable.
+            pdf_version (str): The version written into the header of the file.
+        """
+        # Files opened by the writer are closed again by `close`
+        self.owns_file = isinstance(destination, (str, os.PathLike))
+        self.file = open(destination, "wb") if self.owns_file else destination
+        self.pdf_version = pdf_version
+        self.position = 0
+        # Offsets of the written objects by their ids and ids of the written content streams by page
+        self.offsets = {}
+        self.content_ids = {}
+        self.write(f"{PDFHeader(pdf_version).serialize()}\n".encode("latin-1"))
+
+    def __deepcopy__(self, memo: dict) -> None:
+        # Copies of a document (e.g. by `FPDF.offset_rendering`) must not write into the destination
+        return None
+
+    def write(self, data: bytes) -> None:
+        self.file.write(data)
+        self.position += len(data)
+
+    def close(self) -> None:
+        if self.owns_file:
+            self.file.close()
+
+    def write_object(self, pdf: FPDF, obj: PDFObject) -> int:
+        """
+        Writes an object with an id reserved in the resource catalog of the document and returns the id.
+        """
+        catalog = pdf._resource_catalog
+        catalog.last_reserved_object_id += 1
+        obj.id = catalog.last_reserved_object_id
+        self.offsets[obj.id] = self.position
+        self.write(f"{obj.serialize()}\n".encode("latin-1"))
+        return obj.id
+
+    def write_page(self, pdf: FPDF, page: int, split: int|None=None) -> None:
+        """
+        Writes the content stream of a completed page. The placeholders of the total number of pages
+        are substituted at the very end, hence the content from the given split offset onwards
+        (usually the footer) is kept as remainder of the page and written as a second content stream later on.
+        Args:
+            pdf (FPDF): The document.
+            page (int): The number of the completed page.
+            split (int): Offset in the content of the page, which starts at the boundary of an operator
+                and precedes all placeholders. If the offset is missing, pages with placeholders are kept.
+        """
+        page_obj = pdf.pages[page]
+        contents = page_obj.contents
+        if page_obj.get_text_substitutions():
+            placeholders = (
+                contents.find(substitution.get_placeholder_string().encode("latin-1"))
+                for substitution in page_obj.get_text_substitutions()
+            )
+            if split is None or min(placeholders) < split:
+                split = 0
+        else:
+            split = len(contents)
+        if split == 0:
+            return
+        self.content_ids[page] = self.write_object(pdf, PDFContentStream(contents=contents[:split], compress=pdf.compress))
+        page_obj.contents = contents[split:]
+
+
+class StreamedBuffer(bytearray):
+    """
+    Buffer of the remaining objects of a streamed document. Its length is the position in the
+    destination, so fpdf computes the offsets of the objects as they are in the file.
+    The header of the file is already written, hence it is dropped.
+    """
+    def __init__(self, position: int) -> None:
+        super().__init__()
+        self.position = position
+        self.header_written = False
+
+    def __iadd__(self, data):
+        if not self.header_written:
+            self.header_written = True
+            return self
+        return super().__iadd__(data)
+
+    def __len__(self) -> int:
+        return self.position + bytearray.__len__(self)
+
+    def __bool__(self) -> bool:
+        return bytearray.__len__(self) > 0
+
+
+class StreamedOffsets(dict):
+    """
+    Offsets of the objects of the document, including the objects written by the `PageStreamWriter`.
+    """
+    def __init__(self, written: dict) -> None:
+        super().__init__()
+        self.written = written
+
+    def __missing__(self, id: int) -> int:
+        return self.written[id]
+
+
+class StreamingOutputProducer(PageLayerOutputProducer):
+    """
+    Output producer, which completes a document, whose pages have been written by a `PageStreamWriter`.
+    It produces the remaining objects (pages, fonts, images, ...), the cross-reference table and the trailer.
+    """
+    def __init__(self, fpdf: FPDF) -> None:
+        super().__init__(fpdf)
+        self.writer = fpdf.page_writer
+        if fpdf._security_handler is not None or fpdf._sign_key or fpdf.toc_placeholder:
+            raise FPDFException("Encryption, signatures and tables of contents are not supported by streamed documents")
+        self.offsets = StreamedOffsets(self.writer.offsets)
+        self.buffer = StreamedBuffer(self.writer.position)
+
+    def _add_catalog(self):
+        catalog_obj = super()._add_catalog()
+        if self.fpdf.pdf_version > self.writer.pdf_version:
+            # The header has been written before the version was known
+            catalog_obj.version = Name(self.fpdf.pdf_version)
+        return catalog_obj
+
+    def _add_pages(self, _slice: slice=slice(0, None)) -> list:
+        fpdf = self.fpdf
+        page_objs = []
+        for page_obj in list(self._iter_pages_in_order())[_slice]:
+            if fpdf.pdf_version > "1.3" and fpdf.allow_images_transparency:
+                page_obj.group = pdf_dict(
+                    {"/Type": "/Group", "/S": "/Transparency", "/CS": "/DeviceRGB"},
+                    field_join=" ",
+                )
+            if page_obj.dimensions() != fpdf.default_page_dimensions:
+                page_obj.media_box = _dimensions_to_mediabox(page_obj.dimensions())
+            self._add_pdf_obj(page_obj, "pages")
+            page_objs.append(page_obj)
+
+            # The written content stream is followed by the remainder of the page, if any
+            streams = []
+            if page_obj.index() in self.writer.content_ids:
+                streams.append(StreamedObject(self.writer.content_ids[page_obj.index()]))
+            if page_obj.contents or not streams:
+                cs_obj = PDFContentStream(contents=page_obj.contents, compress=fpdf.compress)
+                self._add_pdf_obj(cs_obj, "pages")
+                streams.append(cs_obj)
+            page_obj.contents = streams[0] if len(streams) == 1 else PDFArray(streams)
+        return page_objs
+
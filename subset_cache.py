@@ -0,0 +1,355 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from fontTools import subset as ftsubset
+from fontTools import ttLib
+from fpdf import FPDF_VERSION
+from fpdf.fonts import TTFFont
+from fpdf.output import LOGGER, CIDSystemInfo, OutputProducer, PDFFont, PDFFontStream
+from fpdf.syntax import Name, PDFArray, PDFContentStream
+
+from font_registry import font_registry
+
+# Embedding the cached subsets follows `OutputProducer._add_fonts` of these versions of fpdf and relies
+# on its private helpers. With any other version, fpdf embeds the fonts by itself without the cache.
+CACHED_EMBEDDING_FPDF_VERSIONS = ("2.8.9",)
+try:
+    from fpdf.output import _build_cmap_blocks, _tt_font_widths
+except ImportError:
+    _build_cmap_blocks = _tt_font_widths = None
+CACHED_EMBEDDING = FPDF_VERSION in CACHED_EMBEDDING_FPDF_VERSIONS and _tt_font_widths is not None
+
+
+# A charset covering most of our business documents: ASCII, German letters and common symbols.
+# Use it for the fixed charset mode of the `SubsetCache`.
+DEFAULT_CHARSET = (
+    "".join(chr(c) for c in range(0x20, 0x7F))
+    + "ÄÖÜäöüß€•–—„“”‚‘’…°§²³µ·×÷«»"
+)
+
+# Same tables as dropped by fpdf when subsetting fonts
+DROP_TABLES = [
+    "FFTM", "GDEF", "GPOS", "GSUB", "MATH", "hdmx", "meta", "sbix",
+    "CBDT", "CBLC", "EBDT", "EBLC", "EBSC", "SVG ", "CPAL", "COLR",
+]
+
+
+def subset_font(fname: str, glyph_names: list) -> tuple:
+    """
+    Creates the subset of a font, which contains only the given glyphs.
+    Returns a tuple (font stream, glyph ids), where the glyph ids map the glyph names
+    to their ids in the subset.
+    Args:
+        fname (str): The path to the font file.
+        glyph_names (list): The names of the glyphs to keep.
+    """
+    ttfont = ttLib.TTFont(fname, recalcTimestamp=False, lazy=True)
+    options = ftsubset.Options(notdef_outline=True, recommended_glyphs=True)
+    options.drop_tables += DROP_TABLES
+    subsetter = ftsubset.Subsetter(options)
+    subsetter.populate(glyphs=glyph_names)
+    subsetter.subset(ttfont)
+    glyph_ids = {name: ttfont.getGlyphID(name) for name in glyph_names}
+    output = BytesIO()
+    ttfont.save(output)
+    ttfont.close()
+    return output.getvalue(), glyph_ids
+
+
+class SubsetCache:
+    """
+    Cache of font subsets shared between documents.
+    Subsets are keyed by the hash of the font file and the set of used glyphs. They are kept
+    in an in-memory LRU and optionally in a directory on disk, so they can be reused across
+    processes as well.
+    In the fixed charset mode, every document embeds the glyphs of the given charset, hence
+    all documents only using these glyphs share one precomputed subset.
+    The directory is bounded by `max_disk_bytes`, the least recently used subsets are removed from it.
+    """
+    def __init__(
+            self,
+            maxsize: int=128,
+            directory: str|None=None,
+            charset: str|None=None,
+            max_disk_bytes: int=64 * 1024 * 1024,
+        ) -> None:
+        self.maxsize = maxsize
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.charset = charset
+        self._subsets = OrderedDict()
+        self._file_hashes = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._subsets)
+
+    def __deepcopy__(self, memo: dict) -> "SubsetCache":
+        # The cache is shared between documents, hence copies of a document (e.g. by
+        # `FPDF.offset_rendering`) share it as well
+        return self
+
+    def file_hash(self, fname: str) -> str:
+        """
+        Returns the hash of a font file. The hash is computed once per file and modification time.
+        """
+        key = (str(fname), os.stat(fname).st_mtime_ns)
+        with self._lock:
+            file_hash = self._file_hashes.get(key)
+        if file_hash is None:
+            with open(fname, "rb") as f:
+                file_hash = hashlib.sha1(f.read()).hexdigest()
+            with self._lock:
+                self._file_hashes[key] = file_hash
+        return file_hash
+
+    def key(self, fname: str, glyph_names: list) -> str:
+        """
+        Returns the cache key for the subset of the given font file and glyphs.
+        """
+        glyphs = "\0".join(sorted(glyph_names))
+        return hashlib.sha1(f"{self.file_hash(fname)}\0{glyphs}".encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.subset")
+
+    def get(self, fname: str, glyph_names: list) -> tuple:
+        """
+        Returns the subset of the font for the given glyphs as a tuple (font stream, glyph ids).
+        The subset is looked up in memory and on disk first and only created if it is missing.
+        Args:
+            fname (str): The path to the font file.
+            glyph_names (list): The names of the glyphs to keep.
+        """
+        key = self.key(fname, glyph_names)
+        with self._lock:
+            if key in self._subsets:
+                self.hits += 1
+                self._subsets.move_to_end(key)
+                return self._subsets[key]
+
+        subset = None
+        if self.directory is not None:
+            try:
+                with open(self._path(key), "rb") as f:
+                    header, stream = f.read().split(b"\n", 1)
+                subset = stream, json.loads(header)
+                # The modification time orders the subsets on disk by their last use (see `_prune`)
+                os.utime(self._path(key))
+            except (OSError, ValueError):
+                subset = None
+
+        with self._lock:
+            if subset is not None:
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+
+        if subset is None:
+            subset = subset_font(fname, glyph_names)
+            if self.directory is not None:
+                tmp_file = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_file, "wb") as f:
+                    f.write(json.dumps(subset[1], separators=(",", ":")).encode() + b"\n" + subset[0])
+                os.replace(tmp_file, self._path(key))
+                self._prune()
+
+        with self._lock:
+            self._subsets[key] = subset
+            self._subsets.move_to_end(key)
+            while len(self._subsets) > self.maxsize:
+                self._subsets.popitem(last=False)
+        return subset
+
+    def _prune(self) -> None:
+        """
+        Removes the least recently used subsets from the directory, until it fits into `max_disk_bytes`.
+        """
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".subset"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, path in sorted(files):
+            if size <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Removed by another process in the meantime
+                pass
+            size -= file_size
+
+    def stats(self) -> dict:
+        """
+        Returns the number of hits (in memory and on disk), misses and cached subsets.
+        """
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "subsets": len(self)}
+
+    def clear(self) -> None:
+        """
+        Removes all subsets from memory and resets the counters. The disk tier is kept.
+        """
+        with self._lock:
+            self._subsets.clear()
+            self.hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+
+
+# Shared by all instances of the template manager within the current process
+subset_cache = SubsetCache()
+
+
+class SubsetCachingOutputProducer(OutputProducer):
+    """
+    Output producer, which embeds TrueType fonts from the `SubsetCache` of the document
+    instead of subsetting them again for every document.
+    Color fonts, CFF fonts and PDF/A documents are embedded by fpdf as usual, so are all fonts
+    with other versions of fpdf than the ones the embedding follows (see `CACHED_EMBEDDING_FPDF_VERSIONS`).
+    """
+    def _is_cacheable(self, font) -> bool:
+        return (
+            CACHED_EMBEDDING
+            and isinstance(font, TTFFont)
+            and font.color_font is None
+            and not font.is_cff
+            and not self.fpdf._compliance
+        )
+
+    def _add_fonts(self, image_objects_per_index, gfxstate_objs_per_name, pattern_objs_per_name):
+        catalog = self.fpdf._resource_catalog
+        fonts = catalog.font_registry
+        cache = getattr(self.fpdf, "subset_cache", subset_cache)
+        font_objs_per_index = {}
+        try:
+            # Keep the order of fpdf, so the object ids do not change
+            for fontkey, font in sorted(fonts.items(), key=lambda item: item[1].i):
+                if self._is_cacheable(font):
+                    font_objs_per_index[font.i] = self._add_cached_font(font, cache)
+                    continue
+                # fpdf subsets the font tables in place
+                font_registry.own_tables(font)
+                catalog.font_registry = {fontkey: font}
+                font_objs_per_index.update(
+                    super()._add_fonts(image_objects_per_index, gfxstate_objs_per_name, pattern_objs_per_name)
+                )
+        finally:
+            catalog.font_registry = fonts
+        return font_objs_per_index
+
+    def _add_cached_font(self, font: TTFFont, cache: SubsetCache) -> PDFFont:
+        """
+        Adds all objects of a TrueType font to the document, the same way fpdf does,
+        but takes the font stream from the cache.
+        """
+        fontname = f"MPDFAA+{font.name}"
+        if cache.charset is not None:
+            for char in cache.charset:
+                if ord(char) in font.cmap:
+                    font.subset.pick(ord(char))
+
+        glyph_names = font.subset.get_all_glyph_names()
+        if len(font.missing_glyphs) > 0:
+            msg = ", ".join(f"'{chr(x)}' ({chr(x).encode('unicode-escape').decode()})" for x in font.missing_glyphs[:10])
+            if len(font.missing_glyphs) > 10:
+                msg += f", ... (and {len(font.missing_glyphs) - 10} others)"
+            LOGGER.warning("Font %s is missing the following glyphs: %s", fontname, msg)
+
+        ttfontstream, glyph_ids = cache.get(font.ttffile, glyph_names)
+        code_to_glyph = {
+            char_id: glyph_ids[glyph.glyph_name]
+            for glyph, char_id in font.subset.items()
+            if glyph is not None
+        }
+
+        composite_font_obj = PDFFont(subtype="Type0", base_font=fontname, encoding="Identity-H")
+        self._add_pdf_obj(composite_font_obj, "fonts")
+        cid_font_obj = PDFFont(
+            subtype="CIDFontType2",
+            base_font=fontname,
+            d_w=font.desc.missing_width,
+            w=_tt_font_widths(font),
+        )
+        self._add_pdf_obj(cid_font_obj, "fonts")
+        composite_font_obj.descendant_fonts = PDFArray([cid_font_obj])
+
+        # The ToUnicode map allows searching the file and copying text from it
+        def format_code(unicode: int) -> str:
+            if unicode > 0xFFFF:
+                code_high = 0xD800 | (unicode - 0x10000) >> 10
+                code_low = 0xDC00 | (unicode & 0x3FF)
+                return f"{code_high:04X}{code_low:04X}"
+            return f"{unicode:04X}"
+
+        bfChar = []
+        for glyph, code_mapped in font.subset.items():
+            if glyph is None or not isinstance(glyph.unicode, tuple) or len(glyph.unicode) == 0:
+                continue
+            bfChar.append(f'<{code_mapped:04X}> <{"".join(format_code(code) for code in glyph.unicode)}>\n')
+
+        to_unicode_obj = PDFContentStream(
+            (
+                "/CIDInit /ProcSet findresource begin\n"
+                "12 dict begin\n"
+                "begincmap\n"
+                "/CIDSystemInfo\n"
+                "<</Registry (Adobe)\n"
+                "/Ordering (UCS)\n"
+                "/Supplement 0\n"
+                ">> def\n"
+                "/CMapName /Adobe-Identity-UCS def\n"
+                "/CMapType 2 def\n"
+                "1 begincodespacerange\n"
+                "<0000> <FFFF>\n"
+                "endcodespacerange\n"
+                f"{_build_cmap_blocks(bfChar, 'bfchar')}"
+                "endcmap\n"
+                "CMapName currentdict /CMap defineresource pop\n"
+                "end\n"
+                "end"
+            ).encode("latin-1")
+        )
+        self._add_pdf_obj(to_unicode_obj, "fonts")
+        composite_font_obj.to_unicode = to_unicode_obj
+
+        cid_system_info_obj = CIDSystemInfo()
+        self._add_pdf_obj(cid_system_info_obj, "fonts")
+        cid_font_obj.c_i_d_system_info = cid_system_info_obj
+
+        font_descriptor_obj = font.desc
+        font_descriptor_obj.font_name = Name(fontname)
+        self._add_pdf_obj(font_descriptor_obj, "fonts")
+        cid_font_obj.font_descriptor = font_descriptor_obj
+
+        # The CIDToGIDMap maps the character ids used in the content streams to the glyphs of the subset
+        cid_to_gid_map = bytearray(256 * 256 * 2)
+        for char_id, glyph_id in code_to_glyph.items():
+            cid_to_gid_map[char_id * 2] = glyph_id >> 8
+            cid_to_gid_map[char_id * 2 + 1] = glyph_id & 0xFF
+        cid_to_gid_map_obj = PDFContentStream(contents=bytes(cid_to_gid_map), compress=True)
+        self._add_pdf_obj(cid_to_gid_map_obj, "fonts")
+        cid_font_obj.c_i_d_to_g_i_d_map = cid_to_gid_map_obj
+
+        font_file_cs_obj = PDFFontStream(contents=ttfontstream)
+        self._add_pdf_obj(font_file_cs_obj, "fonts")
+        font_descriptor_obj.font_file2 = font_file_cs_obj
+
+        font.subset.pick.cache_clear()
+        font.subset.get_glyph.cache_clear()
+        if not font_registry.is_shared(font):
+            font.close()
+        return composite_font_obj
@@ -0,0 +1,410 @@
+from typing import Callable, Iterable
+
+from fpdf.enums import Align, TableHeadingsDisplay, WrapMode
+from fpdf.errors import FPDFException
+from fpdf.fonts import CORE_FONTS, FontFace
+from fpdf.table import Cell, RowLayoutInfo, Table
+from fpdf.util import NumberClass, Padding
+
+from text_metrics import is_measurable, wrap_text
+
+
+class TableLayout:
+    """
+    Layout of a table, which is computed once before the table is rendered.
+    Holds the row heights, the x positions of the columns and everything required to find
+    the page breaks of the table, so the unbreakable check, the page breaks and the drawing
+    of the table share the same measurement of each cell.
+    """
+    def __init__(
+            self,
+            rows: list,
+            l_margin: float,
+            x_positions: list,
+            gutter_height: float=0,
+            outer_margin: float=0,
+            num_heading_rows: int=0,
+            repeat_headings: bool=False,
+        ) -> None:
+        """
+        Args:
+            rows (list): The `RowLayoutInfo` of each row as computed by fpdf.
+            l_margin (float): The left margin of the document while rendering the table.
+            x_positions (list): The x positions of the columns.
+            gutter_height (float): The vertical space between rows.
+            outer_margin (float): The vertical space between the outer border and the rows.
+            num_heading_rows (int): The number of heading rows.
+            repeat_headings (bool): If True, the headings are repeated on top of every page.
+        """
+        self.rows = rows
+        self.l_margin = l_margin
+        self.x_positions = x_positions
+        self.gutter_height = gutter_height
+        self.outer_margin = outer_margin
+        self.num_heading_rows = num_heading_rows
+        self.repeat_headings = repeat_headings
+
+    @property
+    def heights(self) -> list:
+        return [row.height for row in self.rows]
+
+    @property
+    def height(self) -> float:
+        """
+        The height of the entire table without page breaks.
+        """
+        if not self.rows:
+            return self.outer_margin
+        return self.outer_margin + sum(self.heights) + (len(self.rows) - 1) * self.gutter_height
+
+    def headings_page_break_height(self) -> float:
+        """
+        The height, which has to fit on a page, so the headings are not left alone on it.
+        """
+        if len(self.rows) > self.num_heading_rows > 0:
+            return sum(row.pagebreak_height for row in self.rows[:self.num_heading_rows + 1])
+        return 0
+
+    def page_breaks(self, y: float, top: float, bottom: float) -> list:
+        """
+        Returns the indices of the rows, which start a new page, when the table is rendered at y.
+        Follows the page breaks of `Table.render`.
+        Args:
+            y (float): The y position of the table.
+            top (float): The y position of the first row on a new page.
+            bottom (float): The y position, which triggers a page break.
+        """
+        breaks = []
+        y += self.outer_margin
+        if y + self.headings_page_break_height() > bottom:
+            y = top
+            breaks.append(0)
+        for index, row in enumerate(self.rows):
+            if y + row.pagebreak_height > bottom:
+                y = top
+                if not breaks or breaks[-1] != index:
+                    breaks.append(index)
+                if self.repeat_headings and index >= self.num_heading_rows:
+                    y += self.outer_margin + sum(self.heights[:self.num_heading_rows])
+            if index > 0:
+                y += self.gutter_height
+            y += row.height
+        return breaks
+
+
+class LayoutTable(Table):
+    """
+    Table, which computes its layout once. The heights of text cells are measured with the
+    text metrics instead of dry runs of `multi_cell`. The layout is available before the
+    table is rendered and reused while drawing it.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._layout = None
+
+    def _check(self) -> None:
+        """
+        Applies the sanity checks of fpdf and computes the number of columns and the width of the table.
+        """
+        self._cols_count = max(row.cols_count for row in self.rows) if self.rows else 0
+        if self._width is None:
+            if self._col_widths and isinstance(self._col_widths, NumberClass):
+                self._width = self._cols_count * self._col_widths
+            else:
+                self._width = self._fpdf.epw
+        elif self._col_widths and isinstance(self._col_widths, NumberClass):
+            if self._cols_count * self._col_widths != self._width:
+                raise ValueError(
+                    f"Invalid value provided width={self._width} should be a multiple of col_widths={self._col_widths}"
+                )
+        if self._width > self._fpdf.epw:
+            raise ValueError(f"Invalid value provided width={self._width}: effective page width is {self._fpdf.epw}")
+        if self._table_align == Align.J:
+            raise ValueError("JUSTIFY is an invalid value for FPDF.table() 'align' parameter")
+        if self._num_heading_rows > 0:
+            if not self._headings_style:
+                raise ValueError(
+                    "headings_style must be provided to FPDF.table() if num_heading_rows>1 or first_row_as_headings=True"
+                )
+            emphasis = self._headings_style.emphasis
+            if emphasis is not None:
+                family = self._headings_style.family or self._fpdf.font_family
+                font_key = family.lower() + emphasis.style.replace("U", "")
+                if font_key not in CORE_FONTS and font_key not in self._fpdf.fonts:
+                    raise FPDFException(
+                        f"Using font '{family}' with emphasis '{emphasis.style}'"
+                        " in table headings require the corresponding font style"
+                        " to be added using add_font()"
+                    )
+
+    def _position(self) -> tuple:
+        """
+        Returns the left margin of the table and the x positions of its columns, same as in `Table.render`.
+        """
+        fpdf = self._fpdf
+        l_margin = fpdf.l_margin
+        if self._table_align == Align.C:
+            l_margin = (fpdf.w - float(self._width)) / 2
+        elif self._table_align == Align.R:
+            l_margin = fpdf.w - fpdf.r_margin - float(self._width)
+        elif fpdf.x != fpdf.l_margin:
+            l_margin = fpdf.x
+
+        xx = l_margin + self._outer_border_margin[0]
+        x_positions = [xx]
+        if self.rows:
+            for i in range(self._cols_count):
+                xx += self._get_col_width(0, i)
+                xx += self._gutter_width
+                x_positions.append(xx)
+        return l_margin, x_positions
+
+    def _create_layout(self, rows: list, l_margin: float, x_positions: list) -> TableLayout:
+        return TableLayout(
+            rows,
+            l_margin,
+            x_positions,
+            gutter_height=self._gutter_height,
+            outer_margin=self._outer_border_margin[1],
+            num_heading_rows=self._num_heading_rows,
+            repeat_headings=self._repeat_headings is TableHeadingsDisplay.ON_TOP_OF_EVERY_PAGE,
+        )
+
+    def layout(self) -> TableLayout:
+        """
+        Computes the layout of the table once and returns it.
+        """
+        if self._layout is None:
+            self._check()
+            self._layout = self._create_layout(list(self._compute_rows_info()), *self._position())
+        return self._layout
+
+    def _cell_style(self, i: int, j: int, cell) -> FontFace:
+        """
+        Returns the style of a cell, same as in `Table._render_table_cell`.
+        """
+        style = self._initial_style
+        if self._cell_fill_mode.should_fill_cell(i, j) and self._cell_fill_color:
+            style = style.replace(fill_color=self._cell_fill_color)
+        if i < self._num_heading_rows:
+            style = FontFace.combine(style, self._headings_style)
+        style = FontFace.combine(style, self.rows[i].style)
+        return FontFace.combine(style, cell.style)
+
+    def _render_table_cell(self, i, j, cell, row_height, cell_height_info=None, cell_x_positions=None, **kwargs):
+        # Text cells are measured by their glyph widths, anything else by a dry run of fpdf
+        if cell_height_info is not None or not cell.text or cell.img or self._markdown or self._wrapmode != WrapMode.WORD:
+            return super()._render_table_cell(i, j, cell, row_height, cell_height_info, cell_x_positions, **kwargs)
+
+        fpdf = self._fpdf
+        padding = Padding.new(cell.padding) if cell.padding else self._padding
+        with fpdf.use_font_face(self._cell_style(i, j, cell)):
+            text = fpdf.normalize_text(cell.text).replace("\r", "")
+            if not is_measurable(fpdf, text):
+                return super()._render_table_cell(i, j, cell, row_height, cell_height_info, cell_x_positions, **kwargs)
+            max_width = self._get_col_width(i, j, cell.colspan) - padding.right - padding.left
+            if not padding.left:
+                max_width -= fpdf.c_margin
+            if not padding.right:
+                max_width -= fpdf.c_margin
+            lines = wrap_text(fpdf, text, max_width)
+        return False, 0, len(lines) * row_height + padding.top + padding.bottom
+
+    def _start(self, layout: TableLayout) -> tuple:
+        """
+        Moves to the position of the table and returns the previous position and left margin.
+        """
+        fpdf = self._fpdf
+        prev = fpdf.x, fpdf.y, fpdf.l_margin
+        if self._table_align in (Align.C, Align.R) or fpdf.x != fpdf.l_margin:
+            fpdf.l_margin = layout.l_margin
+            fpdf.x = fpdf.l_margin
+        fpdf.y += layout.outer_margin
+        if layout.headings_page_break_height():
+            # Avoid having the heading rows alone on a page
+            fpdf._perform_page_break_if_need_be(layout.headings_page_break_height())
+        return prev
+
+    def _render_layout_row(self, i: int, row_info, layout: TableLayout, prev: tuple) -> None:
+        """
+        Renders a single row with the given layout and breaks the page before, if required.
+        """
+        fpdf = self._fpdf
+        pagebreak_height = row_info.pagebreak_height
+        page_break = fpdf._perform_page_break_if_need_be(pagebreak_height)
+        if page_break and fpdf.y + pagebreak_height > fpdf.page_break_trigger:
+            fpdf.x, fpdf.y, fpdf.l_margin = prev
+            raise ValueError(f"The row with index {i} is too high and cannot be rendered on a single page")
+        if page_break and layout.repeat_headings and i >= self._num_heading_rows:
+            fpdf.y += layout.outer_margin
+            for row_idx in range(self._num_heading_rows):
+                self._place_row(row_idx, layout.rows[row_idx], layout)
+        if i > 0:
+            fpdf.y += self._gutter_height
+        self._place_row(i, row_info, layout)
+
+    def _place_row(self, i: int, row_info, layout: TableLayout) -> None:
+        """
+        Draws a single row or only adds its bounding box, while the document is laid out (see `PdfTemplateManager.layout`).
+        """
+        fpdf = self._fpdf
+        recorder = getattr(fpdf, "layout_recorder", None)
+        if recorder is None:
+            self._render_table_row(i, row_info, cell_x_positions=layout.x_positions)
+            return
+        recorder.add(fpdf, layout.l_margin, fpdf.y, float(self._width), row_info.height)
+        fpdf.ln(row_info.height)
+
+    def _finish(self, prev: tuple) -> None:
+        self._fpdf.l_margin = prev[2]
+        self._fpdf.x = self._fpdf.l_margin
+
+    def render(self) -> None:
+        """
+        Renders the table based on its layout. Follows `Table.render` of fpdf.
+        """
+        layout = self.layout()
+        prev = self._start(layout)
+        for i, row_info in enumerate(layout.rows):
+            self._render_layout_row(i, row_info, layout, prev)
+        self._finish(prev)
+
+
+class RowWindow:
+    """
+    Rows of a streamed table. Only the heading rows and the rows of the current chunk are kept,
+    but all rows are still addressed by their index within the entire table.
+    """
+    def __init__(self, num_heading_rows: int) -> None:
+        self.num_heading_rows = num_heading_rows
+        self.headings = []
+        self.window = []
+        # The index of the first row within the window
+        self.offset = 0
+
+    def __len__(self) -> int:
+        return self.offset + len(self.window)
+
+    def __getitem__(self, index: int):
+        if index < len(self.headings):
+            return self.headings[index]
+        return self.window[index - self.offset]
+
+    def __iter__(self):
+        yield from self.headings
+        yield from self.window
+
+    def append(self, row) -> None:
+        if len(self) < self.num_heading_rows:
+            self.headings.append(row)
+            self.offset += 1
+        else:
+            self.window.append(row)
+
+    def drop(self, stop: int) -> None:
+        """
+        Removes all rows of the window before the given index.
+        """
+        del self.window[:stop - self.offset]
+        self.offset = max(self.offset, stop)
+
+
+class StreamingTable(LayoutTable):
+    """
+    Table, which adds its rows from an iterable and renders them as they arrive.
+    The rows are laid out and rendered in chunks of one page, so the memory is bounded
+    by the rows of one page instead of the entire table. The heading rows are repeated on every page.
+    The number of columns is determined by the first chunk and rows cannot span several rows.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.rows = RowWindow(self._num_heading_rows)
+
+    def _compute_chunk_info(self, start: int, stop: int) -> list:
+        """
+        Computes the `RowLayoutInfo` of the rows with the given indices, same as `Table._compute_rows_info`.
+        """
+        rows_info = []
+        with self._fpdf._disable_writing():
+            for i in range(start, stop):
+                row = self.rows[i]
+                spans, prior_spans = row.convert_spans({})
+                if spans or prior_spans:
+                    raise FPDFException("Rows of a streamed table cannot span several rows")
+                dictated_heights, img_heights, rendered_heights = [], [], {}
+                for j, cell in enumerate(row.cells):
+                    if not isinstance(cell, Cell):
+                        continue
+                    _, img_height, text_height = self._render_table_cell(i, j, cell, row_height=self._line_height)
+                    dictated_height = img_height if cell.img_fill_width else text_height
+                    rendered_heights[j] = dictated_height
+                    dictated_heights.append(dictated_height)
+                    img_heights.append(img_height)
+
+                min_height = 0
+                if dictated_heights:
+                    min_height = max(dictated_heights)
+                    if min_height == 0:
+                        min_height = max(img_heights)
+                if min_height == 0:
+                    min_height = self._line_height
+                if row.min_height:
+                    if min_height < row.min_height:
+                        min_height = row.min_height
+                elif self._min_row_height:
+                    if min_height < self._min_row_height:
+                        min_height = float(self._min_row_height)
+                row_height = float(min_height)
+                rows_info.append(RowLayoutInfo(row_height, row_height, rendered_heights, [0, row_height]))
+        return rows_info
+
+    def layout(self) -> TableLayout:
+        # The rows arrive while they are rendered, hence there is no layout of the entire table
+        raise TypeError("A streamed table has no layout of all its rows, it is rendered page by page by `render_rows`")
+
+    def render(self) -> None:
+        raise TypeError("A streamed table is rendered page by page by `render_rows`")
+
+    def render_rows(self, items: Iterable, add_row: Callable) -> None:
+        """
+        Adds the items as rows to the table and renders them page by page.
+        Args:
+            items (iterable): The rows of the table, e.g. a generator or a database cursor.
+            add_row (callable): Adds a single item as row to the table. Called with the index and the item.
+        """
+        fpdf = self._fpdf
+        # No more rows than these fit on a single page
+        chunk_size = self._num_heading_rows + int((fpdf.page_break_trigger - fpdf.t_margin) // self._line_height) + 1
+        items = enumerate(items)
+        exhausted = False
+        layout = headings = prev = None
+        start = 0
+        while True:
+            # The table always keeps one row ahead, so it knows whether a row is its last one
+            while not exhausted and len(self.rows) - start <= chunk_size:
+                try:
+                    add_row(*next(items))
+                except StopIteration:
+                    exhausted = True
+            stop = len(self.rows) if exhausted else len(self.rows) - 1
+
+            if layout is None:
+                self._check()
+                rows_info = self._compute_chunk_info(0, stop)
+                headings = rows_info[:self._num_heading_rows]
+                layout = self._create_layout(rows_info, *self._position())
+                prev = self._start(layout)
+                offset = 0
+            else:
+                rows_info = headings + self._compute_chunk_info(start, stop)
+                layout = self._create_layout(rows_info, layout.l_margin, layout.x_positions)
+                # The heading rows are followed by the rows of the chunk
+                offset = start - self._num_heading_rows
+
+            for i in range(start, stop):
+                self._render_layout_row(i, layout.rows[i - offset], layout, prev)
+            self.rows.drop(stop)
+            start = stop
+            if exhausted:
+                break
+        self._finish(prev)
@@ -0,0 +1,131 @@
+import json
+from collections.abc import Mapping
+from copy import deepcopy
+from types import MappingProxyType
+
+
+def merge(source: dict, destination: dict) -> dict:
+    """
+    Merges the source dictionary recursively into the destination dictionary,
+    the values of the source override the values of the destination.
+    """
+    for key, value in source.items():
+        if isinstance(value, dict):
+            merge(value, destination.setdefault(key, {}))
+        else:
+            destination[key] = value
+    return destination
+
+
+def freeze(value):
+    """
+    Converts dictionaries into read-only mappings and lists into tuples, recursively.
+    """
+    if isinstance(value, Mapping):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    """
+    Converts frozen values (see `freeze`) back into dictionaries and lists of dictionaries.
+    """
+    if isinstance(value, Mapping):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple) and any(isinstance(item, Mapping) for item in value):
+        return [thaw(item) for item in value]
+    return value
+
+
+# The formats, which are available as attributes of the compiled formats
+FORMAT_NAMES = (
+    "mx",
+    "my",
+    "pf",
+    "ph",
+    "line_height",
+    "primary_color",
+    "secondary_color",
+    "primary_contrast_color",
+    "typography",
+    "footer",
+    "background",
+    "fold_marks",
+)
+
+
+class CompiledFormats(Mapping):
+    """
+    Immutable formats of the template manager. The values are read as attributes (e.g. `formats.mx`)
+    by the hot properties of the template manager instead of dictionary lookups, derived values
+    such as the margins are computed once. Nested values are read-only mappings and tuples,
+    so a compiled formats object is shared by all documents and threads without copying it.
+    It still reads like the dictionary it was compiled from, e.g. `formats["typography"]["size"]`.
+    """
+    __slots__ = ("_values", "key", "top_margin", "bottom_margin") + FORMAT_NAMES
+
+    def __init__(self, values: Mapping) -> None:
+        """
+        Args:
+            values (dict): The complete formats, e.g. the default formats merged with custom ones.
+        """
+        values = thaw(values)
+        set = object.__setattr__
+        set(self, "_values", freeze(values))
+        # Canonical form of the formats, e.g. for the keys of caches
+        set(self, "key", json.dumps(values, sort_keys=True, separators=(",", ":"), default=str))
+        for name in FORMAT_NAMES:
+            set(self, name, self._values.get(name))
+        set(self, "top_margin", self.my + self.ph)
+        set(self, "bottom_margin", self.my + self.pf)
+
+    def __setattr__(self, name: str, value) -> None:
+        raise AttributeError("Compiled formats are immutable, use `merge` to derive new formats")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError("Compiled formats are immutable, use `merge` to derive new formats")
+
+    def __getitem__(self, key: str):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, CompiledFormats):
+            return self.key == other.key
+        return super().__eq__(other)
+
+    def __hash__(self) -> int:
+        return hash(self.key)
+
+    def __repr__(self) -> str:
+        return f"CompiledFormats({self.key})"
+
+    def __copy__(self) -> "CompiledFormats":
+        return self
+
+    def __deepcopy__(self, memo: dict) -> "CompiledFormats":
+        # Immutable, hence copies of a document (e.g. by `FPDF.offset_rendering`) share it
+        return self
+
+    def __reduce__(self) -> tuple:
+        return CompiledFormats, (self.as_dict(),)
+
+    def as_dict(self) -> dict:
+        """
+        Returns the formats as a new, mutable dictionary.
+        """
+        return thaw(self._values)
+
+    def merge(self, custom_formats: Mapping) -> "CompiledFormats":
+        """
+        Returns new formats, in which the given custom formats override these formats.
+        Nested values such as the typography are merged as well.
+        """
+        return CompiledFormats(merge(deepcopy(thaw(custom_formats)), self.as_dict()))
@@ -0,0 +1,188 @@
+import re
+from copy import deepcopy
+from typing import Iterable, Iterator
+
+from fragment_cache import record_fragment
+from pdf_template_manager import PdfTemplateManager, compile_formats
+
+
+# Placeholders such as {{name}} or {{customer.name}} within the strings of a content list
+PLACEHOLDER = re.compile(r"\{\{\s*([\w.]+)\s*\}\}")
+
+# The block types supported by `PdfTemplateManager.render`
+BLOCK_TYPES = ("text", "line", "table")
+
+
+def lookup(record: dict, name: str):
+    """
+    Returns the value of a field of the record. Nested fields are separated by dots.
+    """
+    value = record
+    for key in name.split("."):
+        try:
+            value = value[int(key) if isinstance(value, (list, tuple)) else key]
+        except (KeyError, IndexError, TypeError, ValueError):
+            raise KeyError(f"The record has no field '{name}'") from None
+    return value
+
+
+def compile_value(value, fields: set):
+    """
+    Compiles a value of the content into a function, which binds its placeholders to a record.
+    A string consisting of a single placeholder is replaced by the value of the field as it is
+    (e.g. the rows of a table), other placeholders are formatted into the string.
+    Returns None, if the value does not contain any placeholders.
+    Args:
+        value: The value of the content, e.g. the arguments of a block.
+        fields (set): Collects the names of all fields used by the value.
+    """
+    if isinstance(value, str):
+        names = PLACEHOLDER.findall(value)
+        if not names:
+            return None
+        fields.update(names)
+        match = PLACEHOLDER.fullmatch(value)
+        if match is not None:
+            name = match.group(1)
+            return lambda record: lookup(record, name)
+        return lambda record: PLACEHOLDER.sub(lambda m: str(lookup(record, m.group(1))), value)
+
+    if isinstance(value, dict):
+        binders = {key: compile_value(item, fields) for key, item in value.items()}
+        binders = {key: binder for key, binder in binders.items() if binder is not None}
+        if not binders:
+            return None
+        def bind_dict(record: dict) -> dict:
+            # Only the bound items are replaced, the static ones are shared by all records
+            bound = dict(value)
+            for key, binder in binders.items():
+                bound[key] = binder(record)
+            return bound
+        return bind_dict
+
+    if isinstance(value, (list, tuple)):
+        binders = [(index, compile_value(item, fields)) for index, item in enumerate(value)]
+        binders = [(index, binder) for index, binder in binders if binder is not None]
+        if not binders:
+            return None
+        def bind_list(record: dict):
+            bound = list(value)
+            for index, binder in binders:
+                bound[index] = binder(record)
+            return type(value)(bound) if isinstance(value, tuple) else bound
+        return bind_list
+
+    return None
+
+
+class TemplatePlan:
+    """
+    Render plan of a content list with placeholders, which is compiled once and rendered for many records.
+    The content is interpreted and validated once. Static blocks are laid out once, when they are rendered
+    for the first record, and recorded as fragments (see `Fragment`), which later records replay.
+    Per record only the blocks with bound fields are filled in and laid out.
+    Example:
+        plan = TemplatePlan([{"type": "text", "args": {"lines": ["Dear {{name}},"]}}])
+        pdf = plan.render({"name": "Julius"})
+    """
+    def __init__(self, content: list, formats: dict|None=None) -> None:
+        """
+        Args:
+            content (list): The content blocks (see `PdfTemplateManager.render`) with placeholders.
+            formats (dict): Optional formats overriding the default formats.
+        """
+        self.formats = compile_formats(formats)
+        self.fields = set()
+        self.steps = []
+        for item in content:
+            # Same as `PdfTemplateManager.render`, unknown blocks are ignored
+            if item["type"] not in BLOCK_TYPES:
+                continue
+            # The plan must not change, if the content is modified afterwards
+            args = deepcopy(item["args"])
+            self.steps.append((f"render_{item['type']}", args, compile_value(args, self.fields)))
+        # Fragments of the static blocks by their step and the page size
+        self._fragments = {}
+
+    @property
+    def static_blocks(self) -> int:
+        return sum(binder is None for _, _, binder in self.steps)
+
+    def _render_static(self, pdf: PdfTemplateManager, index: int) -> None:
+        """
+        Replays the fragment of a static block or records it, if the block has not been recorded yet.
+        Blocks, which cannot be recorded (e.g. because they break the page), are laid out as usual.
+        """
+        method, args, _ = self.steps[index]
+        if pdf.formats != self.formats:
+            # Documents with other formats are laid out differently
+            getattr(pdf, method)(**args)
+            return
+        key = (index, pdf.w, pdf.h)
+        fragment = self._fragments.get(key)
+        if fragment is None:
+            fragment = record_fragment(pdf, lambda: getattr(pdf, method)(**args))
+            if fragment is not None:
+                self._fragments[key] = fragment
+            return
+        pdf.render_fragment({"type": method[len("render_"):], "args": args}, fragment)
+
+    def bind(self, record: dict) -> list:
+        """
+        Binds the fields of the given record to the blocks without laying them out, so a record missing
+        a field fails before anything is drawn. Returns the arguments per block, None for static blocks.
+        Args:
+            record (dict): The values of the fields of the plan.
+        """
+        return [binder(record) if binder is not None else None for _, _, binder in self.steps]
+
+    def draw(self, pdf: PdfTemplateManager, bound: list) -> None:
+        """
+        Lays out the blocks with the arguments bound to a record (see `bind`) on the current page
+        of an existing document.
+        Args:
+            pdf (PdfTemplateManager): The document to render the blocks into.
+            bound (list): The arguments per block returned by `bind`.
+        """
+        for index, ((method, _, _), args) in enumerate(zip(self.steps, bound)):
+            if args is None:
+                self._render_static(pdf, index)
+            else:
+                getattr(pdf, method)(**args)
+
+    def apply(self, pdf: PdfTemplateManager, record: dict) -> None:
+        """
+        Lays out the blocks for the given record on the current page of an existing document.
+        Args:
+            pdf (PdfTemplateManager): The document to render the blocks into.
+            record (dict): The values of the fields of the plan.
+        """
+        self.draw(pdf, self.bind(record))
+
+    def build(self, record: dict) -> PdfTemplateManager:
+        """
+        Lays out the document for the given record without writing it.
+        Args:
+            record (dict): The values of the fields of the plan.
+        """
+        pdf = PdfTemplateManager(compiled_formats=self.formats)
+        self.apply(pdf, record)
+        return pdf
+
+    def render(self, record: dict, destination=None) -> bytes|None:
+        """
+        Renders the document for the given record.
+        Returns the document as bytes, if no destination is given.
+        Args:
+            record (dict): The values of the fields of the plan.
+            destination (str): The path or binary file object the document is written to.
+        """
+        output = self.build(record).output(destination if destination is not None else "")
+        return bytes(output) if output is not None else None
+
+    def render_many(self, records: Iterable) -> Iterator:
+        """
+        Renders the document for each record and yields the documents as bytes.
+        """
+        for record in records:
+            yield self.render(record)
@@ -1,6 +1,41 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import tracemalloc
+from io import BytesIO
+from pathlib import Path
 import unittest
-from unittest import skip
-from pdf_template_manager import PdfTemplateManager, formats
+from unittest import mock, skip
+import pdf_template_manager
+from pdf_template_manager import PdfTemplateManager, compile_formats, formats
+from batch import PoolRenderer, render_many
+from async_render import render_async
+from template_plan import TemplatePlan
+from mail_merge import MailMerge, read_records
+from main import content as main_content
+from page_layers import FIRST_FORM_XOBJECT_INDEX, PageLayer
+from pdf_import import PdfFile, dict_get, import_page
+from result_cache import ResultCache
+from fragment_cache import ESCAPED, TEXT_TOKEN, UNESCAPED, FragmentCache
+from template_formats import CompiledFormats
+from state_tracker import STATE_OPERATORS
+from render_profiler import RenderProfiler
+from document_layout import LayoutRecorder
+import copy
+from functools import partial
+import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import asyncio
+from font_registry import FontIndex, font_index, font_registry
+from subset_cache import DEFAULT_CHARSET, SubsetCache
+from table_layout import LayoutTable, RowWindow, StreamingTable
+from text_metrics import WrapCache, measure_text, wrap_cache
+from fpdf import FPDF
+from fpdf.errors import FPDFException
+from fpdf.output import OutputProducer
+from fpdf.table import Table
 
 from datetime import datetime
 
@@ -154,3 +189,1295 @@ class TestPdfTemplateManagerUtilities(unittest.TestCase):
         date = datetime.now()
         self.pdf.set_meta_data()
         self.assertAlmostEqual(self.pdf.creation_date, date)
+
+
+class TestFontRegistry(unittest.TestCase):
+    def setUp(self):
+        font_registry.clear()
+
+    def test_fonts_are_parsed_only_once(self):
+        PdfTemplateManager()
+        misses = font_registry.misses
+        PdfTemplateManager()
+        self.assertEqual(font_registry.misses, misses)
+        self.assertEqual(font_registry.hits, misses)
+
+    def test_documents_share_font_tables(self):
+        pdf1, pdf2 = PdfTemplateManager(), PdfTemplateManager()
+        self.assertIs(pdf1.fonts["roboto"].ttfont, pdf2.fonts["roboto"].ttfont)
+        self.assertIsNot(pdf1.fonts["roboto"].subset, pdf2.fonts["roboto"].subset)
+
+    def test_fpdf_output_does_not_subset_shared_tables(self):
+        pdf1, pdf2 = PdfTemplateManager(), PdfTemplateManager()
+        shared = pdf2.fonts["roboto"].ttfont
+        glyphs = len(shared.getGlyphOrder())
+        pdf1.render_text(["Hello World"])
+        pdf1.output(output_producer_class=OutputProducer)
+        self.assertIsNot(pdf1.fonts["roboto"].ttfont, shared)
+        self.assertEqual(len(shared.getGlyphOrder()), glyphs)
+        pdf2.render_text(["Grüße"])
+        self.assertTrue(bytes(pdf2.output()).startswith(b"%PDF"))
+
+    def test_failed_parse_releases_its_lock(self):
+        with tempfile.NamedTemporaryFile(suffix=".ttf") as f:
+            with self.assertRaises(Exception):
+                font_registry.parse(PdfTemplateManager(), f.name)
+        self.assertEqual(font_registry._parsing, {})
+
+    def test_modified_files_replace_older_versions(self):
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, "font.ttf")
+            shutil.copy(font_index.resolve("roboto")[0], fname)
+            first = font_registry.parse(PdfTemplateManager(), fname)
+            os.utime(fname, ns=(0, 0))
+            second = font_registry.parse(PdfTemplateManager(), fname)
+            self.assertIsNot(first, second)
+            self.assertEqual([key for key in font_registry._fonts if key[0] == os.path.abspath(fname)], [(os.path.abspath(fname), 0)])
+
+    def test_rendering_several_documents_with_shared_fonts(self):
+        outputs = []
+        for text in ["Hello World", "Grüße • 100,00 €"]:
+            pdf = PdfTemplateManager()
+            pdf.render_text([text])
+            outputs.append(bytes(pdf.output()))
+        self.assertTrue(all(output.startswith(b"%PDF") for output in outputs))
+
+
+class TestLazyFontRegistration(unittest.TestCase):
+    def test_only_default_font_is_registered(self):
+        pdf = PdfTemplateManager()
+        self.assertEqual(list(pdf.fonts), [formats["typography"]["family"].lower()])
+
+    def test_font_is_registered_on_first_use(self):
+        pdf = PdfTemplateManager()
+        pdf.render_text(["Hello World"], family="Montserrat", style="BU")
+        self.assertIn("montserratB", pdf.fonts)
+        self.assertNotIn("montserrat", pdf.fonts)
+        self.assertNotIn("inter", pdf.fonts)
+
+    def test_table_headings_font_is_registered(self):
+        pdf = PdfTemplateManager()
+        pdf.render_table([("Heading", "Value"), ("Foo", "Bar")], col_widths=(80, 84))
+        self.assertIn("robotoB", pdf.fonts)
+
+    def test_load_all_fonts(self):
+        pdf = PdfTemplateManager()
+        pdf.load_fonts()
+        self.assertEqual(len(pdf.fonts), 4 * len(font_index.families()))
+
+
+class TestFontIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.index_file = os.path.join(self.tmp_dir.name, "index.json")
+        self.index = FontIndex(index_file=self.index_file)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_resolve_static_fonts(self):
+        self.assertTrue(self.index.resolve("Roboto")[0].endswith("Roboto-Regular.ttf"))
+        self.assertTrue(self.index.resolve("roboto", "B")[0].endswith("Roboto-Bold.ttf"))
+        self.assertTrue(self.index.resolve("Roboto", "BI")[0].endswith("Roboto-BoldItalic.ttf"))
+        self.assertTrue(self.index.resolve("Roboto", weight=300)[0].endswith("Roboto-Light.ttf"))
+
+    def test_resolve_optical_size_family(self):
+        self.assertTrue(self.index.resolve("Inter", "B")[0].endswith("Inter_18pt-Bold.ttf"))
+
+    def test_resolve_unknown_family(self):
+        self.assertIsNone(self.index.resolve("Comic Sans"))
+
+    def test_index_file_is_reused(self):
+        self.index.load()
+        index = FontIndex(index_file=self.index_file)
+        index._build = None
+        self.assertEqual(index.load(), self.index.load())
+
+    def test_index_file_defaults_to_cache_dir(self):
+        with mock.patch.dict(os.environ, {"PYOFFICE_CACHE_DIR": self.tmp_dir.name}):
+            index = FontIndex()
+            index.load()
+        self.assertEqual(index.index_file.parent, Path(self.tmp_dir.name))
+        self.assertTrue(index.index_file.exists())
+        self.assertNotIn(index.directory, index.index_file.parents)
+
+    def test_resolve_independent_of_working_directory(self):
+        cwd = os.getcwd()
+        try:
+            os.chdir(self.tmp_dir.name)
+            pdf = PdfTemplateManager()
+            pdf.render_text(["Hello World"], style="B")
+        finally:
+            os.chdir(cwd)
+        self.assertIn("robotoB", pdf.fonts)
+
+
+class TestSubsetCache(unittest.TestCase):
+    def render(self, text, cache, **kwargs):
+        pdf = PdfTemplateManager()
+        pdf.subset_cache = cache
+        pdf.set_creation_date(datetime(2024, 10, 16))
+        pdf.render_text([text])
+        return bytes(pdf.output(**kwargs))
+
+    def test_output_equals_fpdf_output(self):
+        cache = SubsetCache()
+        output = self.render("Grüße • 100,00 €", cache)
+        self.assertEqual(output, self.render("Grüße • 100,00 €", cache, output_producer_class=OutputProducer))
+
+    def test_subset_is_reused(self):
+        cache = SubsetCache()
+        first = self.render("Hello World", cache)
+        second = self.render("Hello World", cache)
+        self.assertEqual(first, second)
+        self.assertEqual(cache.hits, cache.misses)
+
+    def test_different_glyphs_miss(self):
+        cache = SubsetCache()
+        self.render("Hello World", cache)
+        misses = cache.misses
+        self.render("Hallo Welt", cache)
+        self.assertGreater(cache.misses, misses)
+
+    def test_lru_eviction(self):
+        cache = SubsetCache(maxsize=1)
+        self.render("Hello World", cache)
+        self.assertEqual(len(cache), 1)
+
+    def test_disk_tier(self):
+        with tempfile.TemporaryDirectory() as directory:
+            first = self.render("Hello World", SubsetCache(directory=directory))
+            cache = SubsetCache(directory=directory)
+            second = self.render("Hello World", cache)
+            self.assertEqual(first, second)
+            self.assertEqual(cache.misses, 0)
+            self.assertGreater(cache.disk_hits, 0)
+
+    def test_disk_tier_is_bounded(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = SubsetCache(directory=directory)
+            self.render("Hello World", cache)
+            size = sum(entry.stat().st_size for entry in os.scandir(directory))
+            cache = SubsetCache(directory=directory, max_disk_bytes=size)
+            self.render("Hallo Welt", cache)
+            self.render("Grüße", cache)
+            self.assertLessEqual(sum(entry.stat().st_size for entry in os.scandir(directory)), size)
+            self.assertGreater(len(os.listdir(directory)), 0)
+
+    def test_other_fpdf_versions_embed_without_cache(self):
+        cache = SubsetCache()
+        with mock.patch("subset_cache.CACHED_EMBEDDING", False):
+            output = self.render("Grüße • 100,00 €", cache)
+        self.assertEqual(cache.stats()["misses"], 0)
+        self.assertEqual(output, self.render("Grüße • 100,00 €", cache, output_producer_class=OutputProducer))
+
+    def test_fixed_charset(self):
+        cache = SubsetCache(charset=DEFAULT_CHARSET)
+        self.render("Hello World", cache)
+        misses = cache.misses
+        self.render("Grüße • 100,00 €", cache)
+        self.assertEqual(cache.misses, misses)
+
+
+class TestTextMetrics(unittest.TestCase):
+    pdf = PdfTemplateManager()
+    texts = [
+        "",
+        "Stk.",
+        "Yamaha Clavinova Digitalpiano Modell: CLP - 775 Ausführung: Rosenholz",
+        "Bitte registrieren Sie Ihr Instrument.\n\nhttps://de.yamaha.com/de/support/warranty/index.",
+        "Donaudampfschifffahrtsgesellschaftskapitänsmütze",
+        "Konzert\u00adflügel\u00adservice mit\u00a0Stimmen und Reinigen\n",
+    ]
+
+    def test_lines_equal_multi_cell(self):
+        for text in self.texts:
+            for w in (15, 24, 85):
+                expected = self.pdf.multi_cell(w=w, h=5, text=text, dry_run=True, output="LINES")
+                self.assertEqual(measure_text(self.pdf, text, w, 5)[0], expected)
+
+    def test_height_equals_multi_cell(self):
+        for text in self.texts:
+            with self.pdf.offset_rendering() as dummy:
+                y = dummy.get_y()
+                dummy.multi_cell(w=40, h=5, text=text)
+                expected = dummy.get_y() - y
+            self.assertAlmostEqual(measure_text(self.pdf, text, 40, 5)[1], expected)
+
+    def test_not_enough_space(self):
+        with self.assertRaises(FPDFException):
+            measure_text(self.pdf, "W", 1)
+
+    def test_fallback_for_page_number_alias(self):
+        lines, _ = measure_text(self.pdf, "Seite 1 von {nb}", 100)
+        self.assertEqual(lines, ["Seite 1 von {nb}"])
+
+    def test_estimate_table_height_without_col_widths(self):
+        height = self.pdf.estimate_table_height([("Foo", "Bar"), ("Baz", "Qux")])
+        self.assertAlmostEqual(height, self.pdf.get_y() + 2 * self.pdf.line_height)
+
+
+class TestWrapCache(unittest.TestCase):
+    text = "Yamaha Clavinova Digitalpiano Modell: CLP - 775 Ausführung: Rosenholz"
+
+    def render(self, method, align):
+        pdf = PdfTemplateManager()
+        pdf.set_creation_date(datetime(2024, 10, 16))
+        for w in (0, 30, 60):
+            for _ in range(20):
+                if method == "multi_cell":
+                    pdf.multi_cell(w=w, h=pdf.line_height, text=self.text, new_x="LEFT", new_y="NEXT", align=align)
+                else:
+                    pdf.wrapped_cell(w=w, text=self.text, align=align)
+        return bytes(pdf.output())
+
+    def test_wrapped_cell_equals_multi_cell(self):
+        for align in ("L", "C", "R", "J"):
+            self.assertEqual(self.render("wrapped_cell", align), self.render("multi_cell", align))
+
+    def test_texts_are_wrapped_once(self):
+        pdf = PdfTemplateManager()
+        measure_text(pdf, self.text, 30, 5)
+        hits = wrap_cache.hits
+        lines, _ = measure_text(PdfTemplateManager(), self.text, 30, 5)
+        self.assertEqual(wrap_cache.hits, hits + 1)
+        self.assertEqual(lines, pdf.multi_cell(w=30, h=5, text=self.text, dry_run=True, output="LINES"))
+
+    def test_font_size_is_part_of_the_key(self):
+        pdf = PdfTemplateManager()
+        short, _ = measure_text(pdf, self.text, 30, 5)
+        pdf.set_font(size=20)
+        long, _ = measure_text(pdf, self.text, 30, 5)
+        self.assertGreater(len(long), len(short))
+
+    def test_lru_eviction(self):
+        cache = WrapCache(maxsize=2)
+        for text in ("foo", "bar", "baz"):
+            cache.put((text,), (text,))
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(("foo",)))
+        self.assertEqual(cache.get(("baz",)), ("baz",))
+        self.assertEqual(cache.stats()["hit_rate"], 0.5)
+
+
+class TestTableLayout(unittest.TestCase):
+    items = [("Artikel", "Menge", "Preis")] + [
+        ("Yamaha Clavinova Digitalpiano Modell: CLP - 775 Ausführung: Rosenholz", "1 Stk.", "4.999,00 €"),
+        ("Klavierbank", "1 Stk.", "299,00 €"),
+    ] * 40
+    kwargs = {"col_widths": (100, 30, 34), "padding": (1, 0, 1, 0), "text_align": ("LEFT", "CENTER", "RIGHT")}
+
+    def render(self, table_class):
+        pdf = PdfTemplateManager()
+        pdf.set_creation_date(datetime(2024, 10, 16))
+        pdf.register_font(pdf.font_family, "B")
+        table = table_class(pdf, line_height=pdf.line_height, **self.kwargs)
+        for item in self.items:
+            table.row(item)
+        table.render()
+        return pdf, bytes(pdf.output())
+
+    def test_output_equals_fpdf_table(self):
+        self.assertEqual(self.render(LayoutTable)[1], self.render(Table)[1])
+
+    def test_row_heights_equal_fpdf(self):
+        pdf = PdfTemplateManager()
+        table = pdf.build_table(self.items, **self.kwargs)
+        heights = table.layout().heights
+        # Measure the cells with dry runs of fpdf instead
+        with mock.patch.object(LayoutTable, "_render_table_cell", Table._render_table_cell):
+            expected = [row.height for row in Table._compute_rows_info(table)]
+        self.assertEqual(heights, expected)
+
+    def test_page_breaks(self):
+        pdf = PdfTemplateManager()
+        table = pdf.build_table(self.items, **self.kwargs)
+        breaks = table.layout().page_breaks(pdf.get_y(), pdf.t_margin, pdf.page_break_trigger)
+        table.render()
+        self.assertEqual(len(breaks) + 1, pdf.pages_count)
+
+    def test_layout_is_computed_once(self):
+        pdf = PdfTemplateManager()
+        table = pdf.build_table(self.items, **self.kwargs)
+        self.assertIs(table.layout(), table.layout())
+
+    def test_unbreakable_table_starts_on_new_page(self):
+        pdf = PdfTemplateManager()
+        pdf.set_y(pdf.page_break_trigger - pdf.line_height)
+        pdf.render_table(self.items[:3], unbreakable=True, **self.kwargs)
+        self.assertEqual(pdf.pages_count, 2)
+
+
+class TestStreamingTable(unittest.TestCase):
+    items = TestTableLayout.items
+    kwargs = TestTableLayout.kwargs
+
+    def render(self, table_items, **kwargs):
+        pdf = PdfTemplateManager()
+        pdf.set_creation_date(datetime(2024, 10, 16))
+        pdf.render_table(table_items, **self.kwargs, **kwargs)
+        pdf.render_text(["Summe"])
+        return bytes(pdf.output())
+
+    def test_output_equals_list(self):
+        for kwargs in ({}, {"cell_fill_mode": "ROWS"}, {"gutter_height": 2, "repeat_headings": 0}):
+            self.assertEqual(self.render(iter(self.items), **kwargs), self.render(self.items, **kwargs))
+
+    def test_short_and_empty_iterables(self):
+        for count in (0, 1, 2):
+            self.assertEqual(self.render(iter(self.items[:count])), self.render(self.items[:count]))
+
+    def test_memory_is_bounded_by_one_page(self):
+        windows = []
+        append = RowWindow.append
+        def record(window, row):
+            append(window, row)
+            windows.append(len(window.window))
+        with mock.patch.object(RowWindow, "append", record):
+            self.render(item for _ in range(3) for item in self.items)
+        pdf = PdfTemplateManager()
+        self.assertLess(max(windows), (pdf.page_break_trigger - pdf.t_margin) / pdf.line_height + 3)
+
+    def test_layout_is_not_supported(self):
+        pdf = PdfTemplateManager()
+        table = StreamingTable(pdf)
+        with self.assertRaisesRegex(TypeError, "render_rows"):
+            table.layout()
+        with self.assertRaisesRegex(TypeError, "render_rows"):
+            table.render()
+
+
+class TestRenderMany(unittest.TestCase):
+    content = [
+        {"type": "text", "args": {"lines": ["Rechnung", "Vielen Dank für Ihren Einkauf."]}},
+        {"type": "table", "args": {"table_items": [("Artikel", "Preis"), ("Klavierbank", "299,00 €")]}},
+    ]
+
+    def test_render_jobs(self):
+        with tempfile.TemporaryDirectory() as directory:
+            jobs = [(self.content, None, os.path.join(directory, f"{index}.pdf")) for index in range(3)]
+            results = render_many(jobs)
+            self.assertEqual([result["status"] for result in results], ["ok"] * 3)
+            for _, _, destination in jobs:
+                self.assertTrue(os.path.getsize(destination) > 0)
+
+    def test_failure_does_not_abort(self):
+        broken = [{"type": "text", "args": {}}]
+        results = list(render_many([(broken, None, BytesIO()), (broken,), (self.content, None, BytesIO())]))
+        self.assertEqual(results[0]["status"], "error")
+        self.assertIn("TypeError", results[0]["error"])
+        # Malformed jobs do not abort the remaining ones either
+        self.assertEqual(results[1]["status"], "error")
+        self.assertIn("ValueError", results[1]["error"])
+        self.assertEqual(results[2]["status"], "ok")
+        self.assertGreater(len(results[2]["destination"].getvalue()), 0)
+
+    def test_results_are_yielded(self):
+        jobs = iter([(self.content, None, None), (self.content, None, None)])
+        results = render_many(jobs)
+        self.assertTrue(next(results)["pdf"].startswith(b"%PDF"))
+        self.assertEqual(len(list(jobs)), 1)
+
+    def test_custom_formats(self):
+        results = list(render_many([(self.content, {"typography": {"size": 12}}, BytesIO())]))
+        self.assertEqual(results[0]["status"], "ok")
+        self.assertEqual(formats["typography"]["size"], 10)
+
+    def test_formats_are_compiled_once(self):
+        compiled = compile_formats({"mx": 20})
+        self.assertIs(compile_formats({"mx": 20}), compiled)
+        self.assertEqual(compiled["mx"], 20)
+        self.assertEqual(compiled["typography"], formats["typography"])
+        self.assertEqual(PdfTemplateManager(compiled_formats=compiled).l_margin, 20)
+
+    def test_compiled_formats_are_bounded(self):
+        compiled = compile_formats({"mx": 21})
+        with mock.patch("pdf_template_manager.COMPILED_FORMATS_MAXSIZE", 2):
+            compile_formats({"mx": 22})
+            compile_formats({"mx": 21})
+            compile_formats({"mx": 23})
+            # The least recently used formats are evicted
+            self.assertIs(compile_formats({"mx": 21}), compiled)
+            self.assertEqual(len(pdf_template_manager._compiled_formats), 2)
+
+
+class TestPoolRenderer(unittest.TestCase):
+    content = TestRenderMany.content
+
+    def test_render_in_workers(self):
+        broken = [{"type": "text", "args": {}}]
+        with tempfile.TemporaryDirectory() as directory:
+            destination = os.path.join(directory, "document.pdf")
+            jobs = [(self.content, None, None), (broken, None, None), (self.content, {"mx": 20}, destination)]
+            with PoolRenderer(processes=2, chunksize=1, maxtasksperchild=2) as renderer:
+                results = renderer.render(jobs)
+            self.assertEqual([result["status"] for result in results], ["ok", "error", "ok"])
+            self.assertTrue(results[0]["pdf"].startswith(b"%PDF"))
+            self.assertIsNone(results[2]["pdf"])
+            self.assertTrue(os.path.getsize(destination) > 0)
+
+    def test_render_returns_bytes(self):
+        self.assertTrue(bytes(PdfTemplateManager().render(self.content)).startswith(b"%PDF"))
+
+    def test_deterministic_across_workers(self):
+        jobs = [(main_content, {"mx": 20}, None)] * 4
+        with PoolRenderer(processes=2, chunksize=1, maxtasksperchild=1, deterministic=True) as renderer:
+            results = renderer.render(jobs)
+        expected = next(render_many(jobs[:1], deterministic=True))["pdf"]
+        self.assertEqual({result["pdf"] for result in results}, {expected})
+
+    def test_deterministic_with_warm_fragment_cache(self):
+        cached = [dict(block, cache=True) for block in main_content]
+        jobs = [(cached, None, None)] * 2
+        # The second job replays the fragments, which the first job recorded in the same worker
+        with PoolRenderer(processes=1, chunksize=1, deterministic=True) as renderer:
+            warm = renderer.render(jobs)
+        with PoolRenderer(processes=1, chunksize=1, maxtasksperchild=1, deterministic=True) as renderer:
+            fresh = renderer.render(jobs[:1])
+        self.assertEqual([result["pdf"] for result in warm], [fresh[0]["pdf"]] * 2)
+
+
+class TestDeterministicOutput(unittest.TestCase):
+    content = [{"type": "text", "args": {"lines": ["Hello World"]}}]
+
+    def render(self, **kwargs):
+        pdf = PdfTemplateManager(deterministic=True)
+        pdf.set_meta_data(**kwargs)
+        return bytes(pdf.render(self.content))
+
+    def test_same_bytes(self):
+        self.assertEqual(self.render(title="Rechnung"), self.render(title="Rechnung"))
+        self.assertNotEqual(self.render(title="Rechnung"), self.render(title="Angebot"))
+        self.assertIn(b"/CreationDate (D:20000101000000Z", self.render())
+
+    def test_document_id_depends_on_content(self):
+        ids = {re.search(rb"/ID \[(<\w+>)", self.render(title=title)).group(1) for title in ("A", "A", "B")}
+        self.assertEqual(len(ids), 2)
+
+    def test_source_date_epoch(self):
+        with mock.patch.dict(os.environ, {"SOURCE_DATE_EPOCH": "1704067200"}):
+            self.assertIn(b"/CreationDate (D:20240101000000Z", self.render())
+
+    def test_not_deterministic_by_default(self):
+        pdf = PdfTemplateManager()
+        pdf.set_meta_data()
+        self.assertNotEqual(pdf.creation_date.year, 2000)
+
+
+class TestRenderAsync(unittest.IsolatedAsyncioTestCase):
+    content = TestRenderMany.content
+
+    async def test_returns_bytes(self):
+        pdf = await render_async(self.content)
+        self.assertTrue(pdf.startswith(b"%PDF"))
+
+    async def test_stream_to_writer(self):
+        class Writer:
+            def __init__(self):
+                self.data = bytearray()
+                self.drained = 0
+            def write(self, chunk):
+                self.data += chunk
+            async def drain(self):
+                self.drained += 1
+
+        writer = Writer()
+        self.assertIsNone(await render_async(self.content, writer=writer))
+        self.assertTrue(writer.data.startswith(b"%PDF"))
+        self.assertTrue(writer.data.rstrip().endswith(b"%%EOF"))
+        self.assertGreater(writer.drained, 0)
+
+    async def test_pages_are_streamed_while_rendering(self):
+        writes = []
+        class Writer:
+            def write(self, chunk):
+                # The pages written so far, while the document is still being rendered
+                writes.append(chunk)
+        content = [{"type": "text", "args": {"lines": ["Lorem ipsum dolor sit amet."] * 200}}]
+        with mock.patch("async_render.WRITE_CHUNK_SIZE", 1):
+            self.assertIsNone(await render_async(content, writer=Writer()))
+        data = b"".join(writes)
+        self.assertGreater(data.count(b"/Type /Page\n"), 1)
+        # Each page is written on its own, before the fonts and the page tree
+        self.assertGreater(len(writes), data.count(b"/Type /Page\n"))
+        self.assertNotIn(b"/Type /Pages", writes[1])
+
+    async def test_writer_requires_a_thread_executor(self):
+        with ProcessPoolExecutor(1) as executor:
+            with self.assertRaises(TypeError):
+                await render_async(self.content, executor=executor, writer=BytesIO())
+
+    async def test_concurrency_limit(self):
+        semaphore = asyncio.Semaphore(2)
+        pdfs = await asyncio.gather(*(render_async(self.content, semaphore=semaphore) for _ in range(4)))
+        self.assertEqual(len(pdfs), 4)
+        self.assertTrue(all(pdf.startswith(b"%PDF") for pdf in pdfs))
+
+
+class TestTemplatePlan(unittest.TestCase):
+    content = [
+        {"type": "line", "args": {"x1": 3, "x2": 7, "y1": 99}},
+        {"type": "text", "args": {"lines": ["DaumDigital", "Olshausenstr. 11"], "size": 7}},
+        {"type": "text", "args": {"lines": ["Sehr geehrte(r) {{customer.name}},", "Rechnung {{number}}"]}},
+        {"type": "table", "args": {"table_items": "{{items}}", "col_widths": (120, 44)}},
+    ]
+    record = {
+        "customer": {"name": "Julius Daum"},
+        "number": 42,
+        "items": [("Artikel", "Preis"), ("Klavierbank", "299,00 €")],
+    }
+
+    def output(self, pdf):
+        pdf.set_creation_date(datetime(2024, 10, 16))
+        return bytes(pdf.output())
+
+    def test_layout_equals_render(self):
+        plan = TemplatePlan(self.content)
+        expected = PdfTemplateManager()
+        expected.render_line(x1=3, x2=7, y1=99)
+        expected.render_text(lines=["DaumDigital", "Olshausenstr. 11"], size=7)
+        expected.render_text(lines=["Sehr geehrte(r) Julius Daum,", "Rechnung 42"])
+        expected.render_table(table_items=self.record["items"], col_widths=(120, 44))
+        pdf = plan.build(self.record)
+        self.assertEqual((pdf.page, pdf.x, pdf.y), (expected.page, expected.x, expected.y))
+        self.assertEqual(bytes(pdf.pages[1].contents).count(b" Tj "), bytes(expected.pages[1].contents).count(b" Tj "))
+
+    def test_static_blocks_are_replayed(self):
+        plan = TemplatePlan(self.content)
+        first = self.output(plan.build(self.record))
+        self.assertEqual(len(plan._fragments), 2)
+        fragments = dict(plan._fragments)
+        texts = []
+        def render_text(pdf, lines, **kwargs):
+            texts.append(lines)
+            return original(pdf, lines, **kwargs)
+        original = PdfTemplateManager.render_text
+        with mock.patch.object(PdfTemplateManager, "render_text", render_text):
+            pdf = plan.build(self.record)
+        # Only the text with fields is laid out again
+        self.assertEqual(texts, [["Sehr geehrte(r) Julius Daum,", "Rechnung 42"]])
+        second = self.output(pdf)
+        self.assertEqual(plan._fragments, fragments)
+        self.assertEqual(second, first)
+
+    def test_render_same_record_repeatedly(self):
+        # The first call records the static blocks, the later calls replay them
+        plan = TemplatePlan(main_content)
+        with mock.patch("template_plan.PdfTemplateManager", partial(PdfTemplateManager, deterministic=True)):
+            documents = [plan.render({}) for _ in range(3)]
+        self.assertEqual(len(set(documents)), 1)
+
+    def test_fields_and_static_blocks(self):
+        plan = TemplatePlan(self.content)
+        self.assertEqual(plan.fields, {"customer.name", "number", "items"})
+        self.assertEqual(plan.static_blocks, 2)
+
+    def test_records_do_not_change_the_plan(self):
+        plan = TemplatePlan(self.content)
+        plan.render(self.record)
+        self.content[1]["args"]["lines"].append("changed")
+        try:
+            other = dict(self.record, number=43)
+            self.assertEqual(plan.steps[2][2](other)["lines"][1], "Rechnung 43")
+            self.assertEqual(plan.steps[1][1]["lines"], ["DaumDigital", "Olshausenstr. 11"])
+        finally:
+            self.content[1]["args"]["lines"].pop()
+
+    def test_missing_field(self):
+        plan = TemplatePlan(self.content)
+        with self.assertRaises(KeyError):
+            plan.render({"number": 1})
+
+
+class TestMailMerge(unittest.TestCase):
+    content = [
+        {"type": "text", "args": {"lines": ["Sehr geehrte(r) {{name}},", "Rechnung {{number}}"]}},
+    ]
+
+    def write_records(self, directory):
+        csv_file = os.path.join(directory, "records.csv")
+        with open(csv_file, "w", encoding="utf-8") as f:
+            f.write("name,number\nJulius Daum,1\nErika Mustermann,2\n")
+        jsonl_file = os.path.join(directory, "records.jsonl")
+        with open(jsonl_file, "w", encoding="utf-8") as f:
+            f.write('{"name": "Julius Daum", "number": 1}\n\n{"name": "Erika Mustermann", "number": 2}\n')
+        return csv_file, jsonl_file
+
+    def test_read_records(self):
+        with tempfile.TemporaryDirectory() as directory:
+            csv_file, jsonl_file = self.write_records(directory)
+            self.assertEqual([record["name"] for record in read_records(csv_file)], ["Julius Daum", "Erika Mustermann"])
+            self.assertEqual([record["number"] for record in read_records(jsonl_file)], [1, 2])
+            with self.assertRaises(ValueError):
+                list(read_records(os.path.join(directory, "records.txt")))
+
+    def test_render_each(self):
+        with tempfile.TemporaryDirectory() as directory:
+            csv_file, _ = self.write_records(directory)
+            records = list(read_records(csv_file)) + [{"name": "Missing number"}]
+            report = MailMerge(self.content).render_each(records, os.path.join(directory, "{{index}}-{{number}}.pdf"))
+            self.assertEqual(report["documents"], 2)
+            self.assertEqual([index for index, _ in report["errors"]], [2])
+            self.assertGreater(report["documents_per_second"], 0)
+            self.assertTrue(os.path.exists(os.path.join(directory, "1-2.pdf")))
+
+    def test_render_combined(self):
+        records = ({"name": f"Kunde {index}", "number": index} for index in range(3))
+        pdf, report = MailMerge(self.content).render_combined(records)
+        self.assertTrue(pdf.startswith(b"%PDF"))
+        self.assertEqual(report["documents"], 3)
+        self.assertEqual(pdf.count(b"/Type /Page\n"), 3)
+
+    def test_render_combined_with_bookmarks(self):
+        records = ({"name": f"Kunde {index}", "number": index} for index in range(3))
+        pdf, _ = MailMerge(self.content).render_combined(records, title="Rechnung {{number}}")
+        self.assertEqual(pdf.count(b"/Title (Rechnung "), 3)
+
+    def test_render_combined_skips_failing_records(self):
+        records = [{"name": "Julius Daum", "number": 1}, {"name": "Missing number"}, {"name": "Kaputt", "number": 3}]
+        def render_text(pdf, lines, **kwargs):
+            original(pdf, lines, **kwargs)
+            if "Kaputt" in lines[0]:
+                raise ValueError("Kaputt")
+        original = PdfTemplateManager.render_text
+        with tempfile.TemporaryDirectory() as directory:
+            destination = os.path.join(directory, "combined.pdf")
+            with mock.patch.object(PdfTemplateManager, "render_text", render_text):
+                pdf, report = MailMerge(self.content).render_combined(records, destination, title="{{name}}")
+            self.assertIsNone(pdf)
+            with open(destination, "rb") as f:
+                output = f.read()
+        self.assertEqual(report["documents"], 1)
+        self.assertEqual([index for index, _ in report["errors"]], [1, 2])
+        # The record missing a field is skipped, the one failing during the layout remains incomplete
+        self.assertEqual(output.count(b"/Type /Page\n"), 2)
+        self.assertEqual(output.count(b"/Title ("), 2)
+        self.assertNotIn(b"/Title (Missing number)", output)
+
+
+class TestPageLayers(unittest.TestCase):
+    letterhead = [
+        {"type": "text", "args": {"lines": ["DaumDigital • Olshausenstr. 11 • 24118 Kiel"], "x": 23, "y": 285, "size": 7}},
+        {"type": "line", "args": {"x1": 23, "x2": 187, "y1": 284}},
+    ]
+
+    def render(self, pages=5):
+        pdf = PdfTemplateManager()
+        pdf.compress = False
+        pdf.add_fold_marks()
+        pdf.add_page_layer(self.letterhead)
+        for _ in range(pages - 1):
+            pdf.add_page()
+        return pdf
+
+    def test_layers_are_recorded_once(self):
+        pdf = self.render()
+        self.assertEqual(len(pdf._resource_catalog.form_xobjects), 2)
+        output = bytes(pdf.output())
+        self.assertEqual(output.count(b"/Subtype /Form"), 2)
+        self.assertEqual(output.count(b"Do Q"), 10)
+        self.assertEqual(output.count(b"Seite "), 0)
+
+    def test_layer_does_not_change_the_document_state(self):
+        pdf = PdfTemplateManager()
+        pdf.set_draw_color(255, 0, 0)
+        state = (pdf.get_x(), pdf.get_y(), pdf.draw_color, pdf.line_width, pdf.font_size_pt, pdf.page)
+        pdf.add_page_layer(self.letterhead)
+        self.assertEqual((pdf.get_x(), pdf.get_y(), pdf.draw_color, pdf.line_width, pdf.font_size_pt, pdf.page), state)
+
+    def test_layer_sets_its_graphics_state(self):
+        pdf = PdfTemplateManager()
+        stream = []
+        with mock.patch("page_layers.PDFContentStream", side_effect=lambda contents, compress: stream.append(contents) or mock.MagicMock()):
+            PageLayer(self.letterhead).place(pdf)
+        self.assertTrue(stream[0].startswith(b"0 G\n0 g\n"))
+        self.assertIn(b" Tf", stream[0])
+
+    def test_images_get_another_index(self):
+        from PIL import Image
+        image = BytesIO()
+        Image.new("RGB", (4, 4), (255, 0, 0)).save(image, format="PNG")
+        pdf = self.render(pages=1)
+        pdf.image(image, x=10, y=10, w=10)
+        indices = [index for index, _ in pdf._resource_catalog.form_xobjects]
+        self.assertNotIn(pdf.image_cache.images[next(reversed(pdf.image_cache.images))]["i"], indices)
+        output = bytes(pdf.output())
+        self.assertEqual(output.count(b"/Subtype /Image"), 1)
+        self.assertEqual(output.count(b"/Subtype /Form"), 2)
+
+    def test_layers_are_not_placed_during_dry_runs(self):
+        pdf = PdfTemplateManager()
+        with pdf._disable_writing():
+            self.assertTrue(pdf.dry_run)
+            pdf.add_fold_marks()
+            pdf.add_page()
+        self.assertFalse(pdf.dry_run)
+        self.assertEqual(pdf.form_xobjects, {})
+        self.assertEqual(pdf._resource_catalog.form_xobjects, [])
+
+
+class TestPdfImport(unittest.TestCase):
+    def test_dict_get(self):
+        dictionary = b"<</Type /Page /Kids [3 0 R 5 0 R] /Font <</F1 7 0 R>> /Title (a >> b)>>"
+        self.assertEqual(dict_get(dictionary, b"/Kids"), b"[3 0 R 5 0 R]")
+        self.assertEqual(dict_get(dictionary, b"/Font"), b"<</F1 7 0 R>>")
+        self.assertEqual(dict_get(dictionary, b"/Title"), b"(a >> b)")
+        self.assertIsNone(dict_get(dictionary, b"/Parent"))
+
+    def test_import_page(self):
+        page = import_page("template.pdf")
+        self.assertIs(import_page("template.pdf"), page)
+        self.assertEqual(page.media_box, (0, 0, 595.28, 841.89))
+        self.assertIn(b"/Font", page.resources)
+        self.assertTrue(page.contents.startswith(b"2 J"))
+        self.assertEqual(len(PdfFile(open("template.pdf", "rb").read()).pages()), 2)
+
+    def test_background_is_embedded_once(self):
+        pdf = PdfTemplateManager(compiled_formats=compile_formats({"background": {"file": "template.pdf"}}))
+        pdf.compress = False
+        pdf.add_page()
+        pdf.add_page()
+        output = bytes(pdf.output())
+        self.assertEqual(output.count(b"/Subtype /Form"), 1)
+        self.assertEqual(output.count(b"q /I%d Do Q" % FIRST_FORM_XOBJECT_INDEX), 3)
+        # Two fonts of the footer and the two imported fonts, which are copied once as well
+        self.assertEqual(output.count(b"/Type /FontDescriptor"), 4)
+        self.assertEqual(len(PdfFile(output).pages()), 3)
+
+    def test_background_is_placed_beneath_the_current_page(self):
+        pdf = PdfTemplateManager()
+        pdf.compress = False
+        pdf.render_text(["Rechnung"])
+        pdf.set_background("template.pdf")
+        self.assertTrue(bytes(pdf.pages[1].contents).startswith(b"q /I%d Do Q" % FIRST_FORM_XOBJECT_INDEX))
+
+
+class TestRenderDocuments(unittest.TestCase):
+    def documents(self, *rows):
+        return [
+            {"title": f"Rechnung {index}", "content": [{"type": "text", "args": {"lines": ["Position"] * count}}]}
+            for index, count in enumerate(rows)
+        ]
+
+    def render(self, documents):
+        # A core font, so the page numbers can be read from the content streams
+        pdf = PdfTemplateManager(compiled_formats=compile_formats({"typography": {"family": "helvetica"}}))
+        pdf.compress = False
+        return bytes(pdf.render_documents(documents))
+
+    def test_page_numbers_per_document(self):
+        output = self.render(self.documents(80, 10, 200))
+        page_numbers = [match.decode() for match in re.findall(rb"Seite (\d+ von \) Tj \(\d+)", output)]
+        self.assertEqual(
+            page_numbers,
+            ["1 von ) Tj (2", "2 von ) Tj (2", "1 von ) Tj (1", "1 von ) Tj (4", "2 von ) Tj (4", "3 von ) Tj (4", "4 von ) Tj (4"],
+        )
+
+    def test_bookmarks(self):
+        output = self.render(self.documents(1, 1, 1))
+        self.assertEqual(re.findall(rb"/Title \((.*?)\)", output), [b"Rechnung 0", b"Rechnung 1", b"Rechnung 2"])
+        self.assertEqual(output.count(b"/Type /Page\n"), 3)
+
+    def test_fonts_are_embedded_once(self):
+        pdf = PdfTemplateManager()
+        output = bytes(pdf.render_documents({"content": content} for content in [main_content] * 5))
+        self.assertEqual(output.count(b"/Type /FontDescriptor"), len(pdf.fonts))
+
+class TestStreamingOutput(unittest.TestCase):
+    def setUp(self):
+        # A core font, so the page numbers can be read from the content streams
+        self.pdf = PdfTemplateManager(compiled_formats=compile_formats({"typography": {"family": "helvetica"}}))
+        self.pdf.compress = False
+        self.file = BytesIO()
+        self.pdf.stream_to(self.file)
+
+    def lines(self, count):
+        return [{"type": "text", "args": {"lines": ["Position"] * count}}]
+
+    def test_pages_are_written_when_completed(self):
+        self.pdf.render_content(self.lines(200))
+        self.assertGreater(self.pdf.page, 2)
+        # Only the footers of the completed pages are kept
+        self.assertGreater(len(self.file.getvalue()), 1000 * (self.pdf.page - 1))
+        for page in range(1, self.pdf.page):
+            self.assertLess(len(self.pdf.pages[page].contents), 200)
+
+    def test_page_totals(self):
+        self.assertIsNone(self.pdf.render(self.lines(200)))
+        output = self.file.getvalue()
+        self.assertEqual(len(PdfFile(output).pages()), 4)
+        self.assertEqual(
+            re.findall(rb"Seite (\d+) von \) Tj \((\d+)", output),
+            [(b"1", b"4"), (b"2", b"4"), (b"3", b"4"), (b"4", b"4")],
+        )
+
+    def test_same_content_as_output(self):
+        self.pdf.add_fold_marks()
+        self.pdf.render(self.lines(100))
+        reference = PdfTemplateManager(compiled_formats=self.pdf.formats)
+        reference.compress = False
+        reference.add_fold_marks()
+        expected = PdfFile(bytes(reference.render(self.lines(100))))
+        streamed = PdfFile(self.file.getvalue())
+        self.assertEqual(len(streamed.pages()), 2)
+        self.assertEqual(len(streamed.pages()), len(expected.pages()))
+        # The written part and the footer of a page are imported as a single content stream
+        for index in range(2):
+            self.assertEqual(streamed.import_page(index).contents.split(), expected.import_page(index).contents.split())
+        # Every object of the file is found at its offset
+        for number in streamed.offsets:
+            streamed.object(number)
+
+    def test_page_totals_per_document(self):
+        self.pdf.render_documents([{"content": self.lines(80)}, {"content": self.lines(10)}])
+        # The footers are written in the order of the substitution of the totals
+        self.assertEqual(
+            sorted(re.findall(rb"Seite (\d+) von \) Tj \((\d+)", self.file.getvalue()), key=lambda page: -int(page[1])),
+            [(b"1", b"2"), (b"2", b"2"), (b"1", b"1")],
+        )
+
+    def test_stream_to_path(self):
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, "streamed.pdf")
+            pdf = PdfTemplateManager()
+            pdf.stream_to(fname)
+            pdf.render(self.lines(100))
+            with open(fname, "rb") as f:
+                self.assertEqual(len(PdfFile(f.read()).pages()), 2)
+
+    def test_encryption_is_not_supported(self):
+        self.pdf.set_encryption(owner_password="secret")
+        with self.assertRaises(FPDFException):
+            self.pdf.output()
+
+class TestResultCache(unittest.TestCase):
+    content = [{"type": "text", "args": {"lines": ["Hello World"]}}]
+
+    def test_hit_does_not_render(self):
+        cache = ResultCache()
+        pdf = cache.render(self.content)
+        with mock.patch("batch.PdfTemplateManager", side_effect=AssertionError("rendered again")):
+            self.assertEqual(cache.render(list(self.content)), pdf)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_key(self):
+        cache = ResultCache()
+        key = cache.key(self.content)
+        self.assertEqual(key, cache.key([{"args": {"lines": ["Hello World"]}, "type": "text"}]))
+        self.assertNotEqual(key, cache.key(self.content, {"mx": 10}))
+        self.assertNotEqual(key, cache.key([{"type": "text", "args": {"lines": ["Hello"]}}]))
+        # Formats equal to the defaults result in the same document
+        self.assertEqual(key, cache.key(self.content, {"mx": formats["mx"]}))
+        with mock.patch.object(font_index, "signature", return_value="other fonts"):
+            self.assertNotEqual(key, cache.key(self.content))
+
+    def test_uncacheable_content(self):
+        cache = ResultCache()
+        content = [{"type": "table", "args": {"table_items": ((str(i),) for i in range(3))}}]
+        self.assertIsNone(cache.key(content))
+        self.assertTrue(cache.render(content).startswith(b"%PDF"))
+        self.assertEqual(len(cache), 0)
+
+    def test_memory_budget(self):
+        cache = ResultCache(max_bytes=100)
+        for index in range(3):
+            cache.put(str(index), bytes(40))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertIsNone(cache.get("0"))
+        self.assertIsNotNone(cache.get("2"))
+        # Documents larger than the budget are not kept in memory
+        cache.put("large", bytes(200))
+        self.assertIsNone(cache.get("large"))
+
+    def test_disk_tier(self):
+        with tempfile.TemporaryDirectory() as directory:
+            pdf = ResultCache(directory=directory).render(self.content)
+            cache = ResultCache(directory=directory)
+            self.assertEqual(cache.render(self.content), pdf)
+            self.assertEqual(cache.stats()["disk_hits"], 1)
+            self.assertEqual(len(cache), 1)
+
+    def test_disk_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(max_bytes=0, directory=directory, max_disk_bytes=100)
+            for index in range(3):
+                cache.put(str(index), bytes(40))
+                os.utime(os.path.join(directory, f"{index}.pdf"), ns=(index, index))
+            cache.put("3", bytes(40))
+            self.assertEqual(sorted(os.listdir(directory)), ["2.pdf", "3.pdf"])
+            self.assertEqual(cache.stats()["disk_evictions"], 2)
+
+class TestFragmentCache(unittest.TestCase):
+    address = {"type": "text", "cache": True, "args": {"lines": ["Muster GmbH", "Musterstraße 1", "12345 Musterstadt"], "style": "B"}}
+
+    def setUp(self):
+        self.cache = FragmentCache()
+
+    def document(self, *fonts):
+        pdf = PdfTemplateManager()
+        pdf.fragment_cache = self.cache
+        for family in fonts:
+            pdf.render_text(["Ä"], family=family)
+        return pdf
+
+    def texts(self, pdf):
+        """
+        Decodes the texts of the first page with the subsets of the document.
+        """
+        fonts = {font.i: font for font in pdf.fonts.values()}
+        texts, font = [], None
+        for match in TEXT_TOKEN.finditer(bytes(pdf.pages[1].contents)):
+            if match.group(1) is not None:
+                font = fonts[int(match.group(1))]
+                continue
+            glyphs = {code: glyph for glyph, code in font.subset.items()}
+            data = ESCAPED.sub(lambda m: UNESCAPED.get(m.group(1), m.group(1)), match.group(3))
+            codes = [int.from_bytes(data[i:i + 2], "big") for i in range(0, len(data), 2)]
+            texts.append("".join(chr(unicode) for code in codes for unicode in glyphs[code].unicode))
+        return texts
+
+    def test_replay_in_other_documents(self):
+        self.document().render_content([self.address])
+        # Other fonts are registered first, so the font ids and subsets differ
+        pdf = self.document("Inter")
+        pdf.render_content([self.address, {"type": "text", "args": {"lines": ["Rechnung"]}}])
+        self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 1, "fragments": 1})
+        self.assertEqual(self.texts(pdf), ["Ä", "Muster GmbH", "Musterstraße 1", "12345 Musterstadt", "Rechnung"])
+
+        expected = self.document("Inter")
+        expected.render_content([{"type": "text", "args": self.address["args"]}, {"type": "text", "args": {"lines": ["Rechnung"]}}])
+        self.assertEqual(self.texts(pdf), self.texts(expected))
+        self.assertAlmostEqual(pdf.y, expected.y)
+
+    def test_replay_at_cursor(self):
+        pdf = self.document()
+        pdf.render_content([self.address])
+        height = pdf.y - pdf.t_margin
+        pdf.render_content([self.address])
+        self.assertEqual(bytes(pdf.pages[1].contents).count(b" cm"), 1)
+        self.assertAlmostEqual(pdf.y, pdf.t_margin + 2 * height)
+
+    def test_block_not_fitting_on_page(self):
+        pdf = self.document()
+        pdf.render_content([self.address])
+        pdf.set_y(pdf.page_break_trigger - 5)
+        pdf.render_content([self.address])
+        self.assertEqual(pdf.page, 2)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def test_invalidation(self):
+        pdf = self.document()
+        key = self.cache.key(pdf, self.address)
+        self.assertEqual(key, self.cache.key(pdf, dict(self.address)))
+        other = PdfTemplateManager(compiled_formats=compile_formats({"line_height": 2}))
+        self.assertNotEqual(key, self.cache.key(other, self.address))
+        with mock.patch.object(font_index, "signature", return_value="other fonts"):
+            self.assertNotEqual(key, self.cache.key(self.document(), self.address))
+        # An explicit key does not depend on the arguments of the block
+        self.assertEqual(
+            self.cache.key(pdf, {"cache": "address", "type": "text", "args": {}}),
+            self.cache.key(pdf, {"cache": "address", "type": "text", "args": {"lines": ["Other"]}}),
+        )
+
+    def test_uncacheable_blocks(self):
+        rows = {"type": "table", "cache": True, "args": {"table_items": ((str(i),) for i in range(3))}}
+        self.assertIsNone(self.cache.key(self.document(), rows))
+        pdf = self.document()
+        pdf.render_content([{"type": "text", "cache": True, "args": {"lines": ["Seite {nb}"]}}])
+        self.assertEqual(len(self.cache), 0)
+
+    def test_cold_and_warm_cache_write_same_bytes(self):
+        # The table of the main content ends below the page break trigger
+        content = [dict(block, cache=True) for block in main_content]
+        def render():
+            pdf = PdfTemplateManager(deterministic=True)
+            pdf.fragment_cache = self.cache
+            return bytes(pdf.render(content))
+        cold = render()
+        self.assertGreater(len(self.cache), 0)
+        self.assertEqual(render(), cold)
+        self.assertEqual(render(), cold)
+
+    def test_bounded(self):
+        cache = FragmentCache(maxsize=2)
+        for index in range(3):
+            cache.put(str(index), None)
+        self.assertEqual(len(cache), 2)
+
+class TestCompiledFormats(unittest.TestCase):
+    def test_immutable(self):
+        compiled = compile_formats()
+        with self.assertRaises(AttributeError):
+            compiled.mx = 10
+        with self.assertRaises(TypeError):
+            compiled["typography"]["size"] = 12
+        with self.assertRaises(TypeError):
+            compiled["mx"] = 10
+
+    def test_reads_like_the_formats(self):
+        compiled = compile_formats()
+        self.assertEqual(compiled["typography"]["family"], formats["typography"]["family"])
+        self.assertEqual(compiled.mx, formats["mx"])
+        self.assertEqual(compiled.top_margin, formats["my"] + formats["ph"])
+        self.assertEqual(compiled.as_dict()["fold_marks"][0]["y"], formats["fold_marks"][0]["y"])
+
+    def test_apply_formats_does_not_change_other_documents(self):
+        pdf = PdfTemplateManager()
+        size = formats["typography"]["size"]
+        pdf.apply_formats({"typography": {"size": size + 2}})
+        # Nested formats are merged, the custom values win
+        self.assertEqual(pdf.formats["typography"]["size"], size + 2)
+        self.assertEqual(pdf.formats["typography"]["family"], formats["typography"]["family"])
+        self.assertEqual(formats["typography"]["size"], size)
+        self.assertEqual(PdfTemplateManager().formats["typography"]["size"], size)
+
+    def test_custom_dict_is_not_aliased(self):
+        custom = {"typography": {"size": 12}}
+        compiled = compile_formats(custom)
+        custom["typography"]["size"] = 14
+        self.assertEqual(compiled["typography"]["size"], 12)
+
+    def test_shared_without_copying(self):
+        compiled = compile_formats({"mx": 20})
+        self.assertIs(copy.deepcopy(compiled), compiled)
+        self.assertIs(PdfTemplateManager(compiled_formats=compiled).formats, compiled)
+        self.assertEqual(pickle.loads(pickle.dumps(compiled)), compiled)
+
+    def test_plain_dict(self):
+        pdf = PdfTemplateManager(compiled_formats=dict(compile_formats({"mx": 20})))
+        self.assertIsInstance(pdf.formats, CompiledFormats)
+        self.assertEqual(pdf.l_margin, 20)
+
+class UntrackedTemplateManager(PdfTemplateManager):
+    # Writes every operator, like fpdf does
+    _out = FPDF._out
+
+class TestGraphicsStateTracker(unittest.TestCase):
+    rows = [[f"Pos {i}", "Artikel", f"{i},00 €"] for i in range(200)]
+    cell_formats = {f"{row}.{column}": {"bg_color": (240, 240, 240), "style": "B"} for row in range(0, 200, 2) for column in range(3)}
+
+    def table(self, pdf: PdfTemplateManager) -> list:
+        pdf.render_table(self.rows, cell_formats=self.cell_formats)
+        # The placeholders of the total number of pages are random
+        return [
+            re.sub(r"::placeholder:[^:]+::", "", bytes(page.contents).decode("latin-1")).splitlines()
+            for page in pdf.pages.values()
+        ]
+
+    def test_drops_only_state_operators(self):
+        pdf = PdfTemplateManager()
+        tracked = self.table(pdf)
+        untracked = self.table(UntrackedTemplateManager())
+        self.assertGreater(pdf.graphics_state.stats()["suppressed"], 0)
+        self.assertLess(sum(map(len, map("\n".join, tracked))), sum(map(len, map("\n".join, untracked))))
+        # Everything else is written as it is
+        def drawing(pages: list) -> list:
+            return [
+                [line for line in lines if not any(pattern.fullmatch(line) for pattern in STATE_OPERATORS.values())]
+                for lines in pages
+            ]
+        self.assertEqual(drawing(tracked), drawing(untracked))
+
+    def lines(self, pdf: PdfTemplateManager, operators: list) -> list:
+        pdf.graphics_state.reset()
+        start = len(pdf.pages[pdf.page].contents)
+        for operator in operators:
+            pdf._out(operator)
+        return bytes(pdf.pages[pdf.page].contents[start:]).decode("latin-1").splitlines()
+
+    def test_redundant_operators(self):
+        pdf = PdfTemplateManager()
+        self.assertEqual(
+            self.lines(pdf, ["1 0 0 rg", "0 0 10 10 re f", "1 0 0 rg", "0 0 10 10 re f"]),
+            ["1 0 0 rg", "0 0 10 10 re f", "0 0 10 10 re f"],
+        )
+
+    def test_overwritten_operators(self):
+        pdf = PdfTemplateManager()
+        self.assertEqual(
+            self.lines(pdf, ["0.5 w", "1 0 0 RG", "0.2 w", "0 0 m 10 0 l S", "0.5 w", "0.2 w", "0 0 m 10 0 l S"]),
+            ["1 0 0 RG", "0.2 w", "0 0 m 10 0 l S", "0 0 m 10 0 l S"],
+        )
+        self.assertEqual(pdf.graphics_state.suppressed["w"], 3)
+
+    def test_save_restore(self):
+        pdf = PdfTemplateManager()
+        self.assertEqual(
+            self.lines(pdf, ["1 0 0 rg", "q", "0 0 1 rg", "0 0 10 10 re f", "Q", "1 0 0 rg", "0 0 10 10 re f"]),
+            ["1 0 0 rg", "q", "0 0 1 rg", "0 0 10 10 re f", "Q", "0 0 10 10 re f"],
+        )
+
+    def test_unknown_output(self):
+        pdf = PdfTemplateManager()
+        # The text color is set within the text object, hence the fill color is not known afterwards
+        operators = ["1 0 0 rg", "0 0 10 10 re f", "BT 0 0 Td 0 0 1 rg (a) Tj ET", "1 0 0 rg"]
+        self.assertEqual(self.lines(pdf, operators), operators)
+        # Unbalanced save and restore operators
+        operators = ["q 1 0 0 1 0 10 cm", "1 0 0 rg", "0 0 10 10 re f", "Q", "1 0 0 rg"]
+        self.assertEqual(self.lines(pdf, operators), operators)
+
+    def test_modified_contents(self):
+        pdf = PdfTemplateManager()
+        self.lines(pdf, ["1 0 0 rg", "0 0 10 10 re f"])
+        del pdf.pages[pdf.page].contents[-9:]
+        self.assertEqual(self.lines(pdf, ["1 0 0 rg"]), ["1 0 0 rg"])
+
+class TestConcurrentRendering(unittest.TestCase):
+    custom_formats = [
+        None,
+        {"mx": 30, "typography": {"size": 12}},
+        {"my": 10, "ph": 50, "primary_color": [220, 38, 38]},
+        {"typography": {"size": 8, "style": "B"}, "line_height": 6},
+    ]
+    content = main_content + [
+        {"type": "table", "args": {"table_items": [[f"Pos {i}", "Artikel", f"{i},00 €"] for i in range(60)]}},
+    ]
+
+    def render(self, index: int) -> bytes:
+        pdf = PdfTemplateManager(deterministic=True)
+        # Half of the documents change their formats after construction
+        custom_formats = self.custom_formats[index % len(self.custom_formats)]
+        if custom_formats is not None and index % 2:
+            pdf.apply_formats(custom_formats)
+        elif custom_formats is not None:
+            pdf = PdfTemplateManager(compiled_formats=compile_formats(custom_formats), deterministic=True)
+        return bytes(pdf.render(self.content))
+
+    def test_same_output_as_serial(self):
+        indices = range(4 * len(self.custom_formats))
+        serial = [self.render(index) for index in indices]
+        # The formats render different documents, so mixing them up would be noticed
+        self.assertEqual(len(set(serial[:len(self.custom_formats)])), len(self.custom_formats))
+        wrap_cache.clear()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            concurrent = list(executor.map(self.render, indices))
+        self.assertEqual(concurrent, serial)
+        self.assertEqual(formats, compile_formats().as_dict())
+
+    def test_striped_wrap_cache(self):
+        cache = WrapCache(maxsize=1024, stripes=8)
+        def put(index: int) -> None:
+            for text in range(index * 50, (index + 1) * 50):
+                cache.put((str(text),), (str(text),))
+                self.assertEqual(cache.get((str(text),)), (str(text),))
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(put, range(8)))
+        self.assertEqual(cache.hits, 400)
+        self.assertEqual(len(cache), 400)
+
+class TestLayout(unittest.TestCase):
+    rows = [[f"Pos {i}", "Artikel " * (i % 5 + 1), f"{i},00 €"] for i in range(150)]
+
+    def compare(self, content) -> dict:
+        # Called twice, as the rows of streamed tables are consumed
+        rendered = PdfTemplateManager()
+        rendered.render_content(content())
+        pdf = PdfTemplateManager()
+        positions = []
+        result = LayoutRecorder.result
+        def record(recorder, pdf):
+            positions.append(pdf.y)
+            return result(recorder, pdf)
+        with mock.patch.object(LayoutRecorder, "result", record):
+            layout = pdf.layout(content())
+        self.assertEqual(len(layout["pages"]), rendered.page)
+        self.assertAlmostEqual(positions[0], rendered.y)
+        return layout
+
+    def test_same_pages_as_render(self):
+        layout = self.compare(lambda: main_content + [{"type": "table", "args": {"table_items": self.rows}}])
+        self.assertEqual(len(layout["blocks"]), len(main_content) + 1)
+        self.assertEqual(layout["pages"][0], (210, 297))
+        # The table continues on the following pages
+        pages = [box[0] for box in layout["blocks"][-1]["boxes"]]
+        self.assertEqual(pages, list(range(pages[0], len(layout["pages"]) + 1)))
+
+    def test_streamed_and_justified_blocks(self):
+        self.compare(lambda: [
+            {"type": "table", "args": {"table_items": (row for row in self.rows)}},
+            {"type": "text", "args": {"lines": ["Lorem ipsum dolor sit amet. " * 200], "align": "J"}},
+        ])
+
+    def test_unbreakable_table(self):
+        layout = self.compare(lambda: [
+            {"type": "text", "args": {"lines": ["Lorem ipsum"] * 40}},
+            {"type": "table", "args": {"table_items": self.rows[:20], "unbreakable": True}},
+        ])
+        self.assertEqual([box[0] for box in layout["blocks"][1]["boxes"]], [2])
+
+    def test_absolute_position(self):
+        pdf = PdfTemplateManager()
+        layout = pdf.layout([
+            {"type": "text", "args": {"lines": ["Hello", "World"], "y": 50, "w": 60}},
+            {"type": "line", "args": {"x1": 20, "y1": 80, "x2": 190}},
+        ])
+        self.assertEqual(layout["blocks"][0]["boxes"][0][:4], (1, pdf.l_margin, 50, 60))
+        self.assertAlmostEqual(layout["blocks"][0]["boxes"][0][4], 2 * pdf.line_height)
+        self.assertEqual(layout["blocks"][1], {"type": "line", "boxes": [(1, 20, 80, 170, 0)]})
+
+    def test_nothing_is_written(self):
+        pdf = PdfTemplateManager()
+        contents = bytes(pdf.pages[1].contents)
+        pdf.layout(main_content + [{"type": "table", "args": {"table_items": self.rows}}])
+        self.assertEqual(bytes(pdf.pages[1].contents), contents)
+        self.assertEqual((pdf.page, len(pdf.pages), pdf.dry_run), (1, 1, False))
+
+    def test_cached_blocks_and_profiler(self):
+        content = [{"type": "text", "args": {"lines": ["DaumDigital", "Olshausenstr. 11"]}, "cache": True}] * 2
+        PdfTemplateManager().render_content(content)
+        profiler = RenderProfiler()
+        pdf = PdfTemplateManager(profiler=profiler)
+        layout = pdf.layout(content)
+        self.assertEqual([block["type"] for block in profiler.report()["blocks"]], ["text", "text"])
+        first, second = (block["boxes"][0] for block in layout["blocks"])
+        self.assertAlmostEqual(second[2], first[2] + first[4])
+        # The layout can still be rendered
+        self.assertTrue(bytes(pdf.render(content)).startswith(b"%PDF"))
+
+class TestRenderProfiler(unittest.TestCase):
+    content = [
+        {"type": "text", "args": {"lines": ["Lorem ipsum dolor sit amet. " * 20], "align": "J"}},
+        {"type": "line", "args": {"x1": 20, "y1": 80, "x2": 190}},
+        {"type": "table", "args": {"table_items": [[f"Pos {i}", "Artikel", f"{i},00 €"] for i in range(100)]}},
+    ]
+
+    def test_report(self):
+        profiler = RenderProfiler()
+        PdfTemplateManager(profiler=profiler).render(self.content)
+        report = profiler.report()
+        self.assertEqual([block["type"] for block in report["blocks"]], ["text", "line", "table"])
+        text, line, table = report["blocks"]
+        self.assertEqual(text["multi_cell_calls"], 1)
+        self.assertEqual(line["multi_cell_calls"], 0)
+        self.assertGreater(table["page_breaks"], 0)
+        self.assertIsNone(table["allocated_bytes"])
+        self.assertEqual(report["totals"]["page_breaks"], table["page_breaks"])
+        output = report["output"]
+        self.assertGreater(output["fonts_ms"], 0)
+        self.assertGreater(output["pages_ms"], 0)
+        self.assertAlmostEqual(output["total_ms"], output["pages_ms"] + output["fonts_ms"] + output["other_ms"])
+
+    def test_same_output(self):
+        profiled = PdfTemplateManager(deterministic=True, profiler=RenderProfiler()).render(self.content)
+        self.assertEqual(profiled, PdfTemplateManager(deterministic=True).render(self.content))
+
+    def test_chrome_trace(self):
+        profiler = RenderProfiler()
+        PdfTemplateManager(profiler=profiler).render(self.content)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "trace.json")
+            profiler.write_chrome_trace(path)
+            with open(path) as f:
+                events = json.load(f)["traceEvents"]
+        names = [event["name"] for event in events]
+        self.assertEqual(names[:3], ["text #0", "line #1", "table #2"])
+        self.assertIn("output", names)
+        self.assertTrue(all(event["ph"] == "X" and event["dur"] >= 0 for event in events))
+
+    def test_trace_memory(self):
+        with RenderProfiler(trace_memory=True) as profiler:
+            PdfTemplateManager(profiler=profiler).render_content(self.content)
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertTrue(all(block["peak_bytes"] > 0 for block in profiler.report()["blocks"]))
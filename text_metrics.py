@@ -0,0 +1,259 @@
+import threading
+from collections import OrderedDict
+
+from fpdf import FPDF
+from fpdf.errors import FPDFException
+from fpdf.fonts import TTFFont
+from fpdf.line_break import BREAKING_SPACE_SYMBOLS_STR, FORM_FEED, HYPHEN, NBSP, NEWLINE, SOFT_HYPHEN, SPACE
+from fpdf.util import FloatTolerance
+
+
+# Characters, which have a special meaning for the line breaking
+SPECIAL_CHARACTERS = frozenset((NEWLINE, FORM_FEED, SOFT_HYPHEN, NBSP))
+
+
+def split_lines(widths, font_size_pt: float, k: float, text: str, max_width: float, print_sh: bool=False) -> list:
+    """
+    Splits a text into lines the same way `FPDF.multi_cell` does (with the word wrap mode),
+    but solely based on the advance widths of the glyphs. No PDF operators are generated.
+    Returns a list of lines, where each line is a list of characters.
+    Args:
+        widths (callable): Returns the advance width of a character in font units (1/1000 em).
+        font_size_pt (float): The font size in points.
+        k (float): The scale factor of the document unit.
+        text (str): The text to split.
+        max_width (float): The available width for the text, without the clearance margins.
+        print_sh (bool): If True, soft hyphens are rendered instead of used as break hints.
+    """
+    if text and SPECIAL_CHARACTERS.isdisjoint(text):
+        # Fast path for the most common case: the entire text fits into a single line
+        line_width = sum(map(widths, text[:-1]))
+        char_width = widths(text[-1])
+        if not FloatTolerance.greater_than(
+            line_width * font_size_pt * 0.001 / k + char_width * font_size_pt * 0.001 / k, max_width
+        ):
+            return [list(text)] if line_width + char_width else []
+
+    lines = []
+    index, length = 0, len(text)
+    last_forced_break = None
+    while index < length:
+        chars = []
+        # Sum of the widths of all characters on the current line in font units
+        line_width = 0
+        space_hint = hyphen_hint = None
+        forced_break, last_forced_break = last_forced_break, None
+        while index < length:
+            char = text[index]
+            if char == SOFT_HYPHEN and not print_sh:
+                char_width = widths(HYPHEN)
+            else:
+                char_width = widths(char)
+
+            if char in (NEWLINE, FORM_FEED):
+                index += 1
+                break
+            # Same floating point operations as fpdf, so we get identical results
+            if FloatTolerance.greater_than(
+                line_width * font_size_pt * 0.001 / k + char_width * font_size_pt * 0.001 / k, max_width
+            ):
+                if char in BREAKING_SPACE_SYMBOLS_STR:
+                    index += 1
+                elif space_hint is not None or hyphen_hint is not None:
+                    if hyphen_hint is not None and (space_hint is None or hyphen_hint[2] > space_hint[2]):
+                        del chars[hyphen_hint[1]:]
+                        chars.append(HYPHEN)
+                        index = hyphen_hint[0] + 1
+                    else:
+                        del chars[space_hint[1]:]
+                        index = space_hint[0] + 1
+                elif forced_break == index:
+                    raise FPDFException("Not enough horizontal space to render a single character")
+                else:
+                    last_forced_break = index
+                break
+
+            # Break hints are (index in text, index in line, line width)
+            if char in BREAKING_SPACE_SYMBOLS_STR:
+                space_hint = (index, len(chars), line_width)
+            elif char == NBSP:
+                char = SPACE
+            elif char == SOFT_HYPHEN and not print_sh:
+                hyphen_hint = (index, len(chars), line_width)
+                index += 1
+                continue
+            chars.append(char)
+            line_width += widths(char)
+            index += 1
+        else:
+            # The last line is only kept, if it has a width
+            if not line_width:
+                break
+        lines.append(chars)
+    return lines
+
+
+class _WrapStripe:
+    """
+    Stripe of the `WrapCache`, an LRU with its own lock and counters.
+    """
+    __slots__ = ("maxsize", "lines", "lock", "hits", "misses")
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.lines = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+class WrapCache:
+    """
+    Bounded LRU cache of wrapped texts. Stores the line splits per text, font, font size and width,
+    so repeated texts such as addresses, headings or units are only wrapped once per process.
+    The alignment does not influence the line splits, hence it is not part of the key.
+    The entries are distributed over stripes by the hash of their key, each with its own LRU and lock,
+    so threads rendering documents concurrently rarely wait for each other. Small caches consist
+    of a single stripe, i.e. an exact LRU.
+    """
+    def __init__(self, maxsize: int=4096, stripes: int=16) -> None:
+        self.maxsize = maxsize
+        count = max(1, min(stripes, maxsize // 64))
+        self._stripes = tuple(_WrapStripe(maxsize // count) for _ in range(count))
+
+    def __len__(self) -> int:
+        return sum(len(stripe.lines) for stripe in self._stripes)
+
+    def __deepcopy__(self, memo: dict) -> "WrapCache":
+        # The cache is shared between documents, hence copies of a document share it as well
+        return self
+
+    @property
+    def hits(self) -> int:
+        return sum(stripe.hits for stripe in self._stripes)
+
+    @property
+    def misses(self) -> int:
+        return sum(stripe.misses for stripe in self._stripes)
+
+    def _stripe(self, key: tuple) -> _WrapStripe:
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def get(self, key: tuple) -> tuple|None:
+        """
+        Returns the cached lines for the given key or None.
+        """
+        stripe = self._stripe(key)
+        with stripe.lock:
+            lines = stripe.lines.get(key)
+            if lines is None:
+                stripe.misses += 1
+                return None
+            stripe.hits += 1
+            stripe.lines.move_to_end(key)
+            return lines
+
+    def put(self, key: tuple, lines: tuple) -> None:
+        """
+        Stores the lines for the given key and evicts the least recently used entries of its stripe.
+        """
+        stripe = self._stripe(key)
+        with stripe.lock:
+            stripe.lines[key] = lines
+            stripe.lines.move_to_end(key)
+            while len(stripe.lines) > stripe.maxsize:
+                stripe.lines.popitem(last=False)
+
+    def stats(self) -> dict:
+        """
+        Returns the number of hits and misses, the hit rate and the number of cached texts.
+        """
+        hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0,
+            "texts": len(self),
+        }
+
+    def clear(self) -> None:
+        """
+        Removes all cached texts and resets the counters.
+        """
+        for stripe in self._stripes:
+            with stripe.lock:
+                stripe.lines.clear()
+                stripe.hits = 0
+                stripe.misses = 0
+
+
+# Shared by all instances of the template manager within the current process
+wrap_cache = WrapCache()
+
+
+def is_measurable(pdf: FPDF, text: str) -> bool:
+    """
+    Checks, whether the text can be measured by `split_lines` with the current settings of the document.
+    Text shaping, fallback fonts, character spacing, font stretching and page number aliases
+    require the full line breaking of fpdf.
+    """
+    font = pdf.current_font
+    return (
+        font is not None
+        and not pdf.text_shaping
+        and not pdf._fallback_font_ids
+        and pdf.char_spacing == 0
+        and pdf.font_stretching == 100
+        and not getattr(font, "is_symbol", False)
+        and not (pdf.str_alias_nb_pages and pdf.str_alias_nb_pages in text)
+    )
+
+
+def wrap_text(pdf: FPDF, text: str, max_width: float) -> tuple:
+    """
+    Wraps a normalized text with the current font of the document and returns its lines.
+    The lines are looked up in the wrap cache first. Make sure the text `is_measurable`.
+    Args:
+        pdf (FPDF): The document providing the font.
+        text (str): The normalized text to wrap.
+        max_width (float): The available width for the text, without the clearance margins.
+    """
+    font = pdf.current_font
+    key = (text, font.fontkey, str(getattr(font, "ttffile", "")), pdf.font_size_pt, pdf.k, max_width)
+    lines = wrap_cache.get(key)
+    if lines is None:
+        cw = font.cw
+        if isinstance(font, TTFFont):
+            widths = lambda char: cw[ord(char)]
+        else:
+            widths = lambda char: cw[char]
+        lines = tuple("".join(chars) for chars in split_lines(widths, pdf.font_size_pt, pdf.k, text, max_width))
+        # Like fpdf, we always have at least one (empty) line
+        lines = lines or ("",)
+        wrap_cache.put(key, lines)
+    return lines
+
+
+def measure_text(pdf: FPDF, text: str, w: float=0, h: float|None=None) -> tuple:
+    """
+    Measures a text like `FPDF.multi_cell` with the current font of the document, without rendering it.
+    Returns a tuple (lines, height), where lines is the list of wrapped lines and height is the height
+    of the multi cell (including an empty line for a trailing line break).
+    Args:
+        pdf (FPDF): The document providing the font and the cell margins.
+        text (str): The text to measure.
+        w (float): The width of the cell. If 0, the width extends to the right margin.
+        h (float): The height of each line. Defaults to the font size.
+    """
+    if h is None:
+        h = pdf.font_size
+    if w == 0:
+        w = pdf.w - pdf.r_margin - pdf.x
+    text = pdf.normalize_text(text).replace("\r", "")
+    if not is_measurable(pdf, text):
+        lines = pdf.multi_cell(w=w, h=h, text=text, dry_run=True, output="LINES")
+        return lines, (len(lines) + text.endswith(NEWLINE)) * h
+
+    lines = wrap_text(pdf, text, w - pdf.c_margin - pdf.c_margin)
+    return list(lines), (len(lines) + text.endswith(NEWLINE)) * h